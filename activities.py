@@ -1,9 +1,21 @@
 from enum import IntFlag
 import datetime
+import logging
 import humanize
 
+from utils import init_log
+
 Idle = 0
 
+logger = logging.getLogger('activities')
+init_log(logger)
+
+#
+# Callables, called with (owner, activities) whenever an owner's activities change
+#
+observers = list()
+
+
 class Activities:
     _activities: IntFlag
     _timing: dict
@@ -14,16 +26,27 @@ class Activities:
 
     def start_activity(self, activity: IntFlag):
         self._activities |= activity
-        self._timing[activity] = datetime.datetime.now
+        self._timing[activity] = datetime.datetime.now()
         if hasattr(self, 'logger'):
             self.logger.debug(f"Started activity {activity}")
-
+        self.notify_observers()
 
     def end_activity(self, activity: IntFlag):
         self._activities &= ~activity
-        duration = self._timing[activity] - datetime.datetime.now
+        duration = datetime.datetime.now() - self._timing.pop(activity, datetime.datetime.now())
         if hasattr(self, 'logger'):
-            self.logger.debug(f"Ended activity {activity} (duration={humanize.precisedelta(duration, 'microseconds')})")
+            self.logger.debug(f"Ended activity {activity} (duration={humanize.precisedelta(duration, minimum_unit='microseconds')})")
+        self.notify_observers()
+
+    def notify_observers(self):
+        for observer in observers:
+            try:
+                observer(self, self._activities)
+            except Exception as ex:
+                logger.exception(f"activities observer {observer} failed for '{self.activities_name()}'", exc_info=ex)
+
+    def activities_name(self) -> str:
+        return type(self).__name__.lower()
 
     def is_active(self, activity: IntFlag):
         return self._activities & activity != Idle
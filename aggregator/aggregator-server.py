@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from socket import gethostname
+
+import uvicorn
+from fastapi import FastAPI
+from starlette.responses import StreamingResponse
+
+from aggregator import SiteAggregator, load_config
+from utils import init_log, LAST_API_ROOT, PrettyJSONResponse
+from deadlines import DeadlineMiddleware
+
+logger = logging.getLogger('site-aggregator-server')
+init_log(logger)
+
+config = load_config()
+aggregator = SiteAggregator(hosts=config['units'], port=config['port'], unit_timeout=config['unit_timeout'],
+                            max_connections=config['max_connections'])
+poller_task: asyncio.Task = None
+
+
+async def poll():
+    """
+    Keeps the merged snapshot fresh, so that reads are answered from memory
+    """
+    while True:
+        try:
+            duration = await aggregator.refresh()
+            logger.debug(f"refreshed {len(aggregator.units)} units in {duration:.3f} seconds")
+        except Exception as ex:
+            logger.exception("poller failed", exc_info=ex)
+        await asyncio.sleep(config['poll_interval'])
+
+
+@asynccontextmanager
+async def lifespan(fast_app: FastAPI):
+    global poller_task
+    poller_task = asyncio.get_running_loop().create_task(poll())
+    yield
+    poller_task.cancel()
+    await aggregator.close()
+
+app = FastAPI(
+    title=f'LAST Site aggregator on {gethostname()}',
+    docs_url='/docs',
+    redocs_url='/redocs',
+    lifespan=lifespan,
+    openapi_url='/openapi.json')
+app.add_middleware(DeadlineMiddleware)
+
+
+@app.get(LAST_API_ROOT + 'site/status', tags=['site'], response_class=PrettyJSONResponse)
+async def site_status(since: int = None, fresh: bool = False):
+    """
+    The merged state of all the unit servers, from memory.  With 'since' only the units that changed
+     after that version, with 'fresh' after refreshing all the units (bounded by the per-unit timeout,
+     or the request's deadline)
+    """
+    if fresh:
+        await aggregator.refresh()
+    return PrettyJSONResponse({'Value': aggregator.snapshot(since=since)})
+
+
+@app.get(LAST_API_ROOT + 'site/stats', tags=['site'], response_class=PrettyJSONResponse)
+async def site_stats():
+    return PrettyJSONResponse({'Value': aggregator.stats()})
+
+
+@app.get(LAST_API_ROOT + 'site/events', tags=['site'])
+async def site_events():
+    """
+    Streams (as server-sent events) the changes in the units' states, as seen by the poller
+    """
+    queue = asyncio.Queue(maxsize=100)
+
+    def on_event(event: dict):
+        if not queue.full():
+            queue.put_nowait(event)
+
+    unsubscribe = aggregator.subscribe(on_event)
+
+    async def stream():
+        try:
+            while True:
+                event = await queue.get()
+                yield f"data: {json.dumps(event, default=str)}\n\n"
+        finally:
+            unsubscribe()
+
+    return StreamingResponse(stream(), media_type='text/event-stream')
+
+
+if __name__ == "__main__":
+    uvicorn_config = uvicorn.Config(app=app, host="0.0.0.0", port=8001)
+    uvicorn_server = uvicorn.Server(config=uvicorn_config)
+    uvicorn_server.run()
@@ -0,0 +1,213 @@
+import asyncio
+import copy
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+unit_dir = str(Path(__file__).resolve().parent.parent / 'unit')
+sys.path.append(unit_dir)
+from utils import init_log, LAST_API_ROOT, default_port
+from deadlines import remaining, timeout_header
+from config import merge
+from versioning import Replica
+
+logger = logging.getLogger('site-aggregator')
+init_log(logger)
+
+#
+# The aggregator's configuration: the built-in defaults below, (deep-)overridden by the JSON file
+#  named by $LAST_SITE_AGGREGATOR_CONFIG (default: /etc/last/site-aggregator.json), if it exists.
+#
+default_config_file = os.path.join('/etc', 'last', 'site-aggregator.json')
+
+defaults = {
+    'units': [f"last{mount:02d}{side}" for mount in range(1, 13) for side in ['e', 'w']],
+    'port': default_port,
+    'unit_timeout': 2.0,        # seconds, per unit server
+    'poll_interval': 5.0,       # seconds, between refreshes of the merged snapshot
+    'max_connections': 32,      # to all the unit servers, together
+}
+
+
+def load_config(path: str = None) -> dict:
+    if path is None:
+        path = os.environ.get('LAST_SITE_AGGREGATOR_CONFIG', default_config_file)
+    if not os.path.exists(path):
+        return copy.deepcopy(defaults)
+    try:
+        with open(path) as f:
+            override = json.load(f)
+    except Exception as ex:
+        logger.exception(f"cannot load configuration from '{path}', using the defaults", exc_info=ex)
+        return copy.deepcopy(defaults)
+    logger.info(f"loaded configuration from '{path}'")
+    return merge(defaults, override)
+
+
+class UnitState:
+    """
+    The latest known state of one unit server
+    """
+    host: str
+    status: Optional[dict] = None       # the 'Value' of its /unit/status
+    error: Optional[str] = None
+    fetched: Optional[datetime.datetime] = None     # when the status was last (successfully) fetched
+    attempted: Optional[datetime.datetime] = None
+    latency: Optional[float] = None     # seconds
+    version: int = 0                    # the site version at which this state last changed
+    replica: Replica                    # of the unit's versioned status, for conditional and delta polls
+
+    def __init__(self, host: str):
+        self.host = host
+        self.replica = Replica()
+
+    def to_dict(self) -> dict:
+        return {
+            'Host': self.host,
+            'Reachable': self.error is None and self.status is not None,
+            'Status': self.status,
+            'Error': self.error,
+            'Fetched': self.fetched.isoformat() if self.fetched else None,
+            'Latency': self.latency,
+            'Version': self.version,
+        }
+
+
+class SiteAggregator:
+    """
+    Keeps a merged snapshot of all the unit servers' states.
+
+    All the unit servers are queried concurrently, over a pool of kept-alive connections, each bounded
+     by its own timeout, so that a refresh takes at most unit_timeout seconds however many units are
+     slow or down.  Every change bumps the site's version, so that clients may ask for just what
+     changed since the version they already have.
+    """
+    units: Dict[str, UnitState]
+    version: int = 0
+    refreshed: Optional[datetime.datetime] = None
+    _snapshot: Optional[dict] = None    # the merged snapshot, rebuilt once per refresh (or change)
+    _subscribers: List[Callable]
+
+    def __init__(self, hosts: List[str], port: int = default_port, unit_timeout: float = 2.0,
+                 max_connections: int = 32):
+        self.port = port
+        self.unit_timeout = unit_timeout
+        self.units = {host: UnitState(host) for host in hosts}
+        self._subscribers = list()
+        self.client = httpx.AsyncClient(
+            trust_env=False,    # must have trust_env=False, to ignore proxy
+            timeout=unit_timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+
+    def url(self, host: str) -> str:
+        return f"http://{host}:{self.port}{LAST_API_ROOT}unit/status"
+
+    async def fetch(self, unit: UnitState, timeout: float):
+        unit.attempted = datetime.datetime.now()
+        start = time.monotonic()
+        status, error = unit.status, None
+        try:
+            reply = None
+            for attempt in range(2):
+                conditional = bool(unit.replica.params() or unit.replica.headers())
+                headers = {timeout_header: f"{timeout:.3f}", **unit.replica.headers()}
+                response = await asyncio.wait_for(
+                    self.client.get(self.url(unit.host), params=unit.replica.params(), headers=headers,
+                                    timeout=timeout),
+                    timeout=timeout)
+                if response.status_code != 304:
+                    response.raise_for_status()
+                reply = unit.replica.update(response.status_code, response.headers.get('ETag'), response.content)
+                if reply is not None or not conditional:
+                    break
+                # e.g. a 304 for a status we no longer have, or changes since another version: the replica was
+                #  reset, ask for all of it
+            if reply is None:
+                error = f"unusable reply (status code {response.status_code})"
+            elif 'Value' in reply:
+                status = reply['Value']
+            else:
+                error = f"{reply.get('Error') or reply.get('Exception')}"
+        except asyncio.TimeoutError:
+            error = f"no response within {timeout:.3f} seconds"
+        except Exception as ex:
+            error = f"{ex}" or type(ex).__name__
+        unit.latency = time.monotonic() - start
+
+        if error is None:
+            unit.fetched = datetime.datetime.now()
+        if status is not unit.status and status != unit.status or error != unit.error:
+            unit.status, unit.error = status, error
+            self.changed(unit)
+
+    def changed(self, unit: UnitState):
+        self.version += 1
+        unit.version = self.version
+        self._snapshot = None
+        event = {'Version': self.version, 'Unit': unit.to_dict()}
+        for callback in list(self._subscribers):
+            try:
+                callback(event)
+            except Exception as ex:
+                logger.exception(f"subscriber {callback} failed", exc_info=ex)
+
+    async def refresh(self, timeout: float = None) -> float:
+        """
+        Fetches all the units' states concurrently, returns the duration
+        """
+        timeout = remaining(self.unit_timeout if timeout is None else timeout)
+        start = time.monotonic()
+        await asyncio.gather(*[self.fetch(unit, timeout) for unit in self.units.values()])
+        self.refreshed = datetime.datetime.now()
+        self._snapshot = None
+        return time.monotonic() - start
+
+    def snapshot(self, since: int = None) -> dict:
+        """
+        The merged state of the site, or only the units that changed after version 'since'
+        """
+        if since is not None:
+            changed = [u for u in self.units.values() if u.version > since]
+            return {
+                'Version': self.version,
+                'Since': since,
+                'Units': {u.host: u.to_dict() for u in changed},
+            }
+
+        if self._snapshot is None:
+            units = {host: unit.to_dict() for host, unit in self.units.items()}
+            reachable = len([u for u in units.values() if u['Reachable']])
+            self._snapshot = {
+                'Version': self.version,
+                'Refreshed': self.refreshed.isoformat() if self.refreshed else None,
+                'Reachable': reachable,
+                'Unreachable': len(units) - reachable,
+                'Units': units,
+            }
+        return self._snapshot
+
+    def subscribe(self, callback: Callable) -> Callable:
+        """
+        Calls callback(event) for every change in a unit's state, returns a function that unsubscribes
+        """
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback) if callback in self._subscribers else None
+
+    def stats(self) -> dict:
+        latencies = [u.latency for u in self.units.values() if u.latency is not None]
+        return {
+            'Units': len(self.units),
+            'Version': self.version,
+            'MaxLatency': max(latencies) if latencies else None,
+            'MeanLatency': (sum(latencies) / len(latencies)) if latencies else None,
+        }
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,238 @@
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+
+from utils import init_log
+from telescope import Telescope
+from exposure import UnitExposure
+from frames import frame_store
+from activities import Activities, UnitActivities
+
+logger = logging.getLogger('unit-autofocus')
+init_log(logger)
+
+
+def focus_metrics(frames: List[np.ndarray], subsample: int = 2) -> np.ndarray:
+    """
+    Computes, per frame, a measure of the sources' size: sqrt(flux / (sum of squared, noise-corrected,
+     residuals)).  For a frame of similar sources it is proportional to their width, so it is smallest
+     in focus and grows linearly with defocus, making for a V-curve.  No thresholding is involved, so
+     faint defocused sources do not drop out of the measure.
+
+    Frames of the same shape are computed as one stack.
+    """
+    shapes = set([f.shape for f in frames])
+    if len(shapes) > 1:
+        return np.concatenate([focus_metrics([f], subsample=subsample) for f in frames])
+
+    stack = np.stack([f[::subsample, ::subsample] for f in frames]).astype(np.float32)
+    flat = stack.reshape(stack.shape[0], -1)
+    background = np.median(flat, axis=1)
+    residuals = flat - background[:, None]
+    noise = 1.4826 * np.median(np.abs(residuals), axis=1)
+    flux = residuals.sum(axis=1, dtype=np.float64)
+    power = np.square(residuals, dtype=np.float64).sum(axis=1) - flat.shape[1] * np.square(noise, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where((flux > 0) & (power > 0), np.sqrt(flux / power), np.nan)
+
+
+def fit_parabolas(positions: np.ndarray, metrics: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Fits metric = a * x^2 + b * x + c for all the telescopes at once (one column per telescope), ignoring NaNs.
+    Returns the positions of the minima (NaN where the fit has no minimum) and the curvatures (a).
+    """
+    center = np.nanmean(positions, axis=0)
+    x = positions - center
+    valid = np.isfinite(x) & np.isfinite(metrics)
+    design = np.stack([np.square(x), x, np.ones_like(x)], axis=-1)      # (steps, telescopes, 3)
+    design = np.where(valid[..., None], design, 0)
+    y = np.where(valid, metrics, 0)
+
+    normal = np.einsum('sti,stj->tij', design, design)                  # (telescopes, 3, 3)
+    rhs = np.einsum('sti,st->ti', design, y)                            # (telescopes, 3)
+    coefficients = np.einsum('tij,tj->ti', np.linalg.pinv(normal), rhs)
+    a, b = coefficients[:, 0], coefficients[:, 1]
+    enough = valid.sum(axis=0) >= 3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        best = np.where(enough & (a > 0), center - b / (2 * a), np.nan)
+    return best, a
+
+
+def bracketed(metrics: np.ndarray, rise: float, points_after: int) -> np.ndarray:
+    """
+    Per telescope (column): is the minimum surrounded, i.e. it is not the first sample and at least
+     points_after later samples are all higher than it by at least the rise fraction?
+    """
+    steps = metrics.shape[0]
+    filled = np.where(np.isfinite(metrics), metrics, np.inf)
+    lowest = filled.argmin(axis=0)
+    minimum = filled.min(axis=0)
+    after = np.arange(steps)[:, None] > lowest[None, :]
+    higher = (filled > minimum * (1 + rise)) | ~after
+    return (lowest > 0) & (steps - 1 - lowest >= points_after) & higher.all(axis=0) & np.isfinite(minimum)
+
+
+class Autofocus:
+    """
+    Autofocuses all the unit's telescopes at once:
+    - At each step all the (not yet done) focusers move concurrently, then all the cameras expose together
+    - The focus metrics of all the frames are computed as one NumPy stack
+    - A telescope is done once its minimum is bracketed, the sweep ends when all of them are done (or
+       the range is exhausted)
+    - The V-curves are fitted (as parabolas) for all the telescopes at once and the focusers are sent
+       to the best positions
+
+    The unit (activities) is Exposing during each step's exposure, as it is for its own exposures.
+
+    The frames are not fetched from the cameras: each camera's driver is expected to push its frames, once
+     read out, to the unit (PUT unit/frames/{camera_id}, see frames.py).  A camera that does not push its
+     frame, or whose trigger or exposure fails, gets no metric for the step.
+    """
+    telescopes: List[Telescope]
+    exptime: float
+    step: float
+    max_steps: int
+    rise: float
+    points_after: int
+    fit_half_width: int
+    positions: np.ndarray   # (max_steps, telescopes), NaN where not sampled
+    metrics: np.ndarray     # (max_steps, telescopes), NaN where not sampled
+    best: Optional[np.ndarray] = None
+    state: str = 'idle'
+    error: Optional[str] = None
+    _move_timeout = 60      # seconds
+    _frame_timeout = 30     # seconds, beyond the exposure time
+
+    def __init__(self, telescopes: List[Telescope], exptime: float, step: float, max_steps: int = 15,
+                 rise: float = 0.2, points_after: int = 2, fit_half_width: int = 2,
+                 activities: Optional[Activities] = None):
+        self.activities = activities
+        self.telescopes = [t for t in telescopes if t is not None]
+        if len(self.telescopes) == 0:
+            raise Exception("No telescopes to autofocus")
+        self.exptime = exptime
+        self.step = step
+        self.max_steps = max_steps
+        self.rise = rise
+        self.points_after = points_after
+        self.fit_half_width = fit_half_width
+        shape = (max_steps, len(self.telescopes))
+        self.positions = np.full(shape, np.nan)
+        self.metrics = np.full(shape, np.nan)
+        self.done = np.zeros(len(self.telescopes), dtype=bool)
+        self.steps_taken = 0
+        self.started = None
+        self.ended = None
+
+    def move(self, executor: ThreadPoolExecutor, indices: List[int], positions: np.ndarray):
+        def move_one(i):
+            error = self.telescopes[i].move_focuser(float(positions[i]))
+            if error is not None:
+                raise Exception(f"focuser-{self.telescopes[i].id}: {error}")
+            if not self.telescopes[i].wait_for_focuser(timeout=self._move_timeout):
+                raise Exception(f"focuser-{self.telescopes[i].id} did not arrive within {self._move_timeout} sec")
+        list(executor.map(move_one, indices))
+
+    def expose(self, executor: ThreadPoolExecutor, indices: List[int], exposure_id: int) -> np.ndarray:
+        telescopes = [self.telescopes[i] for i in indices]
+        seqs = [frame_store.last_seq(t.id) for t in telescopes]
+        exposure = UnitExposure(id=exposure_id, exptime=self.exptime, telescopes=telescopes,
+                                on_error=lambda e: frame_store.wake())
+
+        def wait_for_frame(j: int):
+            e = exposure.cameras[j]
+            if e.error is not None:     # not armed or not triggered, no frame is coming
+                return None
+            return frame_store.wait_for_frame(telescopes[j].id, after_seq=seqs[j],
+                                              timeout=self.exptime + self._frame_timeout,
+                                              failed=lambda: e.error is not None)
+
+        if self.activities is not None:
+            self.activities.start_activity(UnitActivities.Exposing)
+        try:
+            exposure.start()
+            completion = threading.Thread(name=f"unit-autofocus-exposure-{exposure_id}-completion-thread",
+                                          target=exposure.wait_for_completion)
+            completion.start()
+            frames = list(executor.map(wait_for_frame, range(len(telescopes))))
+            completion.join()   # the cameras are idle (or failed) before the next step
+        finally:
+            if self.activities is not None:
+                self.activities.end_activity(UnitActivities.Exposing)
+        metrics = np.full(len(indices), np.nan)
+        arrived = [j for j, f in enumerate(frames) if f is not None]
+        if arrived:
+            metrics[arrived] = focus_metrics([frames[j].data for j in arrived])
+        for j, f in enumerate(frames):
+            if f is None:
+                error = exposure.cameras[j].error
+                logger.error(f"no frame from camera-{telescopes[j].id} for step {self.steps_taken}" +
+                             (f" ({error})" if error else ""))
+        return metrics
+
+    def run(self) -> dict:
+        self.state = 'running'
+        self.started = datetime.datetime.now()
+        try:
+            with ThreadPoolExecutor(max_workers=len(self.telescopes), thread_name_prefix='unit-autofocus-') as executor:
+                centers = np.array(list(executor.map(lambda t: t.focuser_position(), self.telescopes)), dtype=float)
+                if np.isnan(centers).any():
+                    raise Exception(f"Could not get all the focuser positions ({centers})")
+                offsets = (np.arange(self.max_steps) - (self.max_steps - 1) / 2) * self.step
+                planned = centers[None, :] + offsets[:, None]
+
+                for s in range(self.max_steps):
+                    active = [i for i in range(len(self.telescopes)) if not self.done[i]]
+                    if not active:
+                        break
+                    self.move(executor, active, planned[s])
+                    self.positions[s, active] = planned[s, active]
+                    self.metrics[s, active] = self.expose(executor, active, exposure_id=s + 1)
+                    self.steps_taken = s + 1
+                    self.done |= bracketed(self.metrics[:self.steps_taken], rise=self.rise, points_after=self.points_after)
+                    logger.info(f"step {s}: positions={planned[s, active]}, metrics={self.metrics[s, active]}, "
+                                f"done={self.done}")
+
+                # fit only the bottom of the V-curves (the minimum and its neighbours), where they are parabola-like
+                metrics = self.metrics[:self.steps_taken]
+                lowest = np.where(np.isfinite(metrics), metrics, np.inf).argmin(axis=0)
+                near = np.abs(np.arange(self.steps_taken)[:, None] - lowest[None, :]) <= self.fit_half_width
+                self.best, _ = fit_parabolas(self.positions[:self.steps_taken], np.where(near, metrics, np.nan))
+                found = [i for i in range(len(self.telescopes)) if np.isfinite(self.best[i])]
+                # telescopes without a fit go back to where they started
+                final = np.where(np.isfinite(self.best), self.best, centers)
+                self.move(executor, list(range(len(self.telescopes))), final)
+
+            self.state = 'done' if len(found) == len(self.telescopes) else 'partial'
+        except Exception as ex:
+            logger.exception("autofocus failed", exc_info=ex)
+            self.state = 'failed'
+            self.error = f"{ex}"
+        self.ended = datetime.datetime.now()
+        return self.report()
+
+    def report(self) -> dict:
+        def column(a: np.ndarray, i: int) -> list:
+            return [None if np.isnan(v) else float(v) for v in a[:self.steps_taken, i]]
+
+        telescopes = dict()
+        for i, t in enumerate(self.telescopes):
+            telescopes[f'telescope-{t.id}'] = {
+                'Positions': column(self.positions, i),
+                'Metrics': column(self.metrics, i),
+                'Bracketed': bool(self.done[i]),
+                'Best': None if self.best is None or np.isnan(self.best[i]) else float(self.best[i]),
+            }
+        return {
+            'State': self.state,
+            'Error': self.error,
+            'Steps': self.steps_taken,
+            'Started': self.started.isoformat() if self.started else None,
+            'Duration': (self.ended - self.started).total_seconds() if self.ended else None,
+            'Telescopes': telescopes,
+        }
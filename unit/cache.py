@@ -0,0 +1,83 @@
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+
+class ReadCache:
+    """
+    Caches the responses of a driver's getters, each method with its own time-to-live.
+    Any other method (a command, a property set) invalidates the cached methods that depend on it:
+    - the ones listed for it in 'invalidates'
+    - the ones listed for '*' in 'invalidates' (invalidated by any command)
+    - the method with the same name (setting a property invalidates getting it)
+
+    Getters may also be fed from elsewhere (e.g. the device's probes), with their own time-to-live.
+    Only GETs are served from the cache: a PUT of the same name (e.g. a setpoint named like a probed field)
+     is a property set, it invalidates the getter.
+    """
+    _entries: Dict[Hashable, Tuple[float, object]]
+    ttl: Dict[str, float]
+    fed: Set[str]
+    invalidates: Dict[str, List[str]]
+    hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+
+    def __init__(self, ttl: Dict[str, float] = None, invalidates: Dict[str, List[str]] = None):
+        self.ttl = ttl if ttl is not None else dict()
+        self.invalidates = invalidates if invalidates is not None else dict()
+        self._entries = dict()
+        self.fed = set()
+        self._lock = threading.Lock()
+
+    def cacheable(self, method: str, request_type: str = 'GET') -> bool:
+        return request_type == 'GET' and (method in self.ttl or method in self.fed)
+
+    def get(self, key: Hashable) -> Tuple[bool, Optional[object]]:
+        """
+        Returns (True, value) on a fresh hit, (False, None) otherwise
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return True, entry[1]
+        self.misses += 1
+        return False, None
+
+    def put(self, method: str, key: Hashable, value: object, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl.get(method)
+        if ttl is None:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+
+    def feed(self, method: str, key: Hashable, value: object, ttl: float):
+        self.fed.add(method)
+        self.put(method, key, value, ttl=ttl)
+
+    def invalidate(self, command: str):
+        """
+        Called whenever a command (a PUT) is sent to the device.  The fed getters are invalidated as
+         well: the device's state may change before its next probe.
+        """
+        methods = set(self.invalidates.get(command, []) + self.invalidates.get('*', []) + [command]) | self.fed
+        with self._lock:
+            stale = [key for key in self._entries if key[0] in methods]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'Entries': len(self._entries),
+            'Hits': self.hits,
+            'Misses': self.misses,
+            'HitRate': (self.hits / total) if total else None,
+            'Invalidations': self.invalidations,
+        }
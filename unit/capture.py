@@ -0,0 +1,155 @@
+import logging
+import os
+import struct
+import threading
+import time
+from enum import IntEnum
+from typing import Iterator, NamedTuple, Optional
+
+from fastapi import APIRouter
+
+from utils import LAST_API_ROOT, init_log, jsonResponse, path_maker
+from config import config
+
+logger = logging.getLogger('lipp-capture')
+init_log(logger)
+
+capture_router = APIRouter()
+
+#
+# A capture file is the magic, followed by records of:
+#   kind (uint8), timestamp (float64, time.time()), equipment length (uint16), data length (uint32),
+#   the equipment name (e.g. 'camera-1') and the datagram, as it went over the LIPP socket
+#
+magic = b'LIPPCAP1'
+record_header = struct.Struct('<BdHI')
+
+
+class Kind(IntEnum):
+    Request = 0     # unit -> driver
+    Reply = 1       # driver -> unit
+    Probe = 2       # driver -> unit, on the probing socket
+    Ready = 3       # driver -> unit, the first packet
+    Notice = 4      # unit -> driver, a request whose reply nobody waits for
+
+
+class CaptureRecord(NamedTuple):
+    kind: Kind
+    timestamp: float
+    equipment: str
+    data: bytes
+
+
+class CaptureWriter:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if is_new:
+            self.file.write(magic)
+        self._lock = threading.Lock()
+        self.records = 0
+        self.bytes = 0
+
+    def write(self, kind: Kind, equipment: str, data: bytes, timestamp: float = None):
+        name = equipment.encode()
+        header = record_header.pack(kind, time.time() if timestamp is None else timestamp, len(name), len(data))
+        with self._lock:
+            self.file.write(header + name + data)
+            self.records += 1
+            self.bytes += len(header) + len(name) + len(data)
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+def read_capture(path: str) -> Iterator[CaptureRecord]:
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise Exception(f"'{path}' is not a LIPP capture file")
+        while True:
+            header = f.read(record_header.size)
+            if len(header) < record_header.size:
+                return      # a truncated last record is ignored
+            kind, timestamp, name_length, data_length = record_header.unpack(header)
+            name = f.read(name_length)
+            data = f.read(data_length)
+            if len(data) < data_length:
+                return
+            yield CaptureRecord(Kind(kind), timestamp, name.decode(), data)
+
+
+class Capture:
+    """
+    Records the traffic of all the LIPP drivers, while started.  When stopped it costs one attribute check.
+    """
+    writer: Optional[CaptureWriter] = None
+
+    def start(self, path: str = None) -> str:
+        if path is None:
+            path = os.path.join(path_maker.make_daily_log_folder_name(), 'lipp-capture.bin')
+        self.stop()
+        self.writer = CaptureWriter(path)
+        logger.info(f"capturing LIPP traffic to '{path}'")
+        return path
+
+    def stop(self):
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+            logger.info(f"stopped capturing to '{writer.path}' ({writer.records} records, {writer.bytes} bytes)")
+
+    def record(self, kind: Kind, equipment: str, data: bytes):
+        writer = self.writer
+        if writer is not None:
+            try:
+                writer.write(kind, equipment, data)
+            except ValueError:
+                pass    # stopped (closed) meanwhile
+
+    def status(self) -> dict:
+        writer = self.writer
+        return {
+            'Capturing': writer is not None,
+            'Path': writer.path if writer else None,
+            'Records': writer.records if writer else None,
+            'Bytes': writer.bytes if writer else None,
+        }
+
+
+capture = Capture()
+if config['drivers']['capture']['enabled']:
+    capture.start(config['drivers']['capture']['path'])
+
+
+# Method 'capture'
+@capture_router.get(LAST_API_ROOT + 'unit/capture', tags=["unit"])
+async def unit_capture_status():
+    return jsonResponse({"Value": capture.status()})
+
+
+@capture_router.get(LAST_API_ROOT + 'unit/capture/start', tags=["unit"])
+async def unit_capture_start(name: str = None):
+    """
+    Starts capturing to a file (default 'lipp-capture.bin') in the daily log folder.  Only a file name is
+     accepted, not a path.
+    """
+    try:
+        if name is None:
+            name = 'lipp-capture.bin'
+        if name in ('', '.', '..') or os.path.basename(name) != name or \
+                (os.path.altsep is not None and os.path.altsep in name):
+            raise Exception(f"bad {name=}, expected a file name (no directories)")
+        capture.start(os.path.join(path_maker.make_daily_log_folder_name(), name))
+    except Exception as ex:
+        return jsonResponse({"Error": f"{ex}"})
+    return jsonResponse({"Value": capture.status()})
+
+
+@capture_router.get(LAST_API_ROOT + 'unit/capture/stop', tags=["unit"])
+async def unit_capture_stop():
+    status = capture.status()
+    capture.stop()
+    return jsonResponse({"Value": status})
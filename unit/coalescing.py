@@ -0,0 +1,264 @@
+import asyncio
+import contextvars
+import functools
+import json
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from deadlines import current_deadline
+
+
+def request_key(method: str, params: dict) -> Hashable:
+    return method, json.dumps(params, sort_keys=True, default=str)
+
+
+class Abandoned(Exception):
+    """
+    A caller stopped waiting for a shared request (it was cancelled or reached its deadline), the request
+     goes on for the other callers
+    """
+    pass
+
+
+class Call:
+    """
+    A caller's stake in a request, allows it to give up (e.g. when its HTTP client went away)
+    """
+    cancelled: bool = False
+    request_id: Optional[int] = None     # once sent
+    deadline: Optional[float] = None     # as in time.time()
+
+    def __init__(self, deadline: Optional[float] = None):
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._events = list()
+        self._callbacks = list()
+
+    def remaining(self, default: float) -> float:
+        """
+        Seconds left until the deadline, at most default
+        """
+        if self.deadline is None:
+            return default
+        return max(0.0, min(default, self.deadline - time.time()))
+
+    def watch(self, event: threading.Event):
+        """
+        Registers an event the request is waiting upon, cancelling will set it
+        """
+        with self._lock:
+            self._events.append(event)
+            cancelled = self.cancelled
+        if cancelled:
+            event.set()
+
+    def on_cancel(self, callback: Callable[[], None]):
+        with self._lock:
+            self._callbacks.append(callback)
+            cancelled = self.cancelled
+        if cancelled:
+            callback()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            events, callbacks = list(self._events), list(self._callbacks)
+        for event in events:
+            event.set()
+        for callback in callbacks:
+            callback()
+
+
+class Flight(Call):
+    """
+    The stake shared by the callers of a coalesced request: its deadline is the latest of theirs (None
+     when one of them has none) and it gets cancelled only once all of them have given up
+    """
+    callers: int = 0
+
+    def join(self, call: Optional[Call], deadline: Optional[float]) -> Callable[[], None]:
+        """
+        Adds a caller, returns the function to call when it stops waiting (it is called upon the
+         caller's cancellation anyway)
+        """
+        with self._lock:
+            self.callers += 1
+            if self.callers == 1:
+                self.deadline = deadline
+            elif self.deadline is not None:
+                self.deadline = None if deadline is None else max(self.deadline, deadline)
+        left = False
+
+        def leave():
+            nonlocal left
+            with self._lock:
+                if left:
+                    return
+                left = True
+                self.callers -= 1
+                abandoned = self.callers == 0
+            if abandoned:
+                self.cancel()
+
+        if call is not None:
+            call.on_cancel(leave)
+        return leave
+
+
+class _Call:
+    result: object = None
+    error: BaseException = None
+
+    def __init__(self):
+        self.flight = Flight()
+        self.done = False
+        self._lock = threading.Lock()
+        self._events = list()
+
+    def watch(self, event: threading.Event):
+        with self._lock:
+            self._events.append(event)
+            done = self.done
+        if done:
+            event.set()
+
+    def finish(self):
+        with self._lock:
+            self.done = True
+            events = list(self._events)
+        for event in events:
+            event.set()
+
+
+class _AsyncCall:
+    waiters: int = 0
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical requests: while a request for a given key is in flight, other
+     requests for the same key wait for it and share its result (or exception), instead of issuing
+     their own.
+
+    The shared request belongs to none of its callers: it is bounded by the latest of their deadlines,
+     a caller that gets cancelled (or reaches its own deadline) just stops waiting for it (Abandoned),
+     and it is cancelled only when none of its callers is left waiting.
+    """
+    _calls: Dict[Hashable, _Call]
+    _async_calls: Dict[Hashable, _AsyncCall]
+    hits: int = 0       # requests that shared an in-flight request
+    misses: int = 0     # requests that were actually issued
+    abandoned: int = 0  # callers that stopped waiting for a shared request
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+        self._async_calls = dict()
+
+    def do(self, key: Hashable, function: Callable[[Flight], object], call: Optional[Call] = None,
+           deadline: Optional[float] = None) -> object:
+        """
+        Blocking.  The request, function(flight), runs in a thread of its own, with the caller's context.
+        """
+        with self._lock:
+            shared = self._calls.get(key)
+            leader = shared is None or shared.flight.cancelled
+            if leader:
+                shared = _Call()
+                self._calls[key] = shared
+                self.misses += 1
+            else:
+                self.hits += 1
+            leave = shared.flight.join(call, deadline)
+
+        if leader:
+            context = contextvars.copy_context()
+            threading.Thread(name='single-flight', daemon=True,
+                             target=context.run, args=(self._run, key, shared, function)).start()
+
+        done = threading.Event()
+        shared.watch(done)
+        if call is not None:
+            call.watch(done)
+        done.wait(None if deadline is None else max(0.0, deadline - time.time()))
+        if not shared.done:
+            leave()
+            self.abandoned += 1
+            raise Abandoned("cancelled" if call is not None and call.cancelled else "past its deadline")
+        if shared.error is not None:
+            raise shared.error
+        return shared.result
+
+    def _run(self, key: Hashable, shared: _Call, function: Callable[[Flight], object]):
+        try:
+            shared.result = function(shared.flight)
+        except BaseException as ex:
+            shared.error = ex
+        finally:
+            with self._lock:
+                if self._calls.get(key) is shared:
+                    del self._calls[key]
+            shared.finish()
+
+    async def do_async(self, key: Hashable, coroutine_function: Callable[[], Awaitable]) -> object:
+        """
+        The request runs as a task of its own.  The coroutine is not bound by any caller's deadline
+         (only by its own timeouts), each caller waits for it until its own deadline.
+        """
+        loop = asyncio.get_running_loop()
+        key = (loop, key)   # a task is awaited on its own loop only (e.g. call_to_completion() runs loops of its own)
+        with self._lock:
+            shared = self._async_calls.get(key)
+            if shared is None:
+                self.misses += 1
+
+                async def unbounded():
+                    current_deadline.set(None)      # in the task's own copy of the context
+                    return await coroutine_function()
+
+                shared = _AsyncCall(loop.create_task(unbounded()))
+                self._async_calls[key] = shared
+                shared.task.add_done_callback(functools.partial(self._async_done, key, shared))
+            else:
+                self.hits += 1
+
+        deadline = current_deadline.get()
+        shared.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(shared.task),
+                                          None if deadline is None else max(0.0, deadline - time.time()))
+        except asyncio.TimeoutError:
+            if shared.task.done():
+                raise
+            self.abandoned += 1
+            raise Abandoned("past its deadline")
+        except asyncio.CancelledError:
+            self.abandoned += 1
+            raise
+        finally:
+            shared.waiters -= 1
+            if shared.waiters == 0 and not shared.task.done():
+                shared.task.cancel()
+
+    def _async_done(self, key: Hashable, shared: _AsyncCall, task: asyncio.Task):
+        with self._lock:
+            if self._async_calls.get(key) is shared:
+                del self._async_calls[key]
+        if not task.cancelled():
+            task.exception()    # mark as retrieved, when nobody waited for it
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'Hits': self.hits,
+            'Misses': self.misses,
+            'HitRate': (self.hits / total) if total else None,
+            'Abandoned': self.abandoned,
+            'InFlight': len(self._calls) + len(self._async_calls),
+        }
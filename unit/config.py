@@ -0,0 +1,200 @@
+import copy
+import json
+import logging
+import os
+
+from utils import init_log
+
+logger = logging.getLogger('unit-config')
+init_log(logger)
+
+#
+# The unit server's configuration: the built-in defaults below, (deep-)overridden by the JSON file
+#  named by $LAST_UNIT_SERVER_CONFIG (default: /etc/last/unit-server.json), if it exists.
+#
+default_config_file = os.path.join('/etc', 'last', 'unit-server.json')
+
+defaults = {
+    #
+    # The unit's telescopes (ids, each with a focuser and a camera of the same id) and which of them have
+    #  their equipment attached to each side's machine (lastNNe, lastNNw).  The other side's equipment is
+    #  reached through a Forwarder.
+    #
+    'topology': {
+        'telescopes': [1, 2, 3, 4],
+        'sides': {
+            'e': [1, 2],
+            'w': [3, 4],
+        },
+    },
+    #
+    # Writing the frames that reach the unit server (see image_writer.py)
+    #
+    'images': {
+        'enabled': True,
+        'folder': 'Images',     # in the daily folder
+        'workers': 2,           # writer processes
+        'queue': 4,             # frames per camera waiting to be written, beyond which the camera is held back
+        'compression': None,    # None, 'GZIP_1' or 'GZIP_2' (lossless, tiled)
+        'tile_rows': 64,
+        'level': 1,             # gzip level
+    },
+    #
+    # Quick-look numbers of the frames that reach the unit server (see quicklook.py)
+    #
+    'quicklook': {
+        'enabled': True,
+        'workers': 4,           # threads, frames computed in parallel
+        'subsample': 2,         # every n-th row and column, for the background, noise and detection
+        'tile': 64,             # background tile size, in subsampled pixels
+        'samples': 16,          # per tile row and column, for the background and noise
+        'threshold': 5,         # detection threshold, in noise units above the background
+        'max_stars': 200,       # brightest stars used for the FWHM
+        'cache': 64,            # results kept, by frame id
+    },
+    #
+    # Versioned status replies, with ETag/If-None-Match and since=<version> deltas (see versioning.py)
+    #
+    'versioned_status': {
+        'enabled': True,
+        'suffixes': ['/status', '/snapshot'],   # of the GET routes that are versioned
+        'max_removed': 1000,    # removed leaves remembered, older 'since' requests get the full reply
+        # fields (anywhere in the document, case insensitive) whose changes alone do not make a new version
+        'volatile': ['Coalescing', 'Cache', 'LastAnswerToProbe', 'RequestId', 'Timing'],
+    },
+    #
+    # Per-route timing (see profiling.py), can also be toggled at run time
+    #
+    'route_timing': False,
+    #
+    # Event-loop stall detection (see watchdog.py), in seconds
+    #
+    'loop_watchdog': {
+        'threshold': 0.1,
+        'interval': 0.05,
+    },
+    'drivers': {
+        #
+        # When set, the command (list of arguments, '{equipment}' is replaced by e.g. 'camera-1') that
+        #  runs instead of the MATLAB driver, e.g. a replay of captured traffic (see lipp-replay.py)
+        #
+        'command': None,
+        #
+        # Capturing of all the LIPP traffic (see capture.py), path None means the daily log folder
+        #
+        'capture': {
+            'enabled': False,
+            'path': None,
+        },
+        #
+        # Methods that only read device state, so that concurrent identical calls may share
+        #  a single round trip to the device (per equipment type, see Equipment)
+        #
+        'idempotent': {
+            'mount': ['status', 'info', 'RA', 'Dec', 'HA', 'Az', 'Alt', 'isTracking', 'Status'],
+            'camera': ['status', 'info', 'CamStatus', 'Temperature', 'CoolingPower', 'ExpTime', 'CameraModel',
+                       'PixelSize', 'SensorSize'],
+            'focuser': ['status', 'info', 'Pos', 'Status', 'Limits'],
+            'test': ['status', 'info'],
+        },
+        #
+        # Methods that are sent to the device right away, bypassing the queue of pending commands
+        #
+        'emergency': {
+            'mount': ['abort', 'stop'],
+            'camera': ['abort', 'stop'],
+            'focuser': ['abort', 'stop'],
+            'test': ['abort'],
+        },
+        #
+        # The device methods that the unit's own code calls on the device handles (e.g. camera.takeExposure()),
+        #  they are sent as PUTs (see registry.py)
+        #
+        'commands': {
+            'mount': ['abort', 'stop'],
+            'camera': ['abort', 'stop', 'takeExposure'],
+            'focuser': ['abort', 'stop', 'move'],
+            'test': ['abort'],
+        },
+        #
+        # The drivers' periodical probes: compact state vectors, whose fields (by schema version) are
+        #  getters that will be answered from the latest probe rather than by a LIPP request.  The
+        #  drivers are asked to probe every 'fast' seconds while the device is active (non-zero
+        #  'Activities') and every 'slow' seconds when it is idle.
+        #
+        'probe': {
+            'fast': 2,
+            'slow': 30,
+            'timeout_factor': 4,    # a driver that missed this many intervals is considered dead
+            'schemas': {
+                'mount': {
+                    '1': ['Activities', 'Errors', 'RA', 'Dec', 'HA', 'Az', 'Alt', 'isTracking'],
+                },
+                'camera': {
+                    '1': ['Activities', 'Errors', 'CamStatus', 'Temperature', 'CoolingPower'],
+                },
+                'focuser': {
+                    '1': ['Activities', 'Errors', 'Pos', 'Status'],
+                },
+            },
+        },
+        #
+        # Replacing a device's driver (a dead LIPP process, a mount that is served by the other side), see
+        #  registry.py.  In seconds.
+        #
+        'swap': {
+            'drain': 5,         # the old driver's in-flight requests may complete, the rest are retried
+            'ready': 30,        # for the new driver to come up, before it gets the requests
+            'wait': 45,         # at most, a request waits for a swap to end (unless its deadline is nearer)
+            'attempts': 3,      # per request, against successive drivers
+            'retry': 30,        # after a swap that failed to make a new driver, it is tried again
+        },
+        #
+        # Per-method time-to-live (seconds) of cached getter responses, and which cached methods are
+        #  invalidated by which commands ('*': by any command).  Setting a property always invalidates
+        #  the cached getter of the same name.
+        #
+        'cache': {
+            'mount': {
+                'ttl': {'info': 3600, 'Limits': 3600},
+                'invalidates': {},
+            },
+            'camera': {
+                'ttl': {'info': 3600, 'CameraModel': 3600, 'PixelSize': 3600, 'SensorSize': 3600, 'ExpTime': 60},
+                'invalidates': {'takeExposure': ['ExpTime']},
+            },
+            'focuser': {
+                'ttl': {'info': 3600, 'Limits': 3600},
+                'invalidates': {},
+            },
+        },
+    },
+}
+
+
+def merge(base: dict, override: dict) -> dict:
+    merged = copy.deepcopy(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load(path: str = None) -> dict:
+    if path is None:
+        path = os.environ.get('LAST_UNIT_SERVER_CONFIG', default_config_file)
+    if not os.path.exists(path):
+        return copy.deepcopy(defaults)
+    try:
+        with open(path) as f:
+            override = json.load(f)
+    except Exception as ex:
+        logger.exception(f"cannot load configuration from '{path}', using the defaults", exc_info=ex)
+        return copy.deepcopy(defaults)
+    logger.info(f"loaded configuration from '{path}'")
+    return merge(defaults, override)
+
+
+config = load()
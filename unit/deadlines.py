@@ -0,0 +1,86 @@
+import asyncio
+import time
+from contextvars import ContextVar
+
+#
+# A client may bound the time it is willing to wait for a response, by sending this header
+#  with the number of seconds.  The resulting deadline travels with the request, through the
+#  drivers and forwarders, into the LIPP messages.
+#
+timeout_header = 'X-LAST-Timeout'
+
+current_deadline = ContextVar('current_deadline', default=None)    # Optional[float], as in time.time()
+
+
+def remaining(default: float) -> float:
+    """
+    Seconds left for the current request, at most default
+    """
+    deadline = current_deadline.get()
+    if deadline is None:
+        return default
+    return max(0.0, min(default, deadline - time.time()))
+
+
+def expired() -> bool:
+    deadline = current_deadline.get()
+    return deadline is not None and time.time() >= deadline
+
+
+class DeadlineMiddleware:
+    """
+    An ASGI middleware that:
+    - sets current_deadline from the request's timeout header
+    - cancels the request's handling when the client disconnects, so that whatever it awaits
+       (e.g. a driver's reply) gets cancelled as well
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        deadline = None
+        for name, value in scope.get('headers', []):
+            if name.decode('latin-1').lower() == timeout_header.lower():
+                try:
+                    deadline = time.time() + float(value.decode('latin-1'))
+                except ValueError:
+                    pass
+                break
+        token = current_deadline.set(deadline)
+
+        messages = asyncio.Queue()
+        response_complete = False
+
+        async def app_send(message):
+            nonlocal response_complete
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                response_complete = True
+            await send(message)
+
+        app_task = asyncio.get_running_loop().create_task(self.app(scope, messages.get, app_send))
+
+        async def watch():
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message['type'] == 'http.disconnect':
+                    if not response_complete:   # don't disturb background tasks
+                        app_task.cancel()
+                    return
+
+        watcher = asyncio.get_running_loop().create_task(watch())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not app_task.cancelled():    # we were cancelled ourselves
+                app_task.cancel()
+                raise
+            if not watcher.done():
+                raise
+        finally:
+            watcher.cancel()
+            current_deadline.reset(token)
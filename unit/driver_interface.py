@@ -3,9 +3,20 @@ from utils import Equipment
 from datetime import datetime
 
 
+class BackendRetired(Exception):
+    """
+    A request that the driver did not (or will not) complete, because the driver was replaced.  The
+     request is retried against the replacement (see registry.py), so raise it only for requests that
+     were never sent to the device or that are safe to repeat (queries).  A command that was sent and
+     not answered may have been acted upon, it gets an error instead.
+    """
+    pass
+
+
 class DriverInterface(ABC):
 
     _detected: bool = False
+    retired: bool = False
 
     def __init__(self, equipment_type: Equipment, equipment_id: int = 0) -> None:
         pass
@@ -42,3 +53,15 @@ class DriverInterface(ABC):
     @abstractmethod
     def info(self) -> dict:
         pass
+
+    def wait_ready(self, timeout: float) -> bool:
+        """
+        Waits (at most timeout seconds) until the driver can take requests
+        """
+        return True
+
+    def retire(self, reason: str):
+        """
+        The driver is being replaced, it releases its resources and fails its pending requests with BackendRetired
+        """
+        self.retired = True
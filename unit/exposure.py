@@ -0,0 +1,153 @@
+import datetime
+import logging
+import threading
+import time
+from typing import List, Callable, Optional
+
+from utils import init_log, call_to_completion, response_error
+from telescope import Telescope, status_dict
+
+logger = logging.getLogger('unit-exposure')
+init_log(logger)
+
+
+def device_is_idle(device) -> bool:
+    """
+    Whether the device's 'Activities' (fed to its getter by the device's probes, see lipp.py) are none.  When we
+     cannot tell (no reply, an error) the device is not idle, the callers' timeouts deal with one that stays so.
+    """
+    reply = status_dict(call_to_completion(device.get, 'Activities'))
+    if reply is None or response_error(reply) is not None:
+        return False
+    activities = reply.get('Value')
+    return activities is not None and not activities
+
+
+class CameraExposure:
+    telescope_id: int
+    armed: bool = False
+    error: Optional[str] = None
+    triggered: float = None         # time.monotonic() just before the trigger was sent
+    acknowledged: float = None      # time.monotonic() when the trigger was acknowledged
+    completed: float = None
+
+    def __init__(self, telescope_id: int):
+        self.telescope_id = telescope_id
+
+
+class UnitExposure:
+    """
+    One exposure by all the unit's cameras, started as simultaneously as possible:
+    - Arming: each camera gets a thread of its own, which checks that the camera is ready
+    - Triggering: the armed threads are released together by a barrier, so the start-time skew
+       is reduced to the threads' wake-up jitter
+    - Completion: after the exposure time the cameras are polled until they are all idle
+    """
+    id: int
+    exptime: float
+    telescopes: List[Telescope]
+    cameras: List[CameraExposure]
+    started: datetime.datetime
+    _arm_timeout = 5            # seconds for all the cameras to get armed
+    _completion_timeout = 60    # seconds, beyond exptime, for the cameras to become idle
+    _completion_poll = 0.5
+
+    def __init__(self, id: int, exptime: float, telescopes: List[Telescope],
+                 on_error: Callable[[CameraExposure], None] = None):
+        self.id = id
+        self.on_error = on_error    # called when a triggered camera's exposure fails
+        self.exptime = exptime
+        self.telescopes = [t for t in telescopes if t is not None]
+        self.cameras = [CameraExposure(t.id) for t in self.telescopes]
+        self.done = threading.Event()
+
+    def expose_one(self, telescope: Telescope, exposure: CameraExposure, barrier: threading.Barrier):
+        try:
+            if not telescope.camera.detected or not device_is_idle(telescope.camera):
+                raise Exception(f"camera-{telescope.id} is not ready (not detected, busy or not answering)")
+            exposure.armed = True
+        except Exception as ex:
+            exposure.error = f"{ex}"
+
+        try:
+            barrier.wait(timeout=self._arm_timeout)
+        except threading.BrokenBarrierError:
+            if exposure.error is None:
+                exposure.error = f"Not all cameras got armed within {self._arm_timeout} seconds"
+            return
+        if not exposure.armed:
+            return
+
+        exposure.triggered = time.monotonic()
+        try:
+            exposure.error = response_error(call_to_completion(telescope.camera.takeExposure, ExpTime=self.exptime))
+            exposure.acknowledged = time.monotonic()
+        except Exception as ex:
+            exposure.error = f"{ex}"
+
+    def start(self) -> dict:
+        """
+        Arms and triggers all the cameras, returns once all of them acknowledged the trigger
+        """
+        if len(self.telescopes) == 0:
+            raise Exception("No telescopes to expose with")
+        self.started = datetime.datetime.now()
+        barrier = threading.Barrier(len(self.telescopes))
+        threads = [threading.Thread(name=f"unit-exposure-{self.id}-camera-{t.id}",
+                                    target=self.expose_one, args=(t, e, barrier))
+                   for t, e in zip(self.telescopes, self.cameras)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report()
+
+    def wait_for_completion(self, on_done: Callable = None):
+        """
+        Polls the triggered cameras, from the exposure end onwards, until they are all idle
+        """
+        pending = [(t, e) for t, e in zip(self.telescopes, self.cameras) if e.acknowledged is not None]
+        if pending:
+            time.sleep(max(0.0, self.exptime - (time.monotonic() - min([e.triggered for _, e in pending]))))
+        give_up = time.monotonic() + self._completion_timeout
+        while pending and time.monotonic() < give_up:
+            for t, e in list(pending):
+                try:
+                    if device_is_idle(t.camera):
+                        e.completed = time.monotonic()
+                        pending.remove((t, e))
+                except Exception as ex:
+                    logger.error(f"exposure {self.id}: camera-{t.id} status failed ({ex})")
+            if pending:
+                time.sleep(self._completion_poll)
+        for t, e in pending:
+            e.error = f"Did not become idle within {self._completion_timeout} seconds after the exposure"
+            if self.on_error is not None:
+                self.on_error(e)
+
+        self.done.set()
+        logger.info(f"exposure {self.id} done, {self.report()}")
+        if on_done is not None:
+            on_done(self)
+
+    def report(self) -> dict:
+        triggered = [e.triggered for e in self.cameras if e.triggered is not None]
+        acknowledged = [e.acknowledged for e in self.cameras if e.acknowledged is not None]
+        cameras = dict()
+        for e in self.cameras:
+            cameras[f'camera-{e.telescope_id}'] = {
+                'Armed': e.armed,
+                'TriggerOffset': (e.triggered - min(triggered)) if e.triggered is not None else None,
+                'AcknowledgeLatency': (e.acknowledged - e.triggered) if e.acknowledged is not None else None,
+                'Completed': e.completed is not None,
+                'Error': e.error,
+            }
+        return {
+            'Id': self.id,
+            'ExpTime': self.exptime,
+            'Started': self.started.isoformat(),
+            'TriggerSkew': (max(triggered) - min(triggered)) if triggered else None,
+            'AcknowledgeSkew': (max(acknowledged) - min(acknowledged)) if acknowledged else None,
+            'Done': self.done.is_set(),
+            'Cameras': cameras,
+        }
@@ -0,0 +1,148 @@
+import gzip
+import os
+import re
+import time
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+#
+# Writing FITS files.  This module is what the image writer's worker processes (see image_writer.py)
+#  import, it must not import anything of the unit server.
+#
+
+#
+# Frames are written as FITS files, either plain or (losslessly) tile-compressed, following the FITS tiled
+#  image convention (as fpack/funpack and astropy read them): the image is cut into tiles of tile_rows
+#  full rows and each tile is gzip-ed on its own, GZIP_2 first shuffles each pixel's bytes.
+#
+block_size = 2880
+compressions = ['GZIP_1', 'GZIP_2']
+
+#
+# dtype -> (BITPIX, BZERO, the offset is applied by flipping this bit)
+#
+fits_types = {
+    'uint8': (8, None, None),
+    'int16': (16, None, None),
+    'uint16': (16, 32768, 0x8000),
+    'int32': (32, None, None),
+    'uint32': (32, 2147483648, 0x80000000),
+    'float32': (-32, None, None),
+    'float64': (-64, None, None),
+}
+
+
+def card(key: str, value: object, comment: str = '') -> bytes:
+    if isinstance(value, (bool, np.bool_)):
+        text = f"{'T' if value else 'F':>20}"
+    elif isinstance(value, (int, np.integer)):
+        text = f"{value:>20d}"
+    elif isinstance(value, (float, np.floating)):
+        text = f"{value:>20.15G}"
+    else:
+        text = "'" + f"{str(value).replace(chr(39), chr(39) * 2):<8}" + "'"
+    line = f"{key:<8}= {text}" + (f" / {comment}" if comment else '')
+    return line[:80].ljust(80).encode('ascii', 'replace')
+
+
+def header(cards: List[bytes]) -> bytes:
+    data = b''.join(cards) + b'END'.ljust(80)
+    return data + b' ' * (-len(data) % block_size)
+
+
+structural_keys = re.compile(r'^(SIMPLE|BITPIX|EXTEND|BZERO|BSCALE|END|NAXIS\d*|XTENSION|PCOUNT|GCOUNT|TFIELDS|THEAP|'
+                             r'TTYPE\d+|TFORM\d+|EXTNAME|Z[A-Z0-9_-]*)$')
+
+
+def meta_cards(meta: List[Tuple[str, object]]) -> List[bytes]:
+    """
+    The frame's metadata as FITS keywords (upper-cased, cut to 8 characters), skipping the structural ones
+    """
+    cards = list()
+    seen = set()
+    for key, value in meta:
+        key = re.sub(r'[^A-Z0-9_-]', '_', key.upper())[:8]
+        if not key or key in seen or structural_keys.match(key):
+            continue
+        seen.add(key)
+        cards.append(card(key, value))
+    return cards
+
+
+def stored(data: np.ndarray) -> Tuple[np.ndarray, int, Optional[int]]:
+    """
+    The pixels as FITS stores them (big-endian, unsigned ones offset by BZERO), BITPIX and BZERO
+    """
+    if data.dtype.name not in fits_types:
+        raise Exception(f"Cannot write {data.dtype} images")
+    bitpix, bzero, flip = fits_types[data.dtype.name]
+    if flip is not None:
+        data = np.bitwise_xor(data, data.dtype.type(flip)).view(data.dtype.str.replace('u', 'i'))
+    return data.astype(data.dtype.newbyteorder('>'), copy=False), bitpix, bzero
+
+
+def compress_tile(tile: np.ndarray, compression: str, level: int) -> bytes:
+    raw = tile.tobytes()
+    if compression == 'GZIP_2' and tile.itemsize > 1:
+        raw = np.frombuffer(raw, dtype=np.uint8).reshape(-1, tile.itemsize).T.tobytes()
+    return gzip.compress(raw, compresslevel=level, mtime=0)
+
+
+def write_fits(path: str, data: np.ndarray, meta: List[Tuple[str, object]], compression: Optional[str] = None,
+               tile_rows: int = 64, level: int = 1) -> int:
+    """
+    Writes the image, atomically (a temporary file is renamed), returns the file's size
+    """
+    pixels, bitpix, bzero = stored(data)
+    height, width = data.shape
+    scaling = [card('BZERO', bzero), card('BSCALE', 1)] if bzero is not None else []
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        if compression is None:
+            f.write(header([card('SIMPLE', True), card('BITPIX', bitpix), card('NAXIS', 2), card('NAXIS1', width),
+                            card('NAXIS2', height), card('EXTEND', True)] + scaling + meta_cards(meta)))
+            f.write(pixels.tobytes())
+            size = pixels.nbytes
+        else:
+            tiles = [compress_tile(pixels[row:row + tile_rows], compression, level) for row in range(0, height, tile_rows)]
+            descriptors = np.zeros((len(tiles), 2), dtype='>i4')    # (bytes, heap offset) per tile
+            descriptors[:, 0] = [len(t) for t in tiles]
+            descriptors[1:, 1] = np.cumsum(descriptors[:-1, 0])
+            heap = sum([len(t) for t in tiles])
+
+            f.write(header([card('SIMPLE', True), card('BITPIX', 8), card('NAXIS', 0), card('EXTEND', True)]))
+            f.write(header([
+                card('XTENSION', 'BINTABLE'), card('BITPIX', 8), card('NAXIS', 2), card('NAXIS1', 8),
+                card('NAXIS2', len(tiles)), card('PCOUNT', heap), card('GCOUNT', 1), card('TFIELDS', 1),
+                card('TTYPE1', 'COMPRESSED_DATA'), card('TFORM1', f"1PB({max([len(t) for t in tiles])})"),
+                card('ZIMAGE', True), card('ZBITPIX', bitpix), card('ZNAXIS', 2), card('ZNAXIS1', width),
+                card('ZNAXIS2', height), card('ZTILE1', width), card('ZTILE2', tile_rows),
+                card('ZCMPTYPE', compression), card('EXTNAME', 'COMPRESSED_IMAGE'),
+            ] + scaling + meta_cards(meta)))
+            f.write(descriptors.tobytes())
+            for tile in tiles:
+                f.write(tile)
+            size = descriptors.nbytes + heap
+        f.write(b'\0' * (-size % block_size))
+        written = f.tell()
+    os.replace(tmp_path, path)
+    return written
+
+
+def write_shared(path: str, shm_name: str, shape: tuple, dtype: str, meta: List[Tuple[str, object]],
+                 compression: Optional[str], tile_rows: int, level: int) -> Tuple[int, float]:
+    """
+    Runs in a pool process: writes the image found in a shared memory block
+    """
+    start = time.monotonic()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        written = write_fits(path, data, meta, compression=compression, tile_rows=tile_rows, level=level)
+        del data
+    finally:
+        shm.close()
+    return written, time.monotonic() - start
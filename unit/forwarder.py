@@ -1,12 +1,18 @@
 import httpx
 import socket
 import logging
-from utils import Equipment, init_log, LAST_API_ROOT, TriState, log_matlab_exception
+from utils import Equipment, init_log, LAST_API_ROOT, TriState, log_matlab_exception, response_error
 from urllib.parse import urlencode
-from driver_interface import DriverInterface
+from driver_interface import DriverInterface, BackendRetired
 import datetime
 import json
 from fastapi.responses import JSONResponse
+from coalescing import Abandoned, SingleFlight, request_key
+from cache import ReadCache
+from config import config
+from deadlines import remaining, timeout_header
+from timing import timed
+from versioning import Replica
 
 
 class Forwarder(DriverInterface):
@@ -19,6 +25,7 @@ class Forwarder(DriverInterface):
     _reason: str = None
     _info: dict
     _responding: TriState = None
+    _timeout = 5    # seconds
 
     def __init__(self, address: str, port: int = -1, equipment: Equipment = Equipment.Undefined, equip_id: int = 0):
         DriverInterface.__init__(self, equipment_type=equipment, equipment_id=equip_id)
@@ -58,6 +65,15 @@ class Forwarder(DriverInterface):
         self._responding = False
         self._last_response = datetime.datetime.min
 
+        self.idempotent_methods = set(config['drivers']['idempotent'].get(equip_name, []))
+        self.single_flight = SingleFlight()
+        cache_policy = config['drivers']['cache'].get(equip_name, {})
+        self.cache = ReadCache(ttl=cache_policy.get('ttl'), invalidates=cache_policy.get('invalidates'))
+        self.versioned_methods = set()
+        if config['versioned_status']['enabled']:
+            self.versioned_methods = {suffix.strip('/') for suffix in config['versioned_status']['suffixes']}
+        self.replicas = dict()
+
         self.logger = logging.getLogger(f"forwarder-{equip_name}-{self.equip_id}")
         init_log(self.logger)
         self.logger.info(f"Started forwarding to {self.base_url}")
@@ -75,35 +91,90 @@ class Forwarder(DriverInterface):
         if request_type != "GET" and request_type != "PUT":
             raise(Exception(f"Bad '{request_type=}', expected either 'GET' or 'PUT'"))
 
+        key = request_key(method, kwargs)
+        cacheable = self.cache.cacheable(method, request_type)
+        if cacheable:
+            hit, response = self.cache.get(key)
+            if hit:
+                return JSONResponse(response)
+        elif request_type != 'GET':
+            self.cache.invalidate(method)
+
+        with timed('driver'):
+            if request_type == 'GET' and (method in self.idempotent_methods or cacheable):
+                try:
+                    response = await self.single_flight.do_async(key,
+                                                                 lambda: self.forward(request_type, method, **kwargs))
+                except Abandoned as ex:
+                    response = {'Error': f"{method=} to '{self.equip}' {ex}, stopped waiting for it"}
+            else:
+                response = await self.forward(request_type, method, **kwargs)
+
+        if cacheable and isinstance(response, dict) and response_error(response) is None:
+            self.cache.put(method, key, response)
+        return JSONResponse(response) if isinstance(response, dict) else response
+
+    async def forward(self, request_type: str, method: str, **kwargs) -> object:
+        """
+        One HTTP round trip to the peer unit server, returns either the decoded response or the raw content
+        """
+
+        if self.retired:
+            raise BackendRetired(f"{method=} not forwarded, the forwarder to '{self.equip}' was retired")
+
+        replica, conditional, params = None, False, kwargs
+        if request_type == 'GET' and method in self.versioned_methods:
+            # the peer answers 304, or just the changes, when we already have its status
+            replica = self.replicas.setdefault(request_key(method, kwargs), Replica())
+            conditional = bool(replica.params() or replica.headers())
+            kwargs = dict(kwargs, **replica.params())
+
         url = self.base_url + '/' + method
         if kwargs != {}:
             url += "?" + urlencode(kwargs)
+        timeout = remaining(self._timeout)
+        if timeout <= 0:
+            return {'Error': f"{method=} to '{self.equip}' past its deadline, not forwarded"}
+        headers = {timeout_header: f"{timeout:.3f}"}     # the peer's deadline is ours
+        if replica is not None:
+            headers.update(replica.headers())
         self.logger.info(f"forwarding {request_type}(url='{url}')")
         async with httpx.AsyncClient(trust_env=False) as client:  # must have trust_env=False, to ignore proxy
-            timeout = 5
             try:
                 if request_type == 'GET':
-                    response = await client.get(url, timeout=timeout, follow_redirects=False)
+                    response = await client.get(url, timeout=timeout, headers=headers, follow_redirects=False)
                 else:
-                    response = await client.put(url, timeout=timeout, follow_redirects=False)
-                response.raise_for_status()
+                    response = await client.put(url, timeout=timeout, headers=headers, follow_redirects=False)
+                if replica is None or response.status_code != 304:
+                    response.raise_for_status()
                 self._detected = True
             except Exception as ex:
                 self._detected = False
                 self.logger.error(f"HTTP error ({ex.args[0]})")
-                return JSONResponse({'Error': ex.args[0]})
-
-            if response.is_success:
+                return {'Error': ex.args[0]}
+
+            if replica is not None:
+                remote_response = replica.update(response.status_code, response.headers.get('ETag'),
+                                                 response.content)
+                if remote_response is None and conditional:
+                    # e.g. a 304 for a status we no longer have, or changes since another version: the replica
+                    #  was reset, ask for all of it
+                    return await self.forward(request_type, method, **params)
+            elif response.is_success:
                 remote_response = json.loads(response.content)
+            else:
+                return None
+
+            if isinstance(remote_response, dict):
                 if 'Exception' in remote_response:
                     log_matlab_exception(self.logger, remote_response['Exception'])
-                    return JSONResponse(remote_response)
+                    return remote_response
                 elif 'Error' in remote_response:
                     self.logger.error(remote_response['Error'])
-                    return JSONResponse(remote_response)
+                    return remote_response
                 elif 'Value' in remote_response:
-                    return JSONResponse(remote_response)
-                return response.content
+                    return remote_response
+            return response.content
 
     def info(self):
         return self._info
@@ -112,6 +183,8 @@ class Forwarder(DriverInterface):
         return {
             'responding': self._responding,
             'last_response': self._last_response,
+            'coalescing': self.single_flight.stats(),
+            'cache': self.cache.stats(),
         }
     
     @property
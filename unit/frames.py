@@ -0,0 +1,144 @@
+import datetime
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from fastapi import APIRouter, Request
+
+from utils import LAST_API_ROOT, init_log, jsonResponse
+from image_writer import image_writer
+
+logger = logging.getLogger('unit-frames')
+init_log(logger)
+
+frames_router = APIRouter()
+
+
+class Frame:
+    """
+    A camera frame that reached the unit server, kept in memory
+    """
+    id: str
+    camera_id: int
+    seq: int
+    data: np.ndarray
+    received: datetime.datetime
+    meta: dict
+    path: Optional[str] = None      # where it is (being) written
+
+    def __init__(self, camera_id: int, seq: int, data: np.ndarray, meta: dict = None):
+        self.camera_id = camera_id
+        self.seq = seq
+        self.id = f"camera-{camera_id}-{seq}"
+        self.data = data
+        self.received = datetime.datetime.now()
+        self.meta = meta if meta is not None else dict()
+
+    def info(self) -> dict:
+        return {
+            'Id': self.id,
+            'Camera': self.camera_id,
+            'Seq': self.seq,
+            'Shape': list(self.data.shape),
+            'Dtype': str(self.data.dtype),
+            'Received': self.received.isoformat(),
+            'Meta': self.meta,
+            'Path': self.path,
+        }
+
+
+class FrameStore:
+    """
+    Keeps the latest frame of each camera and lets consumers either wait for, or subscribe to, new frames
+    """
+    _latest: Dict[int, Frame]
+    _seq: Dict[int, int]
+    _subscribers: List[Callable]
+
+    def __init__(self):
+        self._latest = dict()
+        self._seq = dict()
+        self._subscribers = list()
+        self._condition = threading.Condition()
+
+    def put(self, camera_id: int, data: np.ndarray, meta: dict = None) -> Frame:
+        with self._condition:
+            seq = self._seq.get(camera_id, 0) + 1
+            self._seq[camera_id] = seq
+            frame = Frame(camera_id=camera_id, seq=seq, data=data, meta=meta)
+            self._latest[camera_id] = frame
+            self._condition.notify_all()
+
+        for callback in list(self._subscribers):
+            try:
+                callback(frame)
+            except Exception as ex:
+                logger.exception(f"frame subscriber {callback} failed", exc_info=ex)
+        return frame
+
+    def latest(self, camera_id: int) -> Optional[Frame]:
+        return self._latest.get(camera_id)
+
+    def camera_ids(self) -> List[int]:
+        return sorted(self._latest.keys())
+
+    def last_seq(self, camera_id: int) -> int:
+        return self._seq.get(camera_id, 0)
+
+    def wait_for_frame(self, camera_id: int, after_seq: int, timeout: float,
+                       failed: Callable[[], bool] = None) -> Optional[Frame]:
+        """
+        Waits for a frame newer than after_seq from the specified camera, None on timeout or as soon as
+         failed() (e.g. the camera's exposure failed) is True, it is checked upon wake()
+        """
+        def arrived() -> bool:
+            return self._seq.get(camera_id, 0) > after_seq
+
+        with self._condition:
+            self._condition.wait_for(lambda: arrived() or (failed is not None and failed()), timeout=timeout)
+            if arrived():
+                return self._latest[camera_id]
+        return None
+
+    def wake(self):
+        """
+        Has the frame waiters check whether they should give up
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+    def subscribe(self, callback: Callable) -> Callable:
+        """
+        Calls callback(frame) for every new frame, returns a function that unsubscribes
+        """
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback) if callback in self._subscribers else None
+
+
+frame_store = FrameStore()
+
+
+# Method 'frames' (ingest)
+@frames_router.put(LAST_API_ROOT + 'unit/frames/{camera_id}', tags=["unit"])
+async def unit_put_frame(camera_id: int, width: int, height: int, request: Request, dtype: str = 'uint16'):
+    """
+    Receives a raw (row-major) frame from a camera driver
+    """
+    body = await request.body()
+    try:
+        data = np.frombuffer(body, dtype=np.dtype(dtype)).reshape((height, width))
+    except (TypeError, ValueError) as ex:
+        return jsonResponse({"Error": f"Bad frame ({len(body)} bytes, {width=}, {height=}, {dtype=}): {ex}"})
+    frame = frame_store.put(camera_id, data, meta=dict(request.query_params))
+    if image_writer.enabled:
+        frame.path = await image_writer.submit(frame)     # waits while the disk is behind
+    return jsonResponse({"Value": frame.info()})
+
+
+@frames_router.get(LAST_API_ROOT + 'unit/frames/{camera_id}', tags=["unit"])
+async def unit_get_frame_info(camera_id: int):
+    frame = frame_store.latest(camera_id)
+    if frame is None:
+        return jsonResponse({"Error": f"No frame from camera-{camera_id}"})
+    return jsonResponse({"Value": frame.info()})
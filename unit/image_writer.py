@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+from fastapi import APIRouter
+
+from utils import LAST_API_ROOT, init_log, jsonResponse, path_maker
+from config import config
+from fits import compressions, write_shared
+
+logger = logging.getLogger('unit-image-writer')
+init_log(logger)
+
+images_router = APIRouter()
+
+
+class WriteJob:
+    def __init__(self, frame, path: str):
+        self.frame = frame
+        self.path = path
+        self.queued = time.monotonic()
+
+
+class CameraLane:
+    """
+    One camera's frames, written one at a time and in order
+    """
+    queue: asyncio.Queue
+    task: asyncio.Task = None
+    writing: bool = False
+
+    def __init__(self, max_queue: int):
+        self.queue = asyncio.Queue(maxsize=max_queue)
+
+
+class ImageWriter:
+    """
+    Writes the frames that reach the unit server to disk, off the request path:
+    - each camera has a bounded queue, its frames are written in order, the cameras in parallel (a process pool)
+    - when a camera's queue is full, submit() waits (and the camera's frame upload with it)
+    - the file names come from the path maker: <daily>/<folder>/camera-<id>/camera-<id>-<seq>.fits[.fz]
+    """
+    enabled: bool
+    lanes: Dict[int, CameraLane]
+    pool: Optional[ProcessPoolExecutor] = None
+    recent: Deque[Tuple[float, int, int]]   # (when, file bytes, image bytes) of the recent writes
+    written: int = 0
+    errors: int = 0
+    written_bytes: int = 0
+    image_bytes: int = 0
+    write_seconds: float = 0
+    max_write_seconds: float = 0
+    backpressure_waits: int = 0
+    backpressure_seconds: float = 0
+
+    def __init__(self, policy: dict):
+        self.enabled = policy['enabled']
+        self.folder = policy['folder']
+        self.workers = policy['workers']
+        self.max_queue = policy['queue']
+        self.compression = policy['compression']
+        if self.compression is not None and self.compression not in compressions:
+            raise Exception(f"Bad image compression '{self.compression}', should be one of {compressions}")
+        self.tile_rows = policy['tile_rows']
+        self.level = policy['level']
+        self.lanes = dict()
+        self.recent = deque(maxlen=1000)
+
+    def start(self):
+        """
+        Called on the event loop.  The pool's processes are spawned (not forked: they must not inherit the
+         drivers' sockets, nor locks held by other threads) when the first frames are submitted.  They
+         import only the fits module and run write_shared().
+        """
+        if self.enabled and self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    async def stop(self, timeout: float = 30):
+        """
+        Waits (up to timeout) for the queued frames to be written
+        """
+        lanes = list(self.lanes.values())
+        if lanes:
+            try:
+                await asyncio.wait_for(asyncio.gather(*[lane.queue.join() for lane in lanes]), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"{sum([lane.queue.qsize() for lane in lanes])} frames were not written within {timeout} seconds")
+        for lane in lanes:
+            if lane.task is not None:
+                lane.task.cancel()
+        self.lanes = dict()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    def lane(self, camera_id: int) -> CameraLane:
+        lane = self.lanes.get(camera_id)
+        if lane is None:
+            lane = CameraLane(self.max_queue)
+            lane.task = asyncio.get_running_loop().create_task(self.drain(lane))
+            self.lanes[camera_id] = lane
+        return lane
+
+    async def submit(self, frame) -> str:
+        """
+        Queues a frame for writing, returns its path.  Waits while the camera's queue is full.
+        """
+        self.start()
+        lane = self.lane(frame.camera_id)
+        suffix = '.fits' if self.compression is None else '.fits.fz'
+        path = path_maker.make_file_name(folder=os.path.join(self.folder, f"camera-{frame.camera_id}"),
+                                         prefix=f"camera-{frame.camera_id}", suffix=suffix)
+        job = WriteJob(frame, path)
+        if lane.queue.full():
+            self.backpressure_waits += 1
+            start = time.monotonic()
+            await lane.queue.put(job)
+            self.backpressure_seconds += time.monotonic() - start
+        else:
+            lane.queue.put_nowait(job)
+        return path
+
+    async def drain(self, lane: CameraLane):
+        while True:
+            job = await lane.queue.get()
+            lane.writing = True
+            try:
+                await self.write(job)
+            finally:
+                lane.writing = False
+                lane.queue.task_done()
+
+    async def write(self, job: WriteJob):
+        loop = asyncio.get_running_loop()
+        frame = job.frame
+        data = frame.data
+        meta = [('CAMERA', frame.camera_id), ('FRAMESEQ', frame.seq), ('RECEIVED', frame.received.isoformat())] + \
+            [(key, value) for key, value in frame.meta.items()]
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        try:
+            shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+            await loop.run_in_executor(None, np.copyto, shared, data)     # a large copy, off the loop
+            del shared
+            written, seconds = await loop.run_in_executor(
+                self.pool, write_shared, job.path, shm.name, data.shape, data.dtype.str, meta,
+                self.compression, self.tile_rows, self.level)
+        except Exception as ex:
+            self.errors += 1
+            logger.exception(f"could not write frame {frame.id} to '{job.path}'", exc_info=ex)
+            return
+        finally:
+            shm.close()
+            shm.unlink()
+
+        self.written += 1
+        self.written_bytes += written
+        self.image_bytes += data.nbytes
+        self.write_seconds += seconds
+        self.max_write_seconds = max(self.max_write_seconds, seconds)
+        self.recent.append((time.monotonic(), written, data.nbytes))
+        logger.debug(f"wrote frame {frame.id} to '{job.path}' ({written} bytes, {seconds:.3f} sec, "
+                     f"{time.monotonic() - job.queued:.3f} sec after it was queued)")
+
+    def stats(self, window: float = 10) -> dict:
+        since = time.monotonic() - window
+        recent = [(written, image) for when, written, image in self.recent if when >= since]
+        return {
+            'Enabled': self.enabled,
+            'Compression': self.compression,
+            'QueueDepth': {f"camera-{camera_id}": lane.queue.qsize() + (1 if lane.writing else 0)
+                           for camera_id, lane in self.lanes.items()},
+            'Written': self.written,
+            'Errors': self.errors,
+            'WrittenMB': self.written_bytes / 1e6,
+            'MBps': sum([written for written, _ in recent]) / 1e6 / window,
+            'ImageMBps': sum([image for _, image in recent]) / 1e6 / window,
+            'CompressionRatio': self.image_bytes / self.written_bytes if self.written_bytes else None,
+            'MeanWriteSeconds': self.write_seconds / self.written if self.written else None,
+            'MaxWriteSeconds': self.max_write_seconds,
+            'Backpressure': {
+                'Waits': self.backpressure_waits,
+                'Seconds': self.backpressure_seconds,
+            },
+        }
+
+
+image_writer = ImageWriter(config['images'])
+
+
+# Method 'images'
+@images_router.get(LAST_API_ROOT + 'unit/images', tags=["unit"])
+async def unit_images():
+    """
+    The image writer's queues and throughput (MB/s over the last 10 seconds)
+    """
+    return jsonResponse({"Value": image_writer.stats()})
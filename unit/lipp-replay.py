@@ -0,0 +1,241 @@
+"""
+Replays captured LIPP traffic (see capture.py), for performance regression checks:
+
+  summary - what a capture contains
+  serve   - plays the MATLAB driver of one equipment: sends its 'ready' packet and probes, and answers each
+             request with a recorded reply, after the recorded service time.  The unit server runs it
+             instead of MATLAB when configured with:
+               "drivers": {"command": ["python3", "<path>/lipp-replay.py", "serve", "--capture", "<file>",
+                                       "--equipment", "{equipment}", "--speed", "<speed>"]}
+  load    - issues the captured requests to a unit server, over HTTP, with the captured timing (divided
+             by speed), and reports latency and throughput
+"""
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Tuple
+from urllib.parse import urlencode
+
+import httpx
+import numpy as np
+
+from capture import Kind, CaptureRecord, read_capture
+from utils import init_log, LAST_API_ROOT
+
+logger = logging.getLogger('lipp-replay')
+init_log(logger)
+
+
+def parameters_key(parameters: dict) -> str:
+    return json.dumps(parameters or {}, sort_keys=True, default=str)
+
+
+def exchanges(records: List[CaptureRecord]) -> List[Tuple[CaptureRecord, dict, CaptureRecord, dict]]:
+    """
+    Pairs the captured requests with their replies (by equipment and RequestId), unanswered ones are left out
+    """
+    requests = dict()
+    pairs = list()
+    for record in records:
+        if record.kind not in (Kind.Request, Kind.Reply):
+            continue
+        try:
+            packet = json.loads(record.data)
+        except ValueError:
+            continue
+        key = (record.equipment, packet.get('RequestId'))
+        if record.kind == Kind.Request:
+            requests[key] = (record, packet)
+        elif key in requests:
+            request_record, request = requests.pop(key)
+            pairs.append((request_record, request, record, packet))
+    return pairs
+
+
+def percentiles(latencies: List[float]) -> dict:
+    if not latencies:
+        return {}
+    values = np.array(latencies) * 1000
+    return {
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+    }
+
+
+def summary(path: str):
+    records = list(read_capture(path))
+    counts = defaultdict(lambda: defaultdict(int))
+    for record in records:
+        counts[record.equipment][record.kind.name] += 1
+    pairs = exchanges(records)
+    print(json.dumps({
+        'Records': len(records),
+        'Duration': (records[-1].timestamp - records[0].timestamp) if records else 0,
+        'Equipment': {equipment: dict(kinds) for equipment, kinds in counts.items()},
+        'CapturedLatency(ms)': percentiles([reply.timestamp - request.timestamp for request, _, reply, _ in pairs]),
+    }, indent=4))
+
+
+class ReplayDriver:
+    """
+    Plays the part of the MATLAB driver of one equipment
+    """
+    replies: Dict[Tuple[str, str], Deque[Tuple[float, dict]]]
+    by_method: Dict[str, Deque[Tuple[float, dict]]]
+
+    def __init__(self, path: str, equipment: str, speed: float):
+        self.equipment = equipment
+        self.speed = speed
+        records = [r for r in read_capture(path) if r.equipment == equipment]
+        self.probes = [r for r in records if r.kind == Kind.Probe]
+        ready = [r for r in records if r.kind == Kind.Ready]
+        self.ready = ready[0].data if ready else json.dumps({'RequestId': 0, 'Value': 'detected'}).encode()
+
+        self.replies = defaultdict(deque)
+        self.by_method = defaultdict(deque)
+        for request_record, request, reply_record, reply in exchanges(records):
+            entry = (reply_record.timestamp - request_record.timestamp, reply)
+            self.replies[(request.get('Method'), parameters_key(request.get('Parameters')))].append(entry)
+            self.by_method[request.get('Method')].append(entry)
+
+        self.local_socket_path = f'\0lipp-driver-{equipment}'
+        self.peer_socket_path = f'\0lipp-unit-{equipment}'
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.local_socket_path)
+
+    def reply_for(self, method: str, parameters: dict) -> Tuple[float, dict]:
+        """
+        The recorded replies to the same request are used round-robin, then the ones to the same method
+        """
+        for entries in (self.replies.get((method, parameters_key(parameters))), self.by_method.get(method)):
+            if entries:
+                entries.rotate(-1)
+                return entries[-1]
+        return 0, {'Value': None}
+
+    def play_probes(self):
+        if not self.probes:
+            return
+        prober = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        start, first = time.monotonic(), self.probes[0].timestamp
+        for probe in self.probes:
+            delay = (probe.timestamp - first) / self.speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                prober.sendto(probe.data, self.peer_socket_path + '-probing')
+            except OSError:
+                pass
+
+    def serve(self):
+        self.socket.sendto(self.ready, self.peer_socket_path)
+        threading.Thread(name='replay-prober-thread', target=self.play_probes, daemon=True).start()
+
+        while True:     # one request at a time, as the MATLAB loop does
+            data, address = self.socket.recvfrom(64 * 1024)
+            request = json.loads(data)
+            method = request.get('Method')
+            if method == 'quit':
+                return
+            if method in ('cancel', 'setProbeInterval'):
+                service_time, reply = 0, {'Value': None}
+            else:
+                service_time, reply = self.reply_for(method, request.get('Parameters'))
+            if service_time > 0:
+                time.sleep(service_time / self.speed)
+            reply = dict(reply)
+            reply['RequestId'] = request.get('RequestId')
+            self.socket.sendto(json.dumps(reply).encode(), self.peer_socket_path)
+
+
+def equipment_path(equipment: str) -> str:
+    """
+    'camera-1' -> 'camera/1', 'mount' -> 'mount/0', as the Forwarder addresses them
+    """
+    name, _, equipment_id = equipment.partition('-')
+    return f"{name}/{equipment_id or 0}"
+
+
+async def load(path: str, url: str, speed: float, equipment: List[str] = None):
+    pairs = [pair for pair in exchanges(list(read_capture(path))) if not equipment or pair[0].equipment in equipment]
+    requests = [(record, request) for record, request, _, _ in pairs]
+    captured = [reply_record.timestamp - record.timestamp for record, _, reply_record, _ in pairs]
+    if not requests:
+        print("No (answered) requests in capture")
+        return
+
+    latencies, errors = list(), 0
+    first = requests[0][0].timestamp
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+
+    async with httpx.AsyncClient(trust_env=False, limits=limits, timeout=30) as client:
+        async def issue(record: CaptureRecord, request: dict):
+            nonlocal errors
+            query = urlencode(request.get('Parameters') or {})
+            request_url = f"{url}{LAST_API_ROOT}{equipment_path(record.equipment)}/{request.get('Method')}"
+            if query:
+                request_url += '?' + query
+            start = time.monotonic()
+            try:
+                response = await client.get(request_url)
+                if not response.is_success or 'Error' in response.json():
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.monotonic() - start)
+
+        start = time.monotonic()
+        tasks = list()
+        for record, request in requests:
+            delay = (record.timestamp - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.get_running_loop().create_task(issue(record, request)))
+        await asyncio.gather(*tasks)
+        duration = time.monotonic() - start
+
+    print(json.dumps({
+        'Requests': len(requests),
+        'Errors': errors,
+        'Speed': speed,
+        'Duration': duration,
+        'Throughput(req/s)': len(requests) / duration if duration > 0 else None,
+        'Latency(ms)': percentiles(latencies),
+        'CapturedLatency(ms)': percentiles(captured),
+    }, indent=4))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays captured LIPP traffic')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    summary_parser = subparsers.add_parser('summary')
+    summary_parser.add_argument('--capture', '-c', required=True)
+
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--capture', '-c', required=True)
+    serve_parser.add_argument('--equipment', '-e', required=True, help="e.g. 'camera-1'")
+    serve_parser.add_argument('--speed', '-s', type=float, default=1.0)
+
+    load_parser = subparsers.add_parser('load')
+    load_parser.add_argument('--capture', '-c', required=True)
+    load_parser.add_argument('--url', '-u', default='http://127.0.0.1:8000')
+    load_parser.add_argument('--speed', '-s', type=float, default=1.0)
+    load_parser.add_argument('--equipment', '-e', action='append', help="only this equipment (may be repeated)")
+
+    args = parser.parse_args()
+    if args.command == 'summary':
+        summary(args.capture)
+    elif args.command == 'serve':
+        ReplayDriver(args.capture, args.equipment, args.speed).serve()
+    elif args.command == 'load':
+        asyncio.run(load(args.capture, args.url, args.speed, args.equipment))
+    sys.exit(0)
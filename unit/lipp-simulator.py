@@ -1,6 +1,6 @@
 import datetime
 
-from utils import Equipment, equipment_ids, init_log, DateTimeEncoder, datetime_decoder
+from utils import Equipment, init_log, DateTimeEncoder, datetime_decoder
 import socket
 from collections import OrderedDict
 import json
@@ -53,6 +53,7 @@ class Simulator:
             for key, value in d['Parameters'].items():
                 incoming.Parameters[key] = value
         incoming.RequestTime = d['RequestTime']
+        incoming.Deadline = d.get('Deadline')
         incoming.RequestReceived = datetime.datetime.now()
 
         return incoming
@@ -86,6 +87,13 @@ if __name__ == '__main__':
         response.RequestId = request.RequestId
         response.Timing['Request']['Received'] = request.RequestReceived
         response.Timing['Request']['Sent'] = request.RequestTime
+        if request.Deadline is not None and datetime.datetime.now() > request.Deadline:
+            response.Response = None
+            response.Error = f"dropped {request.Method}(), past its deadline"
+            simulator.send(response)
+            continue
+        if request.Method == 'cancel':
+            continue    # requests are handled one at a time, nothing left to cancel
         response.Response = f'dummy response to {request.Method}('
         if 'Parameters' in request.__dict__ and request.Parameters is not None and len(request.Parameters) > 0:
             for k, v in request.Parameters.items():
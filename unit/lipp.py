@@ -1,6 +1,6 @@
 import datetime
 
-from utils import Equipment, equipment_ids, init_log, datetime_decoder, DateTimeEncoder, TriState, Never
+from utils import Equipment, init_log, datetime_decoder, DateTimeEncoder, TriState, Never, response_error
 import socket
 from collections import OrderedDict
 import json
@@ -8,16 +8,29 @@ import logging
 from subprocess import Popen
 from enum import Enum
 import humanize
-from driver_interface import DriverInterface
+from driver_interface import DriverInterface, BackendRetired
 import threading
 from fastapi.responses import JSONResponse
 import time
 import asyncio
 import os
 import signal
-from typing import List
+import contextvars
+import functools
+from collections import deque
+from typing import Deque, Dict, List, Optional
 from forwarder import Forwarder
 from utils import default_port
+from reactor import reactor, TimerHandle
+from registry import registry, DeviceHandle
+from coalescing import Abandoned, Call, Flight, SingleFlight, request_key
+from cache import ReadCache
+from scheduler import CommandScheduler, Priority
+from config import config
+from deadlines import current_deadline
+from telemetry import telemetry
+from capture import capture, Kind
+import timing
 
 
 class ReadyMode(Enum):
@@ -37,6 +50,7 @@ class Request:
     Parameters: OrderedDict
     RequestTime: datetime.datetime
     RequestReceived: datetime.datetime
+    Deadline: Optional[datetime.datetime]   # the driver may drop the request after this time
 
 
 class Response:
@@ -46,6 +60,26 @@ class Response:
     Exception: str = None
     Timing: {}
 
+
+class PendingReply:
+    """
+    A request sent to the driver, waiting for the reply with its RequestId
+    """
+    request: Request
+    response: dict = None
+    failed: bool = False    # resolved by fail_pending(), not by a reply
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.event = threading.Event()
+
+    def resolve(self, response: dict):
+        self.response = response
+        self.event.set()
+
+
+current_call = contextvars.ContextVar('current_call', default=None)     # Optional[Call]
+
 logger: logging.Logger = logging.getLogger('lipp')
 init_log(logger)
 
@@ -72,29 +106,47 @@ class Driver(DriverInterface):
     _responding: TriState = None
     _last_response: datetime.datetime = Never
     _receive_timeout = 5    # seconds
+    _queue_timeout = 10     # seconds, how long a command may wait for its turn
+    _send_timeout = 1       # seconds, bounds the time to hand a command to the driver
     _ready_timeout = 30     # be patient, matlab needs to come up
-    _probe_timeout = 120    # regular probes should arrive every 30 seconds
-    _waiter_for_ready_thread: threading.Thread
-    _process_monitor_thread: threading.Thread
-    _probing_monitor_thread: threading.Thread
+    _probe_timeout = 120    # regular probes should arrive every 30 seconds, versioned ones announce their interval
+    _probe_timer: TimerHandle = None
+    _probe: dict = None                 # the latest probed state vector (versioned probes)
+    _probe_seq: int = None
+    _probes_missed: int = 0
+    _probe_interval: float = None       # as announced by the driver
+    _requested_probe_interval: float = None
+    _waiting_for_ready = False
+    _socket_registered = False
     _terminating = False
 
     _last_answer_to_probe: datetime.datetime = None
     _answers_to_probe: TriState = None
 
-    lock: threading.Lock
+    scheduler: CommandScheduler
+    _pending: Dict[int, PendingReply]
+    _abandoned: Deque[int]          # requests we stopped waiting for, their replies are expected late
+    _notices: Deque[int]            # requests sent without waiting for their replies
     driver_process_should_be_restarted: bool = False
+    handle: DeviceHandle
 
     def __init__(self, drivers: list, equipment: Equipment, equipment_id: int = 0):
         super().__init__(equipment, equipment_id)
 
+        #
+        # The list gets the device's (stable) handle, this driver is installed in it, either now or, when
+        #  it replaces a previous driver, by the swap
+        #
         self.drivers = drivers
         self.equipment_id = equipment_id
-        self.drivers[equipment_id] = self
+        self.handle = registry.register(equipment, equipment_id, backend=self,
+                                        make=functools.partial(Driver, drivers, equipment, equipment_id))
+        self.drivers[equipment_id] = self.handle
+        self._ready = threading.Event()
 
         self.equipment_type = equipment
         self.equipment_type_and_id = self.equipment_type.name.lower()
-        if equipment_id in range(1, 5):
+        if equipment_id != 0:
             self.equipment_id = equipment_id
             self.equipment_type_and_id += f'-{self.equipment_id}'
             
@@ -103,9 +155,9 @@ class Driver(DriverInterface):
 
         hostname = socket.gethostname()
         if hostname.endswith('e'):
-            valid_ids = equipment_ids['e']
+            valid_ids = config['topology']['sides']['e']
         elif hostname.endswith('w'):
-            valid_ids = equipment_ids['w']
+            valid_ids = config['topology']['sides']['w']
         else:
             raise Exception("Invalid hostname '{hostname}'")
 
@@ -122,54 +174,78 @@ class Driver(DriverInterface):
 
         # A socket used for communications with the MATLAB Lipp
         self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.socket.settimeout(self._ready_timeout)
+        self.socket.settimeout(self._send_timeout)
         self.socket.bind(self.local_socket_path)
         self.current_request_id = 0
+        self._pending = dict()
+        self._pending_lock = threading.Lock()
+        self._abandoned = deque(maxlen=100)
+        self._notices = deque(maxlen=100)
+        self.scheduler = CommandScheduler()
 
         # A socket to receive the results of periodical device probes
         self.probing_socket_path = self.local_socket_path + '-probing'
         self.probing_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.probing_socket.settimeout(self._probe_timeout)
+        self.probing_socket.setblocking(False)
         self.probing_socket.bind(self.probing_socket_path)
+        reactor.add_reader(self.probing_socket, self.on_probing_readable)
 
         matlab_sentence = "obs.api.Lipp('EquipmentName', " + f"'{equipment.name.lower()}'"
         if equipment_id != 0:
             matlab_sentence += f", 'EquipmentId', {equipment_id}"
         matlab_sentence += ').loop()'
         self.cmd = ['/usr/local/bin/matlab', '-batch', matlab_sentence]
-        self.start_driver_process(reason='first-time')
+        if config['drivers']['command']:    # e.g. a replay of captured traffic
+            self.cmd = [arg.format(equipment=self.equipment_type_and_id) for arg in config['drivers']['command']]
 
-        self.lock = threading.Lock()
+        self.idempotent_methods = set(config['drivers']['idempotent'].get(equipment.name.lower(), []))
+        self.single_flight = SingleFlight()
+        cache_policy = config['drivers']['cache'].get(equipment.name.lower(), {})
+        self.cache = ReadCache(ttl=cache_policy.get('ttl'), invalidates=cache_policy.get('invalidates'))
+        self.emergency_methods = set(config['drivers']['emergency'].get(equipment.name.lower(), []))
+        self.probe_policy = config['drivers']['probe']
+        self.probe_schemas = self.probe_policy['schemas'].get(equipment.name.lower(), {})
+
+        self.start_driver_process(reason='first-time')
 
     def start_driver_process(self, reason: str):
         env = os.environ.copy()
         env['FROM_PYTHON_LIPP'] = '1'
         env['LANG'] = 'en_US'
         self.logger.info(f">>> Starting driver process, {reason=}, {self.cmd=}")
+        self.cache.clear()  # a new process may see different hardware
         self.driver_process = Popen(args=self.cmd, env=env)
         self.driver_process_should_be_restarted = True
 
         self._responding = False
         self._last_response = Never
-        
-        self._waiter_for_ready_thread = threading.Thread(
-            name=f"{self.equipment_type_and_id + '-wait-for-ready-thread'}",
-            target=self.wait_for_ready)
-        self._waiter_for_ready_thread.start()
-
-        self._process_monitor_thread = threading.Thread(
-            name=f"{self.equipment_type_and_id + '-monitor-driver-process-thread'}",
-            target=self.monitor_driver_process)
-        self._process_monitor_thread.start()
-
-        self._probing_monitor_thread = threading.Thread(
-            name=f"{self.equipment_type_and_id + '-monitor-device-probing-thread'}",
-            target=self.monitor_device_probing)
-        self._probing_monitor_thread.start()
+        self._terminating = False
+        self.reset_probing()
+
+        #
+        # No threads of our own: the shared reactor waits for the 'ready' packet, the replies, the probes
+        #  and the process exit, on behalf of all the drivers
+        #
+        self._waiting_for_ready = True
+        self.logger.info("waiting for ready")
+        reactor.add_reader(self.socket, self.on_socket_readable)
+        self._socket_registered = True
+        reactor.watch_process(self.driver_process, self.on_driver_process_exit)
+        self.arm_probe_timer()
 
     def end_driver_process(self, reason: str):
-        self._terminating = True  # tells threads to die
+        self._terminating = True  # tells the reactor callbacks to ignore this driver
         self.driver_process_should_be_restarted = False
+        self._waiting_for_ready = False
+        if self._socket_registered:
+            self._socket_registered = False
+            reactor.remove_reader(self.socket)
+        self.fail_pending(f"driver process ended ({reason})")
+        if self._probe_timer is not None:
+            self._probe_timer.cancel()
+            self._probe_timer = None
+        if self.driver_process:
+            reactor.unwatch_process(self.driver_process)
         if self.driver_process and self.driver_process.poll() is None:
             self.logger.info(f">>> Terminating driver process (pid={self.driver_process.pid}), reason='{reason}'")
             self.driver_process.terminate()
@@ -181,148 +257,409 @@ class Driver(DriverInterface):
         self.end_driver_process(reason=reason)
         self.start_driver_process(reason=reason)
 
-    def monitor_driver_process(self):
+    def on_driver_process_exit(self, rc: int):
         """
-        Monitors the LIPP (MATLAB) process for this driver
+        Called by the reactor when the LIPP (MATLAB) process for this driver exits
         - Idea: maybe it will restart dead processes using self.cmd (frequent restart handling ?!?)
         """
-        rc = self.driver_process.wait()
         if self.driver_process_should_be_restarted:  # if it died somehow, not because we ended it
             reason = f"Process exited with {rc=}"
             self.logger.info(f">>> Starting driver process {reason=}")
+            self.end_driver_process(reason=reason)
             self.start_driver_process(reason=reason)
 
-    def monitor_device_probing(self):
+    def reset_probing(self):
+        self._probe = None
+        self._probe_seq = None
+        self._probe_interval = None
+        self._requested_probe_interval = None
+        self._probe_timeout = Driver._probe_timeout
+
+    def arm_probe_timer(self):
+        if self._probe_timer is not None:
+            self._probe_timer.cancel()
+        self._probe_timer = reactor.call_later(self._probe_timeout, self.on_probe_timeout)
+
+    def on_probe_timeout(self):
+        self._probe_timer = None
+        if self._terminating:
+            return
+        if self._detected:
+            self.logger.error(f"Detected and no probe() within {self._probe_timeout} sec.  Replacing!")
+            # the swap waits for the process to die and for the new one, keep it off the reactor thread
+            threading.Thread(name=f"{self.equipment_type_and_id}-swap-thread", target=self.handle.restart,
+                             args=(f"no probe within {self._probe_timeout} seconds",)).start()
+        else:
+            self.arm_probe_timer()
+
+    def on_probing_readable(self, sock):
         while not self._terminating:
-            self.receive_probing()  # blocking
+            try:
+                data, address = self.probing_socket.recvfrom(self._max_bytes)
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception as ex:
+                self.logger.exception(f"While recvfrom probing_socket", exc_info=ex)
+                return
+            self.receive_probing(data, address)
+
+    def on_socket_readable(self, sock):
+        """
+        Called by the reactor for each datagram on the main socket: first the 'ready' packet, then the replies
+        """
+        if self._terminating:
+            return
+        try:
+            data, address = self.socket.recvfrom(self._max_bytes)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return
+        except Exception as ex:
+            self.logger.exception(f"While recvfrom on main socket", exc_info=ex)
+            return
+
+        if self._waiting_for_ready:
+            capture.record(Kind.Ready, self.equipment_type_and_id, data)
+            self.receive_ready(data)
+        else:
+            capture.record(Kind.Reply, self.equipment_type_and_id, data)
+            self.receive_reply(data, address)
 
-    def wait_for_ready(self):
+    def receive_ready(self, data: bytes):
         """
-        Waits for a 'ready' packet on the main socket.  This packet will (eventually) arrive when the
+        Handles the 'ready' packet on the main socket.  This packet will (eventually) arrive when the
          spawned MATLAB process comes-to-life and tries a "Connected = true" on the underlying driver.
 
         The reply is either 'detected' or 'not-detected' according to whether the driver found its configured hardware.
         """
-        self.logger.info("started")
-        while not self._terminating:
-            incoming_packet = self.receive_from_driver()  # on timeout returns a None incoming_packet
-
-            if incoming_packet is not None:
-                self._responding = True
-                self.socket.settimeout(self._receive_timeout)  # from now on responses should come faster
-
-                if 'Value' in incoming_packet:
-                    # it may have been an 'Error' or 'Exception' packet
-                    if incoming_packet['Value'] == "not-detected":
-                        self.logger.info("not-detected")
-                        self._detected = False
-                        if self.equipment_type == Equipment.Mount:
-                            self.__del__()  # It will morph self into a Forwarder()
-                    elif incoming_packet['Value'] == "detected":
-                        self.logger.info("detected")
-                        self._detected = True
-                return
+        try:
+            incoming_packet = json.loads(data.decode(), object_hook=datetime_decoder)
+        except Exception as ex:
+            self.logger.exception(f"While decoding the ready packet", exc_info=ex)
+            return
 
-        if self._terminating:
-            if self.driver_process and self.driver_process.poll() is None:  # still alive
-                try:
-                    self.logger.info(f"process pid={self.driver_process.pid} is still alive, killing it!")
-                    os.killpg(self.driver_process.pid, signal.SIGKILL)
-                    self.logger.info(f"killed process pid={self.driver_process.pid}")
-                except ProcessLookupError:
-                    pass
-                except Exception as ex:
-                    self.logger.exception(f"Could not killpg pid={self.driver_process.pid}", ex)
-                    self.logger.info("terminated")
-        else:
-            self.logger.info("done")
+        self._waiting_for_ready = False
+        self._responding = True
+        self._last_response = datetime.datetime.now()
+        self._ready.set()
+
+        if 'Value' in incoming_packet:
+            # it may have been an 'Error' or 'Exception' packet
+            if incoming_packet['Value'] == "not-detected":
+                self.logger.info("not-detected")
+                self._detected = False
+                if self.equipment_type == Equipment.Mount:
+                    # The other side's unit server has the mount, keep the swap off the reactor thread
+                    make = functools.partial(peer_forwarder, self.equipment_type, self.equipment_id)
+                    threading.Thread(name=f"{self.equipment_type_and_id}-swap-thread", target=self.handle.swap,
+                                     args=(make, 'not-detected, forwarding to the peer')).start()
+            elif incoming_packet['Value'] == "detected":
+                self.logger.info("detected")
+                self._detected = True
 
     async def get(self, method: str, **kwargs) -> object:
-        await asyncio.sleep(0)
-        return self.get_or_put(method, **kwargs)
-    
+        return await self.run_cancellable('GET', method, **kwargs)
+
     async def put(self, method: str, **kwargs) -> object:
-        await asyncio.sleep(0)
-        return self.get_or_put(method, **kwargs)
+        return await self.run_cancellable('PUT', method, **kwargs)
 
-    def get_or_put(self, method: str, **kwargs) -> object:
+    async def run_cancellable(self, request_type: str, method: str, **kwargs) -> object:
+        """
+        Runs get_or_put() off the event loop.  If the awaiting task gets cancelled (e.g. the HTTP
+         client disconnected) the exchange stops waiting and the driver is told to cancel the request.
+        """
+        call = Call(current_deadline.get())
+        context = contextvars.copy_context()
+        context.run(current_call.set, call)
+        future = asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(context.run, self.get_or_put, request_type, method, **kwargs))
+        start = time.perf_counter()
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        finally:
+            timing.add('driver', time.perf_counter() - start)
+
+    def get_or_put(self, request_type: str, method: str, **kwargs) -> object:
+        """
+        Only GETs are cached, coalesced and queued as queries.  A PUT is a command (or a property set), it
+         invalidates the cached getters that depend on it.
+        """
+        if request_type != "GET" and request_type != "PUT":
+            raise(Exception(f"Bad '{request_type=}', expected either 'GET' or 'PUT'"))
+
+        key = request_key(method, kwargs)
+        query = request_type == 'GET'
+        cacheable = self.cache.cacheable(method, request_type)
+        if cacheable:
+            hit, response = self.cache.get(key)
+            if hit:
+                return JSONResponse(response)
+        elif not query:
+            self.cache.invalidate(method)
+
+        if query and (method in self.idempotent_methods or cacheable):
+            call = current_call.get()
+            try:
+                response = self.single_flight.do(key, functools.partial(self.shared_exchange, request_type, method,
+                                                                        kwargs),
+                                                 call=call,
+                                                 deadline=call.deadline if call is not None else current_deadline.get())
+            except Abandoned as ex:
+                response = {
+                    'Error': f"{method=} to '{self.equipment_type_and_id}' {ex}, stopped waiting for it",
+                }
+        else:
+            response = self.exchange(request_type, method, **kwargs)
 
+        if cacheable and response is not None and response_error(response) is None:
+            self.cache.put(method, key, response)
+        return JSONResponse(response)
+
+    def priority(self, request_type: str, method: str) -> Priority:
+        if method in self.emergency_methods:
+            return Priority.Emergency
+        if method in self.idempotent_methods and request_type == 'GET' or self.cache.cacheable(method, request_type):
+            return Priority.Query
+        return Priority.Control
+
+    def shared_exchange(self, request_type: str, method: str, kwargs: dict, flight: Flight) -> dict:
+        """
+        An exchange shared by coalesced callers, see SingleFlight.do()
+        """
+        current_call.set(flight)    # in the flight's own copy of the context
+        return self.exchange(request_type, method, **kwargs)
+
+    def exchange(self, request_type: str, method: str, **kwargs) -> dict:
+        """
+        One LIPP request/response round trip, returns the decoded response.  Raises BackendRetired for
+         requests that were not completed because this driver was replaced.
+        """
+        if self.retired:
+            raise BackendRetired(f"{method=} not sent, '{self.equipment_type_and_id}' driver retired")
         if not self.detected:
-            return JSONResponse({
+            return {
                 'Error': f"Device '{self.equipment_type_and_id}' not-detected",
-            })
-        
+            }
+
+        call = current_call.get() or Call(current_deadline.get())
+        if call.cancelled or call.remaining(self._queue_timeout) <= 0:
+            return {
+                'Error': f"{method=} to '{self.equipment_type_and_id}' cancelled or past its deadline, not sent",
+            }
+
+        priority = self.priority(request_type, method)
+        queue_timeout = call.remaining(self._queue_timeout)
+        if not self.scheduler.acquire(priority, timeout=queue_timeout, on_wait=call.watch):
+            return {
+                'Error': f"Device '{self.equipment_type_and_id}' busy, {method=} not sent within " +
+                         f"{queue_timeout:.3f} seconds" + (" (cancelled)" if call.cancelled else ""),
+            }
+
         request = Request()
-        self.current_request_id += 1
-        request.RequestId = self.current_request_id
+        request.RequestId = None
         request.Method = method
         request.Parameters = {}
         for k, v in kwargs.items():
             request.Parameters[k] = v
-        request.RequestTime = datetime.datetime.now()
-        data = json.dumps(request.__dict__, cls=DateTimeEncoder).encode()
-        self.pending_request = request
+        request.Deadline = datetime.datetime.fromtimestamp(call.deadline) if call.deadline is not None else None
+        try:
+            if self.retired:    # while waiting for its turn
+                raise BackendRetired(f"{method=} not sent, '{self.equipment_type_and_id}' driver retired")
+            pending = PendingReply(request)
+            call.watch(pending.event)
+            if call.cancelled:
+                return {
+                    'Error': f"{method=} to '{self.equipment_type_and_id}' cancelled, not sent",
+                }
+            with self._pending_lock:
+                self.current_request_id += 1
+                request.RequestId = self.current_request_id
+                self._pending[request.RequestId] = pending
+            request.RequestTime = datetime.datetime.now()
+            data = json.dumps(request.__dict__, cls=DateTimeEncoder).encode()
+            self.pending_request = request
 
-        response = None
-        acquired = self.lock.acquire(timeout=10)
-        if acquired:
             try:
+                capture.record(Kind.Request, self.equipment_type_and_id, data)     # before the reply can arrive
                 self.socket.sendto(data, self.peer_socket_path)
             except ConnectionRefusedError:
                 self._responding = False
-                self.lock.release()
-                return JSONResponse({
+                return {
                     'Error': f"LIPP connection to '{self.peer_socket_path[1:]}' refused",
-                })
-
-            response = self.receive_from_driver()
-            self.lock.release()
-        else:
-            # did not acquire the lock within 10 seconds, kill the Lipper!
-            # self.restart_driver_process(reason=f"did not acquire lock within {10} seconds, " +
-            #                                    f"pending request={self.pending_request.__dict__}")
-            pass
-
-        return JSONResponse(response)
-
-    def receive_probing(self):
-        data = ''
-        address = ''
-
+                }
+            except (socket.timeout, BlockingIOError):
+                return {
+                    'Error': f"LIPP send to '{self.peer_socket_path[1:]}' timed out",
+                }
+            except OSError:
+                if self.retired:    # the socket was closed under us
+                    raise BackendRetired(f"{method=} not sent, '{self.equipment_type_and_id}' driver retired")
+                raise
+
+            call.request_id = request.RequestId
+            # a shared call's deadline may get later while it waits (see Flight)
+            sent = time.monotonic()
+            while True:
+                receive_timeout = time.monotonic() - sent
+                wait = min(self._receive_timeout - receive_timeout, call.remaining(self._receive_timeout))
+                if pending.event.wait(max(0.0, wait)) or wait <= 0 or call.cancelled:
+                    break
+            receive_timeout = time.monotonic() - sent
+            if pending.failed and self.retired:
+                if priority == Priority.Query:
+                    raise BackendRetired(f"{method=} not answered, '{self.equipment_type_and_id}' driver retired")
+                # the device may have acted upon it, a command is not replayed on the replacement
+                return {
+                    'Error': f"{method=} was sent to '{self.equipment_type_and_id}' but not answered before its " +
+                             "driver was replaced, not retried (check the device's state)",
+                }
+            if pending.response is not None:
+                return pending.response
+
+            # we stop waiting, tell the driver not to bother
+            self.abandon(request)
+            if call.cancelled:
+                return {
+                    'Error': f"{method=} to '{self.equipment_type_and_id}' cancelled by the caller",
+                }
+            if call.deadline is None or receive_timeout >= self._receive_timeout:
+                self._responding = False    # an actual timeout, not just a short deadline
+            return {
+                'Error': f"No response from '{self.equipment_type_and_id}' within {receive_timeout:.3f} " +
+                         f"seconds ({method=})",
+            }
+        finally:
+            with self._pending_lock:
+                self._pending.pop(request.RequestId, None)
+            self.scheduler.release(priority)
+
+    def receive_reply(self, data: bytes, address: str):
+        """
+        Hands a reply to the request waiting for it
+        """
         try:
-            data, address = self.probing_socket.recvfrom(self._max_bytes)
-        except socket.timeout:
-            if self._terminating:
-                return
-            if self._detected:
-                self.logger.error(f"Detected and no probe() within {self.probing_socket.gettimeout()} sec.  Suiciding!")
-                self.__del__()
+            response = self.decode_response(data, address)
         except Exception as ex:
-            self.logger.exception(f"While recvfrom probing_socket", exc_info=ex)
+            self.logger.exception(f"While decoding reply '{data}'", exc_info=ex)
             return
+        self._responding = True
+        self._last_response = datetime.datetime.now()
+
+        request_id = response.get('RequestId')
+        with self._pending_lock:
+            if request_id is None and self._pending:
+                request_id = min(self._pending)     # an Error/Exception without an id, goes to the oldest
+            pending = self._pending.get(request_id)
+        if pending is None:
+            if request_id in self._notices:
+                self.logger.debug(f"discarding reply to notice RequestId '{request_id}'")
+            elif request_id in self._abandoned:
+                self.logger.info(f"discarding late reply to abandoned RequestId '{request_id}'")
+            else:
+                self.logger.warning(f"discarding reply to unknown RequestId '{request_id}'")
+            return
+        pending.resolve(response)
 
-        if data == '':
-            pass    # TBD
-        else:
-            self.logger.info(f"got '{data}'" + (f" from '{address}'" if address and address != '' else ""))
+    def abandon(self, request: Request):
+        """
+        Sends a 'cancel' for a request we will no longer wait for.  Neither the cancel's reply nor the
+         request's late reply (if the driver sends them) will reach anyone.
+        """
+        with self._pending_lock:
+            self._abandoned.append(request.RequestId)
+        self.notify('cancel', RequestId=request.RequestId)
+
+    def notify(self, method: str, **kwargs):
+        """
+        Sends a request without waiting for its reply (which will be discarded)
+        """
+        notice = Request()
+        notice.Method = method
+        notice.Parameters = kwargs
+        notice.Deadline = None
+        with self._pending_lock:
+            self.current_request_id += 1
+            notice.RequestId = self.current_request_id
+            self._notices.append(notice.RequestId)
+        notice.RequestTime = datetime.datetime.now()
+        try:
+            data = json.dumps(notice.__dict__, cls=DateTimeEncoder).encode()
+            capture.record(Kind.Notice, self.equipment_type_and_id, data)
+            self.socket.sendto(data, self.peer_socket_path)
+        except Exception as ex:
+            self.logger.error(f"could not send '{method}' ({ex})")
+
+    def fail_pending(self, error: str):
+        with self._pending_lock:
+            pending = list(self._pending.values())
+        for p in pending:
+            p.failed = True
+            p.resolve({'Error': error})
+
+    def receive_probing(self, data: bytes, address: str):
+        if not data:
+            return    # TBD
+        capture.record(Kind.Probe, self.equipment_type_and_id, data)
+        self.logger.debug(f"got '{data}'" + (f" from '{address}'" if address and address != '' else ""))
+        try:
             response = json.loads(data.decode(), object_hook=datetime_decoder)
-            if 'AnswersToProbe' not in response:
-                self.logger.error(f"Missing 'AnswersToProbe' field in received '{data}'")
-                return
+        except ValueError:
+            self.logger.error(f"Cannot decode probe '{data}'")
+            return
+        if 'V' in response:
+            self.receive_state_vector(response)
+        elif 'AnswersToProbe' in response:
             self._answers_to_probe = response['AnswersToProbe']
-            self._last_answer_to_probe = datetime.datetime.now()
+            telemetry.record(f"{self.equipment_type_and_id}.AnswersToProbe", self._answers_to_probe)
+        else:
+            self.logger.error(f"Missing 'AnswersToProbe' field in received '{data}'")
+            return
+        self._last_answer_to_probe = datetime.datetime.now()
+        self.arm_probe_timer()
 
-    def receive_from_driver(self):
-        try:
-            data, address = self.socket.recvfrom(self._max_bytes)
-            self._responding = True
-            self._last_response = datetime.datetime.now()
-        except socket.timeout:
-            # self.logger.error(f"Timeout ({self.socket.gettimeout()} sec.) " +
-            #                   f"while recvfrom on '{self.peer_socket_path[1:]}'")
-            self._responding = False
-            return None
+    def receive_state_vector(self, probe: dict):
+        """
+        A versioned probe: {'V': schema-version, 'Seq': counter, 'Interval': seconds, 'S': [values, by schema]}.
 
+        The fields are fed to the cache, valid for two intervals (at most the fast probe interval), so
+         that their getters will not need a LIPP round trip.  The probe interval is adapted to the device's activity.
+        """
+        self._answers_to_probe = True
+        seq = probe.get('Seq')
+        if self._probe_seq is not None and isinstance(seq, int) and seq > self._probe_seq + 1:
+            self._probes_missed += seq - self._probe_seq - 1
+        self._probe_seq = seq
+
+        interval = probe.get('Interval')
+        if isinstance(interval, (int, float)) and interval > 0:
+            self._probe_interval = interval
+            self._probe_timeout = self.probe_policy['timeout_factor'] * interval
+
+        schema = self.probe_schemas.get(str(probe['V']))
+        values = probe.get('S')
+        if schema is None or not isinstance(values, list) or len(values) != len(schema):
+            self.logger.error(f"Cannot decode probe version '{probe['V']}' (values={values})")
+            return
+
+        self._probe = dict(zip(schema, values))
+        now = time.time()
+        for field, value in self._probe.items():
+            telemetry.record(f"{self.equipment_type_and_id}.{field}", value, timestamp=now)
+        if self._probe_interval is not None:
+            # getters only, valid until the next probe, at most a fast interval (PUTs invalidate them, see get_or_put())
+            ttl = min(2 * self._probe_interval, self.probe_policy['fast'])
+            for field, value in self._probe.items():
+                self.cache.feed(field, request_key(field, {}), {'Value': value}, ttl=ttl)
+
+        wanted = self.probe_policy['fast'] if self._probe.get('Activities') else self.probe_policy['slow']
+        if wanted != self._probe_interval and wanted != self._requested_probe_interval:
+            self.logger.info(f"asking for probes every {wanted} seconds (was {self._probe_interval})")
+            self._requested_probe_interval = wanted
+            self.notify('setProbeInterval', Interval=wanted)
+
+    def decode_response(self, data: bytes, address: str) -> dict:
         self.logger.info(f"got '{data}'" + f" from '{address}'" if address is not None else "")
         response = json.loads(data.decode(), object_hook=datetime_decoder)
 
@@ -344,8 +681,6 @@ class Driver(DriverInterface):
                 self.logger.error(f"remote [{ex['stack']['file']}:{ex['stack']['line']}] {ex['stack']['name']}")
         elif 'RequestId' not in response or response['RequestId'] is None:
             raise Exception("Missing 'RequestId' in response")
-        elif response['RequestId'] != self.current_request_id:
-            raise Exception(f"expected RequestId '{self.current_request_id}' got '{response['RequestId']}'")
 
         if 'Timing' in response and response['Timing'] is not None:
             tx = response['Timing']['Request']
@@ -360,20 +695,23 @@ class Driver(DriverInterface):
 
         return response
 
-    def __del__(self):
-        self._terminating = True    # signal threads to die
-        self.end_driver_process(reason='destructor')
+    def wait_ready(self, timeout: float) -> bool:
+        return self._ready.wait(timeout)
+
+    def retire(self, reason: str):
+        """
+        Called by the swap that replaces this driver: ends the driver process and releases the sockets (the
+         replacement binds the same ones).  The pending requests raise BackendRetired and get retried.
+        """
+        self.retired = True
+        self._terminating = True    # signal the reactor callbacks to ignore us
+        self.end_driver_process(reason=f"retired, {reason}")
+        if self.probing_socket:
+            reactor.remove_reader(self.probing_socket)
         if self.socket:
             self.socket.close()
         if self.probing_socket:
             self.probing_socket.close()
-
-        if self.equipment_type == Equipment.Mount and not self._detected:
-            morph_to_forwarder(self.drivers, self.equipment_type, self.equipment_id)
-        else:
-            resurrect(self.drivers, self.equipment_type, self.equipment_id)
-
-        return self._reason
     
     async def quit(self):
         if self._detected and self.driver_process is not None:
@@ -388,6 +726,15 @@ class Driver(DriverInterface):
         return {
             'AnswersToProbe': self._answers_to_probe,
             'LastAnswerToProbe': self._last_answer_to_probe,
+            'Probe': {
+                'State': self._probe,
+                'Seq': self._probe_seq,
+                'Missed': self._probes_missed,
+                'Interval': self._probe_interval,
+            },
+            'Coalescing': self.single_flight.stats(),
+            'Cache': self.cache.stats(),
+            'Scheduler': self.scheduler.stats(),
         }
     
     @property
@@ -407,12 +754,10 @@ class Driver(DriverInterface):
         return self._last_response
 
 
-def resurrect(drivers: List[Driver], equipment: Equipment, equipment_id: int = 0):
-    logger.info(f">>> Resurrecting LIPP driver {equipment.name}[{equipment_id}] ...")
-    drivers[equipment_id] = Driver(drivers=drivers, equipment=equipment, equipment_id=equipment_id)
-
-
-def morph_to_forwarder(drivers: List[Driver], equipment: Equipment, equipment_id: int = 0):
+def peer_forwarder(equipment: Equipment, equipment_id: int = 0) -> Forwarder:
+    """
+    A Forwarder to the same device, on the other side's unit server
+    """
     hostname = socket.gethostname()
     if hostname.startswith('last'):
         this_side = hostname[-1]
@@ -425,20 +770,21 @@ def morph_to_forwarder(drivers: List[Driver], equipment: Equipment, equipment_id
         peer_side = 'w'
     peer_hostname = hostname[:-1] + peer_side
 
-    logger.info(f">>> Morphing LIPP driver to Forwarder(address={peer_hostname}, port={default_port}, equipment={equipment}, equip_id={equipment_id}) ...")
-    drivers[equipment_id] = Forwarder(address=peer_hostname, port=default_port, equipment=equipment, equip_id=equipment_id)
+    logger.info(f">>> Forwarding {equipment.name}[{equipment_id}] to (address={peer_hostname}, port={default_port}) ...")
+    return Forwarder(address=peer_hostname, port=default_port, equipment=equipment, equip_id=equipment_id)
 
 
 if __name__ == '__main__':
     drivers_list: List[Driver] = list()
     driver = Driver(drivers=drivers_list, equipment=Equipment.Test, equipment_id=3)
 
-    ready_packet = driver.receive_from_driver()
-    driver.logger.info(f"received ready packet with mode={ready_packet.mode}")
+    reactor.start()
+    while driver._waiting_for_ready:    # the reactor receives the ready packet
+        time.sleep(1)
 
-    if ready_packet['Value'] == "ready":
-        driver.get(method='status')
-        driver.get(method='slewToCoordinates', ra=1.2, dec=3.4)
-        driver.get(method='move', position=10234)
+    if driver.detected:
+        driver.get_or_put('GET', method='status')
+        driver.get_or_put('PUT', method='slewToCoordinates', ra=1.2, dec=3.4)
+        driver.get_or_put('PUT', method='move', position=10234)
 
-    driver.get(method='quit')
+    driver.get_or_put('PUT', method='quit')
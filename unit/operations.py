@@ -0,0 +1,150 @@
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from utils import init_log
+
+logger = logging.getLogger('unit-operations')
+init_log(logger)
+
+
+class Operation:
+    """
+    A long-running unit operation (e.g. a slew), running as an asyncio task.  It offers:
+    - completion: 'await operation.wait()' (or the 'future' itself)
+    - progress: the latest progress dict, and a stream of them via 'progress_stream()'
+    - cancellation: 'cancel()'
+    """
+    id: int
+    kind: str
+    state: str          # 'running', 'done', 'failed' or 'cancelled'
+    started: datetime.datetime
+    ended: Optional[datetime.datetime] = None
+    progress: Optional[dict] = None
+    result: Optional[object] = None
+    error: Optional[str] = None
+    task: asyncio.Task
+    _listeners: List[asyncio.Queue]
+
+    def __init__(self, id: int, kind: str):
+        self.id = id
+        self.kind = kind
+        self.state = 'running'
+        self.started = datetime.datetime.now()
+        self._listeners = list()
+
+    def start(self, coroutine_function: Callable[['Operation'], Awaitable]):
+        self.task = asyncio.get_running_loop().create_task(self._run(coroutine_function))
+        self.task.add_done_callback(self._cancelled_early)
+
+    def _cancelled_early(self, task: asyncio.Task):
+        """
+        A task cancelled before it started running never runs _run(), ends it here
+        """
+        if task.cancelled() and self.state == 'running':
+            self.state = 'cancelled'
+            self.ended = datetime.datetime.now()
+            self._publish(None)
+
+    async def _run(self, coroutine_function: Callable[['Operation'], Awaitable]):
+        try:
+            self.result = await coroutine_function(self)
+            self.state = 'done'
+        except asyncio.CancelledError:
+            self.state = 'cancelled'
+        except Exception as ex:
+            logger.exception(f"{self.kind} operation {self.id} failed", exc_info=ex)
+            self.state = 'failed'
+            self.error = f"{ex}"
+        self.ended = datetime.datetime.now()
+        self._publish(None)     # tells the listeners the stream has ended
+        return self.result
+
+    @property
+    def future(self) -> asyncio.Task:
+        return self.task
+
+    async def wait(self, timeout: float = None) -> dict:
+        """
+        Waits (without cancelling it on timeout) for the operation to end.  The waiter's own cancellation
+         propagates, the operation goes on.
+        """
+        await asyncio.wait({self.task}, timeout=timeout)     # neither raises on timeout nor cancels the task
+        return self.report()
+
+    def cancel(self) -> bool:
+        if self.task.done():
+            return False
+        return self.task.cancel()
+
+    def update(self, progress: dict):
+        """
+        Called by the operation itself, to report progress
+        """
+        self.progress = progress
+        self._publish(progress)
+
+    def _publish(self, progress: Optional[dict]):
+        for queue in self._listeners:
+            if not queue.full():
+                queue.put_nowait(progress)
+
+    async def progress_stream(self):
+        """
+        Yields server-sent-event lines with the progress, until the operation ends
+        """
+        queue = asyncio.Queue(maxsize=100)
+        self._listeners.append(queue)
+        try:
+            if self.progress is not None:
+                yield f"data: {json.dumps(self.progress, default=str)}\n\n"
+            while not self.task.done():
+                progress = await queue.get()
+                if progress is None:
+                    break
+                yield f"data: {json.dumps(progress, default=str)}\n\n"
+            yield f"data: {json.dumps(self.report(), default=str)}\n\n"
+        finally:
+            self._listeners.remove(queue)
+
+    def report(self) -> dict:
+        return {
+            'Id': self.id,
+            'Kind': self.kind,
+            'State': self.state,
+            'Started': self.started.isoformat(),
+            'Ended': self.ended.isoformat() if self.ended else None,
+            'Progress': self.progress,
+            'Result': self.result,
+            'Error': self.error,
+        }
+
+
+class Operations:
+    """
+    Keeps the most recent operations, by id
+    """
+    _operations: Dict[int, Operation]
+    _max_kept = 50
+
+    def __init__(self):
+        self._operations = OrderedDict()
+        self._ids = itertools.count(1)
+
+    def start(self, kind: str, coroutine_function: Callable[[Operation], Awaitable]) -> Operation:
+        operation = Operation(id=next(self._ids), kind=kind)
+        self._operations[operation.id] = operation
+        while len(self._operations) > self._max_kept:
+            self._operations.popitem(last=False)
+        operation.start(coroutine_function)
+        return operation
+
+    def get(self, id: int) -> Optional[Operation]:
+        return self._operations.get(id)
+
+
+operations = Operations()
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, Optional
+
+import numpy as np
+from fastapi import APIRouter
+from starlette.responses import PlainTextResponse
+
+from utils import LAST_API_ROOT, init_log, jsonResponse
+from timing import RequestTiming, current_timing
+
+logger = logging.getLogger('unit-profiling')
+init_log(logger)
+
+profiling_router = APIRouter()
+
+
+class RouteStats:
+    count: int = 0
+    errors: int = 0     # 5xx responses
+    total: float = 0
+    driver: float = 0
+    serialization: float = 0
+    max: float = 0
+    recent: Deque[float]
+
+    def __init__(self, history: int = 1000):
+        self.recent = deque(maxlen=history)
+
+    def add(self, elapsed: float, timing: RequestTiming, status: int):
+        self.count += 1
+        if status >= 500:
+            self.errors += 1
+        self.total += elapsed
+        self.driver += timing.driver
+        self.serialization += timing.serialization
+        self.max = max(self.max, elapsed)
+        self.recent.append(elapsed)
+
+    def to_dict(self) -> dict:
+        recent = np.array(self.recent) * 1000 if self.recent else None
+        return {
+            'Count': self.count,
+            'Errors': self.errors,
+            'MeanMs': 1000 * self.total / self.count,
+            'MaxMs': 1000 * self.max,
+            'P50Ms': float(np.percentile(recent, 50)) if recent is not None else None,
+            'P95Ms': float(np.percentile(recent, 95)) if recent is not None else None,
+            'DriverMs': 1000 * self.driver / self.count,
+            'SerializationMs': 1000 * self.serialization / self.count,
+            'OtherMs': 1000 * (self.total - self.driver - self.serialization) / self.count,
+        }
+
+
+class RouteTimingMiddleware:
+    """
+    An ASGI middleware that records, per route, the latency and how much of it was spent waiting
+     for drivers and serializing responses.  When disabled, it only checks a flag.
+    """
+    enabled: bool = False
+    stats: Dict[str, RouteStats] = dict()
+    _paths: Dict[object, str] = dict()     # endpoint -> route path
+
+    def __init__(self, app, routes: list):
+        self.app = app
+        self.routes = routes
+
+    def route_path(self, scope) -> str:
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return '<unmatched>'
+        path = RouteTimingMiddleware._paths.get(endpoint)
+        if path is None:
+            for route in self.routes:
+                if getattr(route, 'endpoint', None) is endpoint:
+                    path = route.path
+                    break
+            else:
+                path = getattr(endpoint, '__name__', '<unknown>')
+            RouteTimingMiddleware._paths[endpoint] = path
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if not RouteTimingMiddleware.enabled or scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        timing = RequestTiming()
+        token = current_timing.set(timing)
+        status = 500
+
+        async def timed_send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_timing.reset(token)
+            key = f"{scope['method']} {self.route_path(scope)}"
+            stats = RouteTimingMiddleware.stats.get(key)
+            if stats is None:
+                stats = RouteStats()
+                RouteTimingMiddleware.stats[key] = stats
+            stats.add(elapsed, timing, status)
+
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """
+    Samples all the other threads' stacks, every interval, for the given seconds.  Returns the
+     number of times each stack was seen, as 'thread;outermost-frame;...;innermost-frame'
+    """
+    me = threading.get_ident()
+    names = dict()
+    samples = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            if thread_id not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, f"thread-{thread_id}"))
+            samples[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return samples
+
+
+def folded(samples: Counter) -> str:
+    """
+    The 'folded stacks' format, as consumed by flamegraph.pl and speedscope
+    """
+    return ''.join([f"{stack} {count}\n" for stack, count in samples.most_common()])
+
+
+profiler_lock = threading.Lock()     # one profile at a time
+
+
+# Method 'timing'
+@profiling_router.get(LAST_API_ROOT + 'admin/timing', tags=["admin"])
+async def admin_timing(enabled: Optional[bool] = None, reset: bool = False):
+    """
+    The per-route timing statistics, optionally enabling/disabling (and/or resetting) them
+    """
+    if enabled is not None:
+        RouteTimingMiddleware.enabled = enabled
+    if reset:
+        RouteTimingMiddleware.stats.clear()
+    return jsonResponse({"Value": {
+        'Enabled': RouteTimingMiddleware.enabled,
+        'Routes': {key: stats.to_dict() for key, stats in sorted(RouteTimingMiddleware.stats.items())},
+    }})
+
+
+# Method 'profile'
+@profiling_router.get(LAST_API_ROOT + 'admin/profile', tags=["admin"])
+async def admin_profile(seconds: float = 10, interval: float = 0.005):
+    """
+    Samples all the threads (the event loop's included) for the given seconds, returns flame-graph
+     compatible folded stacks
+    """
+    if seconds <= 0 or seconds > 300 or interval <= 0:
+        return jsonResponse({"Error": f"Bad {seconds=} (0 < seconds <= 300) or {interval=}"})
+    if not profiler_lock.acquire(blocking=False):
+        return jsonResponse({"Error": "Already profiling"})
+    try:
+        logger.info(f"profiling for {seconds} seconds, every {interval} seconds")
+        samples = await asyncio.get_running_loop().run_in_executor(None, sample_stacks, seconds, interval)
+    finally:
+        profiler_lock.release()
+    return PlainTextResponse(folded(samples))
@@ -0,0 +1,107 @@
+import argparse
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from utils import init_log
+
+#
+# A local stand-in for a LAST power switch.  It serves the two XML pages read by the PswitchDriver
+#  (st0.xml - dynamic state, st2.xml - static outlet names) and obeys outs.cgi, so that the driver
+#  can be exercised and benchmarked without the actual hardware, e.g.:
+#
+#   python3 pswitch-simulator.py --port 8081 --latency 0.05
+#   PswitchDriver('e', base_url='http://127.0.0.1:8081')
+#
+
+
+class Simulator:
+    names: list
+    outlets: list
+    temp: float
+    latency: float
+    requests: dict
+
+    def __init__(self, names: list = None, latency: float = 0) -> None:
+        self.names = names if names is not None else [f"Outlet{i+1}" for i in range(6)]
+        self.outlets = [False] * len(self.names)
+        self.temp = 23.5
+        self.latency = latency
+        self.requests = {'st0.xml': 0, 'st2.xml': 0, 'outs.cgi': 0}
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger('pswitch-simulator')
+        init_log(self.logger)
+
+    def dynamic_xml(self) -> str:
+        outs = ''.join([f"<out{i}>{1 if on else 0}</out{i}>" for i, on in enumerate(self.outlets)])
+        return f"<response>{outs}<ia1>{int(self.temp * 10)}</ia1></response>"
+
+    def static_xml(self) -> str:
+        names = ''.join([f"<r{i+6}>{name}</r{i+6}>" for i, name in enumerate(self.names)])
+        return f"<response>{names}</response>"
+
+    def outs(self, query: dict):
+        """
+        outs.cgi?out<n>=0|1 sets outlet <n>, outs.cgi?out=<n> toggles it
+        """
+        with self.lock:
+            for key, values in query.items():
+                if key == 'out':
+                    idx = int(values[0])
+                    self.outlets[idx] = not self.outlets[idx]
+                elif key.startswith('out'):
+                    self.outlets[int(key[3:])] = values[0] == '1'
+
+    def make_handler(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'   # keep-alive
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                page = url.path.lstrip('/')
+                if page not in simulator.requests:
+                    self.send_error(404)
+                    return
+                simulator.requests[page] += 1
+                if simulator.latency:
+                    time.sleep(simulator.latency)
+
+                if page == 'outs.cgi':
+                    simulator.outs(parse_qs(url.query))
+                    body = simulator.dynamic_xml()
+                elif page == 'st0.xml':
+                    body = simulator.dynamic_xml()
+                else:
+                    body = simulator.static_xml()
+
+                data = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, fmt, *args):
+                simulator.logger.debug(fmt % args)
+
+        return Handler
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        server = ThreadingHTTPServer(('127.0.0.1', port), self.make_handler())
+        self.logger.info(f"serving on http://127.0.0.1:{server.server_address[1]} ({self.latency=})")
+        return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', '-p', action='store', dest='port', type=int, default=8081)
+    parser.add_argument('--latency', '-l', action='store', dest='latency', type=float, default=0,
+                        help='seconds added to every HTTP request, to mimic the real switch')
+
+    args = parser.parse_args()
+    Simulator(latency=args.latency).serve(port=args.port).serve_forever()
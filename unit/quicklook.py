@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict
+
+import numpy as np
+from fastapi import APIRouter
+
+from utils import LAST_API_ROOT, init_log, jsonResponse
+from config import config
+from frames import Frame, frame_store
+from telemetry import telemetry
+
+logger = logging.getLogger('unit-quicklook')
+init_log(logger)
+
+quicklook_router = APIRouter()
+
+fwhm_per_sigma = 2 * np.sqrt(2 * np.log(2))
+
+
+def tile_view(image: np.ndarray, tile: int) -> np.ndarray:
+    """
+    The image (cropped to whole tiles) as (tiles, pixels per tile)
+    """
+    rows, cols = image.shape[0] // tile, image.shape[1] // tile
+    cropped = image[:rows * tile, :cols * tile]
+    return cropped.reshape(rows, tile, cols, tile).swapaxes(1, 2).reshape(rows * cols, tile * tile)
+
+
+def local_maxima(image: np.ndarray, ys: np.ndarray, xs: np.ndarray, radius: int = 1) -> np.ndarray:
+    """
+    A mask of the candidate pixels (ys, xs) that are the strict maxima of their (2 * radius + 1) square
+     neighborhood (edges excluded), so that two maxima are more than radius pixels apart.  Ties go to the
+     first pixel in row order: a flat top (e.g. a saturated star) has a single maximum.
+    """
+    inside = (ys >= radius) & (ys < image.shape[0] - radius) & (xs >= radius) & (xs < image.shape[1] - radius)
+    ys, xs = ys[inside], xs[inside]
+    center = image[ys, xs]
+    mask = np.ones(len(ys), dtype=bool)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if (dy, dx) < (0, 0):
+                mask &= center > image[ys + dy, xs + dx]
+            elif (dy, dx) > (0, 0):
+                mask &= center >= image[ys + dy, xs + dx]
+    result = np.zeros(len(inside), dtype=bool)
+    result[np.flatnonzero(inside)[mask]] = True
+    return result
+
+
+def quick_look(data: np.ndarray, subsample: int = 2, tile: int = 64, samples: int = 16, threshold: float = 5,
+               max_stars: int = 200, half_width: int = 5, separation: int = 2, floor: float = 2,
+               saturation: float = None) -> dict:
+    """
+    Quick-look quality numbers for a frame, computed on a subsampled (every subsample-th row and column) view:
+    - Background and Noise: medians of the per-tile medians and lower-side spreads (to the 16th percentile),
+       from a grid of samples x samples pixels in each tile x tile
+    - Saturated: the fraction of pixels at or above the saturation level (default: the dtype's maximum)
+    - Stars: local maxima (more than separation pixels apart) more than threshold * noise above their tile's
+       background, whose 3x3 neighborhood is also threshold times its own noise above the background (a lone
+       noisy pixel is not)
+    - FWHM: the median, over the brightest unsaturated stars, of the second moments of full-resolution cutouts,
+       from their pixels more than floor * noise above the background (the noise would widen them)
+    """
+    if saturation is None:
+        saturation = np.iinfo(data.dtype).max if np.issubdtype(data.dtype, np.integer) else np.inf
+    image = data[::subsample, ::subsample]
+
+    tile = min(tile, *image.shape)
+    step = max(tile // samples, 1)
+    tile -= tile % step
+    rows, cols = image.shape[0] // tile, image.shape[1] // tile
+    sampled = tile_view(image[:rows * tile:step, :cols * tile:step], tile // step)
+    low, median = np.percentile(sampled, [15.87, 50], axis=1)
+    background_map = median.reshape(rows, cols)
+    noise_map = np.maximum(median - low, 1e-3).reshape(rows, cols)
+    background = float(np.median(background_map))
+    noise = float(np.median(noise_map))
+    noise_map = np.maximum(noise_map, noise)    # a tile's few samples can underestimate it, not below the frame's
+
+    saturated_fraction = float(np.count_nonzero(image >= saturation) / image.size)
+
+    #
+    # Detection: only the pixels above the lowest of the tiles' thresholds are candidates, they are then
+    #  checked against their own tile's threshold (pixels beyond the whole tiles use the last tile's) and
+    #  their neighbors
+    #
+    threshold_map = background_map + threshold * noise_map
+    ys, xs = np.nonzero(image > threshold_map.min())
+    above = image[ys, xs] > threshold_map[np.minimum(ys // tile, rows - 1), np.minimum(xs // tile, cols - 1)]
+    ys, xs = ys[above], xs[above]
+    peaks = local_maxima(image, ys, xs, radius=separation)
+    ys, xs = ys[peaks], xs[peaks]
+    tiles = (np.minimum(ys // tile, rows - 1), np.minimum(xs // tile, cols - 1))
+    offsets = np.arange(-1, 2)
+    boxes = image[ys[:, None, None] + offsets[None, :, None], xs[:, None, None] + offsets[None, None, :]]
+    excess = boxes.sum(axis=(1, 2), dtype=np.float64) - 9 * background_map[tiles]
+    significant = excess > threshold * 3 * noise_map[tiles]     # the noise of a sum of 9 pixels is 3 times theirs
+    ys, xs = ys[significant], xs[significant]
+    stars = int(len(ys))
+
+    #
+    # FWHM, from the brightest unsaturated peaks, at full resolution
+    #
+    fwhm = None
+    values = image[ys, xs]
+    keep = values < saturation
+    ys, xs, values = ys[keep], xs[keep], values[keep]
+    order = np.argsort(values)[::-1][:max_stars]
+    ys, xs = ys[order] * subsample, xs[order] * subsample
+    inside = (ys >= half_width) & (ys < data.shape[0] - half_width) & \
+             (xs >= half_width) & (xs < data.shape[1] - half_width)
+    ys, xs = ys[inside], xs[inside]
+    if len(ys):
+        offsets = np.arange(-half_width, half_width + 1)
+        cutouts = data[ys[:, None, None] + offsets[None, :, None], xs[:, None, None] + offsets[None, None, :]]
+        tiles = (np.minimum(ys // subsample // tile, rows - 1), np.minimum(xs // subsample // tile, cols - 1))
+        weights = cutouts.astype(np.float32) - background_map[tiles][:, None, None]
+        weights[weights <= floor * noise_map[tiles][:, None, None]] = 0
+        total = weights.sum(axis=(1, 2))
+        valid = total > 0
+        weights, total = weights[valid], total[valid]
+        if len(total):
+            dy = offsets[None, :, None].astype(np.float32)
+            dx = offsets[None, None, :].astype(np.float32)
+            cy = (weights * dy).sum(axis=(1, 2)) / total
+            cx = (weights * dx).sum(axis=(1, 2)) / total
+            second_moment = weights * (np.square(dy - cy[:, None, None]) + np.square(dx - cx[:, None, None]))
+            variance = second_moment.sum(axis=(1, 2)) / total / 2
+            fwhm = float(np.median(fwhm_per_sigma * np.sqrt(variance)))
+
+    return {
+        'Background': background,
+        'Noise': noise,
+        'Saturated': saturated_fraction,
+        'Stars': stars,
+        'FWHM': fwhm,       # pixels
+    }
+
+
+class QuickLook:
+    """
+    Computes the quick-look numbers of each new frame as soon as it arrives (all the cameras in parallel,
+     on a thread pool) and keeps the results of the recent frames, by frame id
+    """
+    results: 'OrderedDict[str, dict]'
+    pending: Dict[str, Future]
+
+    def __init__(self, policy: dict):
+        self.enabled = policy['enabled']
+        self.subsample = policy['subsample']
+        self.tile = policy['tile']
+        self.samples = policy['samples']
+        self.threshold = policy['threshold']
+        self.max_stars = policy['max_stars']
+        self.capacity = policy['cache']
+        self.results = OrderedDict()
+        self.pending = dict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=policy['workers'], thread_name_prefix='unit-quicklook-')
+
+    def on_frame(self, frame: Frame):
+        if self.enabled:
+            self.submit(frame)
+
+    def submit(self, frame: Frame) -> Future:
+        with self._lock:
+            future = self.pending.get(frame.id)
+            if future is None:
+                future = self._executor.submit(self.compute, frame)
+                self.pending[frame.id] = future
+            return future
+
+    def compute(self, frame: Frame) -> dict:
+        start = time.monotonic()
+        try:
+            result = quick_look(frame.data, subsample=self.subsample, tile=self.tile, samples=self.samples,
+                                threshold=self.threshold, max_stars=self.max_stars)
+        except Exception as ex:
+            logger.exception(f"quick-look of frame {frame.id} failed", exc_info=ex)
+            result = {'Error': f"{ex}"}
+        else:
+            for name, value in result.items():
+                if value is not None:
+                    telemetry.record(f"camera-{frame.camera_id}.{name.lower()}", value)
+        result['Frame'] = frame.id
+        result['Seconds'] = time.monotonic() - start
+        result['AfterReceived'] = time.time() - frame.received.timestamp()
+
+        with self._lock:
+            self.results[frame.id] = result
+            while len(self.results) > self.capacity:
+                self.results.popitem(last=False)
+            self.pending.pop(frame.id, None)
+        return result
+
+    async def get(self, frame: Frame) -> dict:
+        with self._lock:
+            result = self.results.get(frame.id)
+        if result is not None:
+            return result
+        return await asyncio.wrap_future(self.submit(frame))
+
+
+quick_look_service = QuickLook(config['quicklook'])
+frame_store.subscribe(quick_look_service.on_frame)
+
+
+# Method 'quicklook'
+@quicklook_router.get(LAST_API_ROOT + 'unit/quicklook', tags=["unit"])
+async def unit_quicklook():
+    """
+    The quick-look numbers of all the cameras' latest frames
+    """
+    value = dict()
+    for camera_id in frame_store.camera_ids():
+        frame = frame_store.latest(camera_id)
+        value[f"camera-{camera_id}"] = await quick_look_service.get(frame)
+    return jsonResponse({"Value": value})
+
+
+@quicklook_router.get(LAST_API_ROOT + 'unit/quicklook/{camera_id}', tags=["unit"])
+async def unit_camera_quicklook(camera_id: int):
+    """
+    The quick-look numbers (Background, Noise, Saturated fraction, Stars, FWHM in pixels) of a camera's latest frame
+    """
+    frame = frame_store.latest(camera_id)
+    if frame is None:
+        return jsonResponse({"Error": f"No frame from camera-{camera_id}"})
+    return jsonResponse({"Value": await quick_look_service.get(frame)})
@@ -0,0 +1,215 @@
+import heapq
+import itertools
+import logging
+import os
+import resource
+import selectors
+import socket
+import threading
+import time
+from subprocess import Popen
+from typing import Callable, Dict, List, Optional
+
+from utils import init_log
+
+logger = logging.getLogger('lipp-reactor')
+init_log(logger)
+
+
+class TimerHandle:
+    """
+    Returned by Reactor.call_later(), allows the caller to cancel a pending callback
+    """
+    when: float
+    callback: Callable
+    cancelled: bool = False
+
+    def __init__(self, when: float, callback: Callable):
+        self.when = when
+        self.callback = callback
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Reactor:
+    """
+    A single thread that multiplexes all the LIPP sockets (ready packets, probes) and the
+     driver-process exits (via pidfd, where available) of all the drivers in this process.
+
+    Callbacks are called on the reactor thread, so they must be short and must not block.
+    """
+    _selector: selectors.BaseSelector
+    _lock: threading.RLock
+    _timers: List
+    _thread: Optional[threading.Thread] = None
+    _polled_processes: Dict[int, tuple]
+    _pidfds: Dict[int, int]
+    _process_poll_interval = 1    # seconds, used only when pidfd is not available
+    _process_poll_timer: Optional[TimerHandle] = None
+    _iterations: int = 0
+    _callbacks: int = 0
+
+    def __init__(self, name: str = 'lipp-reactor-thread'):
+        self.name = name
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.RLock()
+        self._timers = list()
+        self._sequence = itertools.count()
+        self._polled_processes = dict()
+        self._pidfds = dict()
+        self._waker, self._wakee = socket.socketpair()
+        self._waker.setblocking(False)
+        self._wakee.setblocking(False)
+        self._selector.register(self._wakee, selectors.EVENT_READ, self._drain_wakeups)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(name=self.name, target=self._loop, daemon=True)
+            self._thread.start()
+            logger.info(f"started (selector={type(self._selector).__name__})")
+
+    def _wakeup(self):
+        try:
+            self._waker.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # the reactor is already due to wake up
+
+    def _drain_wakeups(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def add_reader(self, fileobj, callback: Callable):
+        """
+        Calls callback(fileobj) on the reactor thread whenever fileobj becomes readable
+        """
+        with self._lock:
+            try:
+                self._selector.modify(fileobj, selectors.EVENT_READ, callback)
+            except KeyError:
+                self._selector.register(fileobj, selectors.EVENT_READ, callback)
+        self.start()
+        self._wakeup()
+
+    def remove_reader(self, fileobj):
+        with self._lock:
+            try:
+                self._selector.unregister(fileobj)
+            except (KeyError, ValueError):
+                pass
+        self._wakeup()
+
+    def call_later(self, delay: float, callback: Callable) -> TimerHandle:
+        handle = TimerHandle(when=time.monotonic() + delay, callback=callback)
+        with self._lock:
+            heapq.heappush(self._timers, (handle.when, next(self._sequence), handle))
+        self.start()
+        self._wakeup()
+        return handle
+
+    def watch_process(self, process: Popen, callback: Callable):
+        """
+        Calls callback(returncode) on the reactor thread when the process exits.
+        Uses a pidfd (Linux >= 5.3, Python >= 3.9), otherwise falls back to a single periodic poll
+         shared by all the watched processes.
+        """
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(process.pid)
+            except OSError:
+                pidfd = None
+            if pidfd is not None:
+                def on_exit(fd):
+                    with self._lock:
+                        if self._pidfds.pop(process.pid, None) is None:
+                            return  # unwatched meanwhile
+                    self.remove_reader(fd)
+                    os.close(fd)
+                    callback(process.wait())
+                with self._lock:
+                    self._pidfds[process.pid] = pidfd
+                self.add_reader(pidfd, on_exit)
+                return
+
+        with self._lock:
+            self._polled_processes[process.pid] = (process, callback)
+            if self._process_poll_timer is None:
+                self._process_poll_timer = self.call_later(self._process_poll_interval, self._poll_processes)
+
+    def unwatch_process(self, process: Popen):
+        with self._lock:
+            self._polled_processes.pop(process.pid, None)
+            pidfd = self._pidfds.pop(process.pid, None)
+        if pidfd is not None:
+            self.remove_reader(pidfd)
+            os.close(pidfd)
+
+    def _poll_processes(self):
+        with self._lock:
+            exited = [(pid, process, callback) for pid, (process, callback) in self._polled_processes.items()
+                      if process.poll() is not None]
+            for pid, _, _ in exited:
+                del self._polled_processes[pid]
+            if self._polled_processes:
+                self._process_poll_timer = self.call_later(self._process_poll_interval, self._poll_processes)
+            else:
+                self._process_poll_timer = None
+        for _, process, callback in exited:
+            callback(process.returncode)
+
+    def _next_timeout(self) -> Optional[float]:
+        with self._lock:
+            while self._timers and self._timers[0][2].cancelled:
+                heapq.heappop(self._timers)
+            if not self._timers:
+                return None
+            return max(0.0, self._timers[0][0] - time.monotonic())
+
+    def _run_callback(self, callback: Callable, *args):
+        self._callbacks += 1
+        try:
+            callback(*args)
+        except Exception as ex:
+            logger.exception(f"callback {callback} failed", exc_info=ex)
+
+    def _loop(self):
+        while True:
+            events = self._selector.select(timeout=self._next_timeout())
+            self._iterations += 1
+            for key, _ in events:
+                self._run_callback(key.data, key.fileobj)
+
+            due = list()
+            now = time.monotonic()
+            with self._lock:
+                while self._timers and self._timers[0][0] <= now:
+                    _, _, handle = heapq.heappop(self._timers)
+                    if not handle.cancelled:
+                        due.append(handle)
+            for handle in due:
+                self._run_callback(handle.callback)
+
+    def stats(self) -> dict:
+        """
+        Figures for comparing the reactor against the previous thread-per-socket design
+        """
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        with self._lock:
+            return {
+                'Threads': threading.active_count(),
+                'RegisteredFileObjects': len(self._selector.get_map()) - 1,
+                'PendingTimers': len([t for t in self._timers if not t[2].cancelled]),
+                'PolledProcesses': len(self._polled_processes),
+                'Iterations': self._iterations,
+                'Callbacks': self._callbacks,
+                'VoluntaryContextSwitches': usage.ru_nvcsw,
+                'InvoluntaryContextSwitches': usage.ru_nivcsw,
+            }
+
+
+reactor = Reactor()
@@ -0,0 +1,366 @@
+import asyncio
+import datetime
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set
+
+import numpy as np
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from utils import Equipment, LAST_API_ROOT, init_log, jsonResponse
+from driver_interface import BackendRetired, DriverInterface
+from config import config
+from deadlines import remaining
+from telemetry import telemetry
+
+logger = logging.getLogger('unit-registry')
+init_log(logger)
+
+registry_router = APIRouter()
+
+#
+# The device lists (focusers, cameras, mounts) hold a DeviceHandle per device, never the driver itself, so
+#  that whoever keeps a device (the telescopes, the unit's mount, ...) keeps it across driver replacements.
+#
+# A swap (a LIPP process that stopped probing, a mount that is served by the other side, an operator's
+#  restart) is atomic as far as the requests are concerned:
+#  - new requests wait (bounded by their deadline) for the swap to end
+#  - the old driver's in-flight requests get 'drain' seconds to complete
+#  - the old driver is retired, the requests it did not complete raise BackendRetired and are retried
+#     against the new driver, once it is ready
+#  - if no new driver could be made, the handle is marked failed (its requests get an error right away) and
+#     the swap is retried every 'retry' seconds
+#
+
+
+class Swap:
+    reason: str
+    started: datetime.datetime
+    old: str
+    new: Optional[str] = None
+    drained: Optional[bool] = None      # did all the in-flight requests complete before the old driver retired
+    unfinished: int = 0                 # requests still in flight when it retired (they get retried)
+    ready: Optional[bool] = None        # did the new driver come up within the 'ready' timeout
+    drain_seconds: Optional[float] = None
+    seconds: Optional[float] = None     # during which requests were held
+    error: Optional[str] = None
+
+    def __init__(self, reason: str, old: DriverInterface):
+        self.reason = reason
+        self.old = type(old).__name__
+        self.started = datetime.datetime.now()
+        self._start = time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._start
+
+    def to_dict(self) -> dict:
+        return {
+            'Reason': self.reason,
+            'Started': self.started.isoformat(),
+            'Old': self.old,
+            'New': self.new,
+            'Drained': self.drained,
+            'Unfinished': self.unfinished,
+            'Ready': self.ready,
+            'DrainSeconds': self.drain_seconds,
+            'Seconds': self.seconds,
+            'Error': self.error,
+        }
+
+
+class DeviceHandle:
+    """
+    A stable reference to a device, whose driver may be swapped while in use
+    """
+    name: str                   # e.g. 'camera-1'
+    backend: DriverInterface
+    make: Callable[[], DriverInterface]    # makes a fresh driver, for restarts
+    generation: int = 0         # drivers installed so far
+    inflight: int = 0
+    swapping: bool = False
+    retries: int = 0            # requests retried against a newer driver
+    history: Deque[Swap]
+    commands: Set[str]          # the device's methods offered as the handle's (sent as PUTs)
+    failed: Optional[str] = None    # the last swap did not make a driver, the handle has none that works
+
+    def __init__(self, name: str, backend: DriverInterface, make: Callable[[], DriverInterface], policy: dict,
+                 commands: List[str] = None):
+        self.name = name
+        self.make = make
+        self.policy = policy
+        self.commands = set(commands or [])
+        self.history = deque(maxlen=20)
+        self._condition = threading.Condition()
+        self._installed = threading.Event()
+        self._waiters = list()     # (loop, future) of the requests waiting for a swap to end
+        self._retry_timer = None
+        self.install(backend)
+
+    def install(self, backend: DriverInterface):
+        with self._condition:
+            self.backend = backend
+            self.generation += 1
+            self.failed = None
+        self._installed.set()
+        self._wake()
+
+    def _wake(self):
+        with self._condition:
+            waiters, self._waiters = self._waiters, list()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+    async def _acquire_async(self, timeout: float) -> Optional[DriverInterface]:
+        """
+        Like _acquire(), without parking a thread: the requests waiting for a swap to end are woken by it
+        """
+        deadline = time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        while True:
+            future = loop.create_future()
+            with self._condition:
+                if not self.swapping:
+                    self.inflight += 1
+                    return self.backend
+                self._waiters.append((loop, future))
+            try:
+                await asyncio.wait_for(future, max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                with self._condition:
+                    if (loop, future) in self._waiters:
+                        self._waiters.remove((loop, future))
+
+    def _acquire(self, timeout: float) -> Optional[DriverInterface]:
+        deadline = time.monotonic() + timeout
+        while self._installed.wait(max(0.0, deadline - time.monotonic())):
+            with self._condition:
+                if not self.swapping:
+                    self.inflight += 1
+                    return self.backend
+        return None
+
+    def _release(self):
+        with self._condition:
+            self.inflight -= 1
+            self._condition.notify_all()
+
+    async def request(self, verb: str, method: str, **kwargs) -> object:
+        return await self.call_async(verb, method, what=f"{method=}", **kwargs)
+
+    async def call_async(self, name: str, *args, what: str = None, **kwargs) -> object:
+        """
+        Awaits the current driver's 'name' method, retried against the next driver if it was retired meanwhile
+        """
+        what = what or f"{name}()"
+        for attempt in range(self.policy['attempts']):
+            if self.failed is not None:
+                return JSONResponse({
+                    'Error': f"'{self.name}' has no working driver ({self.failed}), {what} not sent",
+                })
+            backend = self._acquire(0)
+            if backend is None:
+                timeout = remaining(self.policy['wait'])
+                backend = await self._acquire_async(timeout)
+                if backend is None:
+                    return JSONResponse({
+                        'Error': f"'{self.name}' is being replaced, {what} not sent within {timeout:.3f} seconds",
+                    })
+            try:
+                return await getattr(backend, name)(*args, **kwargs)
+            except BackendRetired as ex:
+                self.retries += 1
+                logger.info(f"{self.name}: retrying {what}, its driver was replaced ({ex})")
+            finally:
+                self._release()
+        return JSONResponse({
+            'Error': f"'{self.name}': {what} not completed by {self.policy['attempts']} successive drivers",
+        })
+
+    async def get(self, method: str, **kwargs) -> object:
+        return await self.request('get', method, **kwargs)
+
+    async def put(self, method: str, **kwargs) -> object:
+        return await self.request('put', method, **kwargs)
+
+    def swap(self, make: Callable[[], DriverInterface], reason: str) -> Optional[Swap]:
+        """
+        Replaces the driver with the one make() returns.  Blocks (for up to 'drain' + 'ready' seconds), keep it
+         off the event loop and the reactor thread.  Returns None if another swap is in progress.
+        """
+        with self._condition:
+            if self.swapping:
+                logger.info(f"{self.name}: already swapping, not for {reason=}")
+                return None
+            self.swapping = True
+            self._installed.clear()
+            old = self.backend
+            if self._retry_timer is not None:
+                self._retry_timer.cancel()      # this swap supersedes the scheduled retry
+                self._retry_timer = None
+        swap = Swap(reason, old)
+        logger.info(f"{self.name}: swapping its {swap.old}, {reason=}")
+
+        new = None
+        try:
+            with self._condition:
+                swap.drained = self._condition.wait_for(lambda: self.inflight == 0, timeout=self.policy['drain'])
+                swap.unfinished = self.inflight
+            swap.drain_seconds = swap.elapsed()
+            old.retire(reason)
+            new = make()
+            swap.new = type(new).__name__
+            swap.ready = new.wait_ready(self.policy['ready'])
+        except Exception as ex:
+            swap.error = f"{ex}"
+            logger.exception(f"{self.name}: swap failed, keeping the (retired) {swap.old}, retrying in " +
+                             f"{self.policy['retry']} seconds", exc_info=ex)
+
+        with self._condition:
+            if new is not None:
+                self.backend = new
+                self.generation += 1
+                self.failed = None
+            else:
+                # the requests get an error right away, rather than being retried against the retired driver
+                self.failed = swap.error
+            self.swapping = False
+        self._installed.set()
+        self._wake()
+        if new is None:
+            self._retry_timer = threading.Timer(self.policy['retry'], self.swap,
+                                                args=(make, f"retry of the failed swap ({reason})"))
+            self._retry_timer.daemon = True
+            self._retry_timer.start()
+
+        swap.seconds = swap.elapsed()
+        self.history.append(swap)
+        telemetry.record(f"{self.name}.swap", swap.seconds)
+        logger.info(f"{self.name}: swapped {swap.old} -> {swap.new} in {swap.seconds:.3f} seconds " +
+                    f"(drained={swap.drained}, unfinished={swap.unfinished}, ready={swap.ready})")
+        return swap
+
+    def restart(self, reason: str) -> Optional[Swap]:
+        return self.swap(self.make, reason)
+
+    #
+    # The rest is the current driver's
+    #
+    @property
+    def detected(self) -> bool:
+        return self.backend.detected
+
+    @property
+    def responding(self) -> bool:
+        return self.backend.responding
+
+    @property
+    def last_response(self) -> datetime.datetime:
+        return self.backend.last_response
+
+    def status(self):
+        return self.backend.status()
+
+    def info(self):
+        return self.backend.info()
+
+    async def quit(self):
+        quit = getattr(self.backend, 'quit', None)
+        if quit is not None:
+            await quit()
+
+    def __getattr__(self, item):
+        """
+        The device's commands (see config['drivers']['commands'], e.g. abort, move, takeExposure) are sent as
+         PUTs through the current driver.  Nothing else is proxied.
+        """
+        if item in self.__dict__.get('commands', ()):
+            return functools.partial(self.put, item)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{item}'")
+
+    def stats(self) -> dict:
+        seconds = [s.seconds for s in self.history]
+        return {
+            'Backend': type(self.backend).__name__,
+            'Generation': self.generation,
+            'InFlight': self.inflight,
+            'Swapping': self.swapping,
+            'Failed': self.failed,
+            'Retries': self.retries,
+            'Swaps': len(self.history),
+            'MaxSwapSeconds': max(seconds) if seconds else None,
+            'P50SwapSeconds': float(np.percentile(seconds, 50)) if seconds else None,
+            'Recent': [s.to_dict() for s in self.history],
+        }
+
+
+class DriverRegistry:
+    handles: Dict[str, DeviceHandle]
+
+    def __init__(self, policy: dict, commands: Dict[str, List[str]]):
+        self.policy = policy
+        self.commands = commands
+        self.handles = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def name(equipment: Equipment, equipment_id: int = 0) -> str:
+        return equipment.name.lower() + (f'-{equipment_id}' if equipment_id != 0 else '')
+
+    def register(self, equipment: Equipment, equipment_id: int, backend: DriverInterface,
+                 make: Callable[[], DriverInterface]) -> DeviceHandle:
+        """
+        The device's handle, with backend as its driver.  A driver made during a swap is installed by the swap.
+        """
+        name = self.name(equipment, equipment_id)
+        with self._lock:
+            handle = self.handles.get(name)
+            if handle is None:
+                handle = DeviceHandle(name, backend=backend, make=make, policy=self.policy,
+                                      commands=self.commands.get(equipment.name.lower()))
+                self.handles[name] = handle
+                return handle
+        if not handle.swapping:
+            logger.info(f"{name}: new {type(backend).__name__} installed without a swap")
+            handle.install(backend)
+        return handle
+
+    def get(self, name: str) -> Optional[DeviceHandle]:
+        return self.handles.get(name)
+
+    def stats(self) -> dict:
+        return {name: handle.stats() for name, handle in self.handles.items()}
+
+
+registry = DriverRegistry(config['drivers']['swap'], config['drivers']['commands'])
+
+
+# Method 'drivers'
+@registry_router.get(LAST_API_ROOT + 'admin/drivers', tags=["admin"])
+async def admin_drivers():
+    """
+    The devices' drivers, their in-flight requests and their recent swaps
+    """
+    return jsonResponse({"Value": registry.stats()})
+
+
+# Method 'restart'
+@registry_router.put(LAST_API_ROOT + 'admin/drivers/{name}/restart', tags=["admin"])
+async def admin_driver_restart(name: str):
+    """
+    Replaces a device's driver with a fresh one, e.g. name='camera-1'
+    """
+    handle = registry.get(name)
+    if handle is None:
+        return jsonResponse({"Error": f"No device named '{name}', one of {list(registry.handles.keys())}"})
+    swap = await run_in_threadpool(handle.restart, 'operator restart')
+    if swap is None:
+        return jsonResponse({"Error": f"'{name}' is already being swapped"})
+    return jsonResponse({"Value": swap.to_dict()})
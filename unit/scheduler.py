@@ -0,0 +1,109 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+
+class Priority(IntEnum):
+    Emergency = 0   # abort, stop: never queued
+    Control = 1     # commands that change the device's state
+    Query = 2       # getters
+
+
+class _Waiter:
+    priority: Priority
+    enqueued: float
+    granted: bool = False
+    cancelled: bool = False
+
+    def __init__(self, priority: Priority):
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.event = threading.Event()
+
+
+class CommandScheduler:
+    """
+    Orders the commands to a single device.  One control or query command is outstanding at a time,
+     the waiting ones are granted by priority, then first-come-first-served.
+
+    Emergency commands bypass the queue altogether: they are sent right away, even while another
+     command is outstanding (the driver demultiplexes the replies by RequestId).
+    """
+    _queue: List[Tuple[int, int, _Waiter]]
+    _waits: Dict[Priority, Deque[float]]
+    _busy: bool = False
+    emergencies: int = 0
+    timeouts: int = 0
+
+    def __init__(self, history: int = 100):
+        self._lock = threading.Lock()
+        self._queue = list()
+        self._seq = itertools.count()
+        self._waits = {p: deque(maxlen=history) for p in Priority}
+
+    def acquire(self, priority: Priority, timeout: float,
+                on_wait: Optional[Callable[[threading.Event], None]] = None) -> bool:
+        """
+        Waits (up to timeout seconds) for the caller's turn to talk to the device.  If the caller
+         needs to wake the wait up (e.g. when cancelled), it gets the waited-upon event via on_wait().
+        """
+        if priority == Priority.Emergency:
+            self.emergencies += 1
+            self._waits[priority].append(0.0)
+            return True
+
+        with self._lock:
+            if not self._busy and not self._queue:
+                self._busy = True
+                self._waits[priority].append(0.0)
+                return True
+            waiter = _Waiter(priority)
+            heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+
+        if on_wait is not None:
+            on_wait(waiter.event)
+        waiter.event.wait(timeout)
+        with self._lock:
+            if waiter.granted:
+                self._waits[priority].append(time.monotonic() - waiter.enqueued)
+                return True
+            waiter.cancelled = True     # skipped by release()
+            self.timeouts += 1
+            return False
+
+    def release(self, priority: Priority):
+        if priority == Priority.Emergency:
+            return
+
+        with self._lock:
+            while self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                if waiter.cancelled:
+                    continue
+                waiter.granted = True
+                waiter.event.set()
+                return
+            self._busy = False
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            waiting = [w for _, _, w in self._queue if not w.cancelled]
+        waits = dict()
+        for priority, samples in self._waits.items():
+            waits[priority.name] = {
+                'Mean': (sum(samples) / len(samples)) if samples else None,
+                'Max': max(samples) if samples else None,
+            }
+        return {
+            'Busy': self._busy,
+            'QueueDepth': len(waiting),
+            'OldestAge': max([now - w.enqueued for w in waiting]) if waiting else None,
+            'WaitTime': waits,
+            'Emergencies': self.emergencies,
+            'Timeouts': self.timeouts,
+        }
@@ -0,0 +1,117 @@
+import fcntl
+import os
+import threading
+from typing import Dict, Set
+
+#
+# Sequence numbers for the files in a folder (exposures, captures, ...), kept in memory.
+#
+# The folder's '.seq' file holds the highest number reserved so far, by any process.  A process reserves a
+#  block of numbers at a time (under an exclusive flock of '.seq.lock', the '.seq' file is rewritten
+#  atomically: a temporary file, then os.replace()), and hands them out from memory.  The numbers are
+#  unique and increasing, a process that ends without release() leaves a gap.
+#
+
+
+class _Block:
+    next: int       # the next number to hand out
+    limit: int      # the last number reserved
+
+    def __init__(self):
+        self.next = 1
+        self.limit = 0
+
+
+class SequenceAllocator:
+    _blocks: Dict[str, _Block]
+
+    def __init__(self, block: int = 64):
+        self.block = block
+        self._blocks = dict()
+        self._lock = threading.Lock()
+        self.reservations = 0       # file system round trips, so far
+        if hasattr(os, 'register_at_fork'):
+            # a forked child must not hand out its parent's numbers
+            os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        self._lock = threading.Lock()
+        self._blocks = dict()
+
+    @staticmethod
+    def _read(seq_file: str) -> int:
+        try:
+            with open(seq_file) as f:
+                return int(f.readline())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    @staticmethod
+    def _write(seq_file: str, value: int):
+        tmp_file = f"{seq_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(f'{value}\n')
+        os.replace(tmp_file, seq_file)
+
+    def _reserve(self, path: str, block: _Block, count: int):
+        os.makedirs(path, exist_ok=True)
+        seq_file = os.path.join(path, '.seq')
+        with open(seq_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                reserved = self._read(seq_file)
+                self._write(seq_file, reserved + count)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        block.next, block.limit = reserved + 1, reserved + count
+        self.reservations += 1
+
+    def next(self, path: str) -> int:
+        with self._lock:
+            block = self._blocks.get(path)
+            if block is None:
+                block = _Block()
+                self._blocks[path] = block
+            if block.next > block.limit:
+                self._reserve(path, block, self.block)
+            seq = block.next
+            block.next += 1
+            return seq
+
+    def release(self):
+        """
+        Gives the unused numbers back, where no other process reserved numbers after ours
+        """
+        with self._lock:
+            for path, block in self._blocks.items():
+                if block.next > block.limit:
+                    continue
+                seq_file = os.path.join(path, '.seq')
+                with open(seq_file + '.lock', 'a') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    try:
+                        if self._read(seq_file) == block.limit:
+                            self._write(seq_file, block.next - 1)
+                    finally:
+                        fcntl.flock(lock, fcntl.LOCK_UN)
+                block.limit = block.next - 1
+            self._blocks = dict()
+
+
+class DirectoryCache:
+    """
+    Remembers the directories it already made, so that only the first use of each costs an os.makedirs()
+    """
+    _made: Set[str]
+
+    def __init__(self):
+        self._made = set()
+
+    def ensure(self, directory: str) -> str:
+        if directory not in self._made:
+            os.makedirs(directory, exist_ok=True)
+            self._made.add(directory)
+        return directory
+
+    def forget(self):
+        self._made = set()
@@ -1,12 +1,21 @@
 from fastapi import APIRouter, Query
 from fastapi.responses import JSONResponse
 from utils import LAST_API_ROOT, init_log
+from telemetry import telemetry
+from startup import startup
 import socket
 import logging
 import httpx
 from enum import Enum
 import asyncio
 import xmltodict
+import datetime
+import time
+import math
+import json
+from typing import Callable, Dict, List, Optional
+from pydantic import BaseModel
+from starlette.responses import StreamingResponse
 
 default_sockets = {
     "Unknown1": False,
@@ -26,117 +35,221 @@ hostname = socket.gethostname()
 hostname = hostname[:-1]
 hostname = hostname.replace('last', 'pswitch')
 
+class PswitchSnapshot:
+    """
+    The state of a power switch, as last polled.  Never modified, a new one replaces it on every poll.
+    """
+    timestamp: datetime.datetime
+    sockets: dict
+    temp: float
+    ok: bool
+    error: Optional[str] = None    # why the poll failed
+
+    def __init__(self, sockets: dict, temp: float, ok: bool = True, error: Optional[str] = None):
+        self.timestamp = datetime.datetime.now()
+        self.sockets = sockets
+        self.temp = temp
+        self.ok = ok
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return {
+            'Timestamp': self.timestamp.isoformat(),
+            'Sockets': self.sockets,
+            'Temp': None if math.isnan(self.temp) else self.temp,     # NaN is not JSON
+            'Ok': self.ok,
+            'Error': self.error,
+        }
+
+
 class PswitchDriver():
     hostname: str
     ipaddr: str
-    base_url: str
+    base_url: str = None
     _auth = ("admin", "admin")
-    sockets: dict
-
-    def __init__(self, side: str) -> None:
+    _timeout = 5    # seconds
+    _confirm_timeout = 3    # seconds to wait for an outlet to reach the requested state
+    _confirm_interval = 0.1
+    snapshot: PswitchSnapshot
+    _names: list = None     # from st2.xml, practically never change, cached until invalidate_names()
+    _async_client: httpx.AsyncClient
+    _subscribers: list
+    polled: bool = False    # the first refresh (successful or not) is done
+
+    def __init__(self, side: str, base_url: str = None) -> None:
         # self.hostname = f"{hostname}{side}"
         self.hostname = f"pswitch02{side}"
-        try:
-            self.ipaddr = socket.gethostbyname(self.hostname)
-        except Exception as ex:
-             logger.exception(f"cannot get ipaddr for hostname={self.hostname}", exc_info=ex)
-             return
-        
-        self.base_url = f"http://{self.ipaddr}"        
-        self.refresh()
+        self.snapshot = PswitchSnapshot(sockets=default_sockets, temp=float('nan'), ok=False)
+        self._subscribers = list()
 
+        #
+        # A persistent (keep-alive) client, so that each refresh does not pay for a new connection.
+        # No network I/O here: the address is resolved, and the switch first read, by the poller
+        #
+        self._async_client = httpx.AsyncClient(auth=self._auth, timeout=self._timeout)
+        if base_url is not None:
+            self.base_url = base_url
 
-    async def getAsync(self, page: str = "/") -> str:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{self.base_url}/{page}", auth=self._auth, timeout=5)
-            if response.is_success:
-                return response.content
-            else:
-                pass
-
-    def get(self, page: str = "/") -> str:
-        with httpx.Client() as client:
-            response = client.get(f"{self.base_url}/{page}", auth=self._auth, timeout=5)
-            if response.is_success:
-                return response.content
-            else:
-                pass
+    @property
+    def sockets(self) -> dict:
+        return self.snapshot.sockets
+
+    def subscribe(self, callback: Callable) -> Callable:
+        """
+        Calls callback(event) for every change in the switch's state, returns a function that unsubscribes
+        """
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback) if callback in self._subscribers else None
+
+    def publish_changes(self, old: PswitchSnapshot, new: PswitchSnapshot):
+        events = list()
+        for name, state in new.sockets.items():
+            if old.sockets.get(name) != state:
+                events.append({'Switch': self.hostname, 'Socket': name, 'State': state})
+        if old.temp != new.temp and not (math.isnan(old.temp) and math.isnan(new.temp)):
+            events.append({'Switch': self.hostname, 'Temp': new.temp})
+        for event in events:
+            event['Timestamp'] = new.timestamp.isoformat()
+            for callback in list(self._subscribers):
+                try:
+                    callback(event)
+                except Exception as ex:
+                    logger.exception(f"subscriber {callback} failed", exc_info=ex)
+
+    def update(self, snapshot: PswitchSnapshot):
+        old = self.snapshot
+        self.snapshot = snapshot
+        if snapshot.ok:
+            telemetry.record(f"{self.hostname}.temp", snapshot.temp)
+        self.publish_changes(old, snapshot)
 
+    async def getAsync(self, page: str = "/") -> str:
+        response = await self._async_client.get(f"{self.base_url}/{page}")
+        if response.is_success:
+            return response.content
+        else:
+            pass
 
-    async def refreshAsync(self):
+    async def resolve(self) -> bool:
         try:
-            dynamic_xml = await self.getAsync(page='st0.xml')
+            addresses = await asyncio.get_running_loop().getaddrinfo(self.hostname, None, family=socket.AF_INET)
+            self.ipaddr = addresses[0][4][0]
         except Exception as ex:
-            logger.exception('HTTP Error', exc_info=ex)
-            self.sockets = default_sockets
-            self.temp = float('nan')
-            return        
-        static_xml = await self.getAsync(page='st2.xml')
-        self.parse(dynamic_xml=dynamic_xml, static_xml=static_xml)
+            logger.exception(f"cannot get ipaddr for hostname={self.hostname}", exc_info=ex)
+            return False
+        self.base_url = f"http://{self.ipaddr}"
+        return True
+
+    def invalidate_names(self):
+        """
+        Forgets the cached outlet names (st2.xml), the next refresh will fetch them again
+        """
+        self._names = None
 
 
-    def refresh(self):
+    async def refreshAsync(self):
         try:
-            dynamic_xml = self.get(page='st0.xml')
-        except Exception as ex:
-            logger.exception('HTTP Error', exc_info=ex)
-            self.sockets = default_sockets
-            self.temp = float('nan')
-            return        
-        static_xml = self.get(page='st2.xml')
-        self.parse(dynamic_xml=dynamic_xml, static_xml=static_xml)
-
-
-    def parse(self, dynamic_xml: str, static_xml: str):
-        self.sockets = dict()
-        d = xmltodict.parse(dynamic_xml)
-        dynamic_dict = d['response']
-        d = xmltodict.parse(static_xml)
-        static_dict = d['response']
-
-        for i in range(0, 6):
-            name = static_dict[f"r{i+6}"]
+            if self.base_url is None and not await self.resolve():
+                self.update(PswitchSnapshot(sockets=default_sockets, temp=float('nan'), ok=False,
+                                            error=f"cannot resolve '{self.hostname}'"))
+                return
+            try:
+                static_xml = None
+                if self._names is None:
+                    dynamic_xml, static_xml = await asyncio.gather(self.getAsync(page='st0.xml'),
+                                                                   self.getAsync(page='st2.xml'))
+                    if static_xml is None:
+                        raise Exception(f"no st2.xml from '{self.hostname}'")
+                else:
+                    dynamic_xml = await self.getAsync(page='st0.xml')
+                if dynamic_xml is None:     # not a 2xx reply
+                    raise Exception(f"no st0.xml from '{self.hostname}'")
+                if static_xml is not None:
+                    self.parse_names(static_xml=static_xml)
+                self.parse(dynamic_xml=dynamic_xml)
+            except Exception as ex:
+                logger.exception(f"{self.hostname}: refresh failed", exc_info=ex)
+                self.update(PswitchSnapshot(sockets=default_sockets, temp=float('nan'), ok=False, error=f"{ex}"))
+                return
+        finally:
+            self.polled = True
+
+
+    def parse_names(self, static_xml: str):
+        static_dict = xmltodict.parse(static_xml)['response']
+        self._names = [static_dict[f"r{i+6}"] for i in range(0, 6)]
+
+
+    def parse(self, dynamic_xml: str):
+        sockets = dict()
+        dynamic_dict = xmltodict.parse(dynamic_xml)['response']
+
+        for i, name in enumerate(self._names):
             state = True if dynamic_dict[f"out{i}"] == "1" else False
-            self.sockets[name] = state        
-        self.temp = float(dynamic_dict["ia1"]) / 10
+            sockets[name] = state
+        self.update(PswitchSnapshot(sockets=sockets, temp=float(dynamic_dict["ia1"]) / 10))
 
 
     async def get_names(self) -> list:
-        await self.refreshAsync()
         return [str(k) for k in self.sockets.keys()]
     
     @property
     async def names(self) -> list:
         names = await self.get_names()
         return names
-    
-    async def turnOn(self, socket_name: str) -> str:
+
+    async def set_sockets(self, states: Dict[str, Optional[bool]]) -> Dict[str, dict]:
+        """
+        Sets sockets to the requested states (a None state toggles the socket), all at once, and waits
+         for the switch to confirm them.  One st0.xml read confirms all the sockets.
+        Returns, per socket, the confirmed state and how long the transition took.
+        """
         names = list(self.sockets.keys())
-        if socket_name not in names:
-            raise Exception(f"Bad socket name '{socket_name}'")
-        idx = names.index(socket_name)
-        await self.getAsync(page=f"/outs.cgi?out{idx}=1")
-        return "ok"
+        wanted = dict()
+        for socket_name, state in states.items():
+            if socket_name not in names:
+                raise Exception(f"Bad socket name '{socket_name}'")
+            wanted[socket_name] = (not self.sockets[socket_name]) if state is None else state
+
+        start = time.monotonic()
+        await asyncio.gather(*[self.getAsync(page=f"outs.cgi?out{names.index(name)}={1 if state else 0}")
+                               for name, state in wanted.items()])
+        results = dict()
+        while True:
+            await self.refreshAsync()
+            latency = time.monotonic() - start
+            for name, state in wanted.items():
+                if name not in results and self.sockets.get(name) == state:
+                    results[name] = {'Value': state, 'Confirmed': True, 'Latency': latency}
+            if len(results) == len(wanted):
+                return results
+            if latency >= self._confirm_timeout:
+                for name, state in wanted.items():
+                    if name not in results:
+                        logger.error(f"{self.hostname}: socket '{name}' did not become {state} within {latency:.3f} sec")
+                        results[name] = {'Value': self.sockets.get(name), 'Confirmed': False, 'Latency': latency}
+                return results
+            await asyncio.sleep(self._confirm_interval)
+
+    async def set_socket(self, socket_name: str, state: bool = None) -> dict:
+        """
+        Sets a socket to the requested state (state=None toggles it) and waits for the switch to confirm it.
+        """
+        results = await self.set_sockets({socket_name: state})
+        return results[socket_name]
+
+    async def turnOn(self, socket_name: str) -> dict:
+        return await self.set_socket(socket_name, True)
     
-    async def turnOff(self, socket_name: str) -> str:
-        names = list(self.sockets.keys())
-        if socket_name not in names:
-            raise Exception(f"Bad socket name '{socket_name}'")
-        idx = names.index(socket_name)
-        await self.getAsync(page=f"/outs.cgi?out{idx}=0")
-        return "ok"
+    async def turnOff(self, socket_name: str) -> dict:
+        return await self.set_socket(socket_name, False)
     
-    async def toggle(self, socket_name: str) -> str:
-        names = list(self.sockets.keys())
-        if socket_name not in names:
-            raise Exception(f"Bad socket name '{socket_name}'")
-        idx = names.index(socket_name)
-        await self.getAsync(page=f"/outs.cgi?out={idx}")
-        return "ok"
+    async def toggle(self, socket_name: str) -> dict:
+        return await self.set_socket(socket_name, None)
     
-    async def temp(self) -> float:
-        await self.refreshAsync()
-        return self.temp
+    async def temp(self) -> Optional[float]:
+        temp = self.snapshot.temp
+        return None if math.isnan(temp) else temp
 
 
 pswitch = {
@@ -145,10 +258,54 @@ pswitch = {
 }
 
 
+async def refresh_all():
+    """
+    Refreshes the east and west switches concurrently
+    """
+    await asyncio.gather(*[ps.refreshAsync() for ps in pswitch.values()])
+
+
+poll_interval = 2   # seconds
+poller_task: asyncio.Task = None
+
+
+async def poll():
+    """
+    Keeps the switches' snapshots fresh, so that reads are answered from memory
+    """
+    while True:
+        try:
+            await refresh_all()
+        except Exception as ex:
+            logger.exception("poller failed", exc_info=ex)
+        await asyncio.sleep(poll_interval)
+
+
+def start_poller():
+    global poller_task
+    if poller_task is None:
+        poller_task = asyncio.get_running_loop().create_task(poll())
+
+
+def stop_poller():
+    global poller_task
+    if poller_task is not None:
+        poller_task.cancel()
+        poller_task = None
+
+
 class ValidSides(str, Enum):
     east = "e",
     west = "w",
 
+
+async def socket_response(operation: Callable, socket_name: str) -> JSONResponse:
+    try:
+        return JSONResponse(await operation(socket_name))
+    except Exception as ex:
+        return JSONResponse({'Error': f"{ex}"})
+
+
 #
 # The functions below come in (east|west)_xxx pairs.  It looks like repetitive code but
 #  since they are used by the openapi to extract number of parameters and their types
@@ -167,60 +324,73 @@ async def west_names() -> str:
     return JSONResponse(names)
 
         
+# invalidate
+async def east_invalidate() -> str:
+    pswitch["e"].invalidate_names()
+    await pswitch["e"].refreshAsync()
+    return JSONResponse(list(pswitch["e"].sockets.keys()))
+
+
+async def west_invalidate() -> str:
+    pswitch["w"].invalidate_names()
+    await pswitch["w"].refreshAsync()
+    return JSONResponse(list(pswitch["w"].sockets.keys()))
+
+
 # isOn
-async def east_isOn(socket_name: str = Query(enum=list(pswitch["e"].sockets.keys()))) -> str:
-    ps = pswitch["e"]
-    await asyncio.sleep(0)
-    if socket_name in list(ps.sockets.keys()):
-        return JSONResponse(ps.sockets[socket_name])
+async def east_isOn(socket_name: str = Query(description="One of the socket names (see names)")) -> str:
+    sockets = pswitch["e"].sockets
+    if socket_name in sockets:
+        return JSONResponse(sockets[socket_name])
+    return JSONResponse({'Error': f"Bad socket name '{socket_name}'"})
 
         
-async def west_isOn(socket_name: str = Query(enum=list(pswitch["w"].sockets.keys()))) -> str:
-    ps = pswitch["w"]
-    await asyncio.sleep(0)
-    if socket_name in list(ps.sockets.keys()):
-        return JSONResponse(ps.sockets[socket_name])
+async def west_isOn(socket_name: str = Query(description="One of the socket names (see names)")) -> str:
+    sockets = pswitch["w"].sockets
+    if socket_name in sockets:
+        return JSONResponse(sockets[socket_name])
+    return JSONResponse({'Error': f"Bad socket name '{socket_name}'"})
 
 
 # turnOn
-async def east_turnOn(socket_name: str = Query(enum=list(pswitch["e"].sockets.keys()))) -> str:
-    await asyncio.sleep(0)
-    return JSONResponse(pswitch["e"].turnOn(socket_name))
+async def east_turnOn(socket_name: str = Query(description="One of the socket names (see names)")) -> str:
+    return await socket_response(pswitch["e"].turnOn, socket_name)
 
         
-async def west_turnOn(socket_name: str = Query(enum=list(pswitch["w"].sockets.keys()))) -> str:
-    await asyncio.sleep(0)
-    return JSONResponse(pswitch["w"].turnOn(socket_name))
+async def west_turnOn(socket_name: str = Query(description="One of the socket names (see names)")) -> str:
+    return await socket_response(pswitch["w"].turnOn, socket_name)
 
 # turnOff
-async def east_turnOff(socket_name: str = Query(enum=list(pswitch["e"].sockets.keys()))) -> str:
-    await asyncio.sleep(0)
-    return JSONResponse(pswitch["e"].turnOff(socket_name))
+async def east_turnOff(socket_name: str = Query(description="One of the socket names (see names)")) -> str:
+    return await socket_response(pswitch["e"].turnOff, socket_name)
 
         
-async def west_turnOff(socket_name: str = Query(enum=list(pswitch["w"].sockets.keys()))) -> str:
-    await asyncio.sleep(0)
-    return JSONResponse(pswitch["w"].turnOff(socket_name))
+async def west_turnOff(socket_name: str = Query(description="One of the socket names (see names)")) -> str:
+    return await socket_response(pswitch["w"].turnOff, socket_name)
 
 # toggle
-async def east_toggle(socket_name: str = Query(enum=list(pswitch["e"].sockets.keys()))) -> str:
-    await asyncio.sleep(0)
-    return JSONResponse(pswitch["e"].toggle(socket_name))
+async def east_toggle(socket_name: str = Query(description="One of the socket names (see names)")) -> str:
+    return await socket_response(pswitch["e"].toggle, socket_name)
 
         
-async def west_toggle(socket_name: str = Query(enum=list(pswitch["w"].sockets.keys()))) -> str:
-    await asyncio.sleep(0)
-    return JSONResponse(pswitch["w"].toggle(socket_name))
+async def west_toggle(socket_name: str = Query(description="One of the socket names (see names)")) -> str:
+    return await socket_response(pswitch["w"].toggle, socket_name)
 
 # temp
 async def east_temp() -> str:
-    await asyncio.sleep(0)
-    return JSONResponse(pswitch["e"].temp())
+    return JSONResponse(await pswitch["e"].temp())
 
         
 async def west_temp() -> str:
-    await asyncio.sleep(0)
-    return JSONResponse(pswitch["w"].temp())
+    return JSONResponse(await pswitch["w"].temp())
+
+# snapshot
+async def east_snapshot() -> str:
+    return JSONResponse({'Value': pswitch["e"].snapshot.to_dict()})
+
+
+async def west_snapshot() -> str:
+    return JSONResponse({'Value': pswitch["w"].snapshot.to_dict()})
 
 
 for side in pswitch.keys():
@@ -233,3 +403,117 @@ for side in pswitch.keys():
     router.add_api_route(path=base_url + "/turnOff", tags = [tag], endpoint=east_turnOff  if side == "e" else west_turnOff)
     router.add_api_route(path=base_url + "/toggle",  tags = [tag], endpoint=east_toggle   if side == "e" else west_toggle)
     router.add_api_route(path=base_url + "/temp",    tags = [tag], endpoint=east_temp     if side == "e" else west_temp)
+    router.add_api_route(path=base_url + "/invalidate", tags = [tag], endpoint=east_invalidate if side == "e" else west_invalidate)
+    router.add_api_route(path=base_url + "/snapshot", tags = [tag], endpoint=east_snapshot if side == "e" else west_snapshot)
+    startup.gate(base_url + "/", lambda ps=pswitch[side]: ps.polled)
+
+startup.gate(LAST_API_ROOT + 'pswitch/', lambda: all([ps.polled for ps in pswitch.values()]))
+
+
+@router.get(LAST_API_ROOT + 'pswitch/events', tags=['pswitch'])
+async def pswitch_events():
+    """
+    Streams (as server-sent events) the changes in the state of both power switches, as seen by the poller
+    """
+    queue = asyncio.Queue(maxsize=100)
+
+    def on_event(event: dict):
+        if not queue.full():
+            queue.put_nowait(event)
+
+    unsubscribers = [ps.subscribe(on_event) for ps in pswitch.values()]
+
+    async def stream():
+        try:
+            while True:
+                event = await queue.get()
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            for unsubscribe in unsubscribers:
+                unsubscribe()
+
+    return StreamingResponse(stream(), media_type='text/event-stream')
+
+
+class PowerOperation(BaseModel):
+    side: ValidSides
+    socket: str
+    state: Optional[bool] = None    # None toggles the socket
+    after: List[str] = []           # '<side>:<socket>' of the operations that must be done before this one
+
+    @property
+    def key(self) -> str:
+        return f"{self.side.value}:{self.socket}"
+
+
+class PowerBulkRequest(BaseModel):
+    operations: List[PowerOperation]
+    step_delay: float = 0           # seconds between consecutive steps, to limit inrush currents
+
+
+def power_steps(operations: List[PowerOperation]) -> List[List[PowerOperation]]:
+    """
+    Orders the operations into steps.  The operations in a step do not depend on each other, each
+     operation comes in a step later than all of those it depends on.
+    """
+    pending = {op.key: op for op in operations}
+    if len(pending) != len(operations):
+        raise Exception("Duplicate operations on the same socket")
+    for op in operations:
+        for dependency in op.after:
+            if dependency not in pending:
+                raise Exception(f"Operation '{op.key}' depends on unknown operation '{dependency}'")
+
+    steps = list()
+    done = set()
+    while pending:
+        step = [op for op in pending.values() if all(dependency in done for dependency in op.after)]
+        if not step:
+            raise Exception(f"Cyclic dependencies between operations {list(pending.keys())}")
+        for op in step:
+            del pending[op.key]
+        done.update([op.key for op in step])
+        steps.append(step)
+    return steps
+
+
+async def power_bulk(operations: List[PowerOperation], step_delay: float = 0) -> dict:
+    """
+    Applies many socket operations on both switches.  The operations in a step are sent concurrently,
+     all of a switch's sockets in a step are confirmed by the same reads, consecutive steps are
+     separated by step_delay seconds.
+    """
+    start = time.monotonic()
+    steps = power_steps(operations)
+    results = dict()
+    for i, step in enumerate(steps):
+        if i > 0 and step_delay > 0:
+            await asyncio.sleep(step_delay)
+
+        per_side: Dict[str, Dict[str, Optional[bool]]] = dict()
+        for op in step:
+            per_side.setdefault(op.side.value, dict())[op.socket] = op.state
+        sides = list(per_side.keys())
+        step_results = await asyncio.gather(*[pswitch[side].set_sockets(per_side[side]) for side in sides])
+        for side, side_results in zip(sides, step_results):
+            for socket_name, result in side_results.items():
+                result['Step'] = i
+                results[f"{side}:{socket_name}"] = result
+
+    return {
+        'Value': results,
+        'Confirmed': all(r['Confirmed'] for r in results.values()),
+        'Steps': len(steps),
+        'Duration': time.monotonic() - start,
+    }
+
+
+@router.post(LAST_API_ROOT + 'pswitch/bulk', tags=['pswitch'])
+async def pswitch_bulk(request: PowerBulkRequest):
+    """
+    Turns many sockets, on both power switches, on/off in (optionally) dependent steps
+    """
+    try:
+        return JSONResponse(await power_bulk(request.operations, step_delay=request.step_delay))
+    except Exception as ex:
+        return JSONResponse({'Error': f"{ex}"})
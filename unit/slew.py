@@ -0,0 +1,72 @@
+import math
+import time
+from typing import Optional, Tuple
+
+from validations import ValidCoordSystems
+
+#
+# The mount status fields holding the current position, per coordinate system
+#
+position_fields = {
+    ValidCoordSystems.eq: ('RA', 'Dec'),
+    ValidCoordSystems.ha: ('HA', 'Dec'),
+    ValidCoordSystems.hor: ('Az', 'Alt'),
+    ValidCoordSystems.azalt: ('Az', 'Alt'),
+}
+
+
+def mount_position(status: object, coord_system: ValidCoordSystems) -> Optional[Tuple[float, float]]:
+    """
+    Extracts the mount's position (degrees) in the given coordinate system, None if the status does not have it
+    """
+    fields = position_fields[coord_system]
+    values = list()
+    for field in fields:
+        value = status.get(field) if isinstance(status, dict) else getattr(status, field, None)
+        if not isinstance(value, (int, float)):
+            return None
+        values.append(float(value))
+    return values[0], values[1]
+
+
+def angular_distance(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    """
+    Great-circle distance (degrees) between two (longitude-like, latitude-like) positions, in degrees
+    """
+    lon1, lat1, lon2, lat2 = [math.radians(v) for v in (*a, *b)]
+    cos_distance = math.sin(lat1) * math.sin(lat2) + math.cos(lat1) * math.cos(lat2) * math.cos(lon1 - lon2)
+    return math.degrees(math.acos(max(-1.0, min(1.0, cos_distance))))
+
+
+class SlewTracker:
+    """
+    Estimates the time of arrival from successive positions.  Until the mount is seen moving, the
+     nominal slew rate is used.
+    """
+    target: Tuple[float, float]
+    nominal_rate: float         # degrees per second
+    rate: float
+    _last: Optional[Tuple[float, Tuple[float, float]]] = None
+
+    def __init__(self, target: Tuple[float, float], nominal_rate: float = 5.0):
+        self.target = target
+        self.nominal_rate = nominal_rate
+        self.rate = nominal_rate
+
+    def update(self, position: Optional[Tuple[float, float]]) -> dict:
+        if position is None:
+            return {'Position': None, 'Distance': None, 'ETA': None}
+
+        now = time.monotonic()
+        distance = angular_distance(position, self.target)
+        if self._last is not None:
+            elapsed = now - self._last[0]
+            moved = angular_distance(self._last[1], position)
+            if elapsed > 0 and moved > 0:
+                self.rate = 0.5 * self.rate + 0.5 * (moved / elapsed)    # smoothed
+        self._last = (now, position)
+        return {
+            'Position': list(position),
+            'Distance': distance,
+            'ETA': distance / self.rate if self.rate > 0 else None,
+        }
@@ -0,0 +1,115 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from utils import LAST_API_ROOT, init_log, jsonResponse
+
+logger = logging.getLogger('unit-startup')
+init_log(logger)
+
+startup_router = APIRouter()
+
+#
+# The unit server starts serving right away and creates its devices in the background (see unit-server.py).
+#  Until a part of the API is ready its routes answer {"Error": "initializing"} (status 503), without
+#  reaching code that would need devices that do not exist yet.
+#
+# The startup profile (unit/startup) has the time of each phase, counted from when unit-server.py started
+#  importing.  For a per-module import profile run: python3 -X importtime unit/unit-server.py
+#
+
+
+class Startup:
+    state: str = 'initializing'     # 'initializing', 'ready' or 'failed'
+    error: Optional[str] = None
+    phases: Dict[str, Tuple[float, float]]     # name -> (started, duration), seconds since start
+    _gates: List[Tuple[str, Callable[[], bool]]]    # (path prefix, is ready), longest prefix first
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = dict()
+        self._gates = list()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    @contextmanager
+    def phase(self, name: str):
+        started = self.elapsed()
+        try:
+            yield
+        finally:
+            self.phases[name] = (started, self.elapsed() - started)
+            logger.info(f"startup: {name} took {self.phases[name][1]:.3f} seconds")
+
+    def mark(self, name: str):
+        """
+        A phase that ends now, started when the previous one ended
+        """
+        started = max([s + d for s, d in self.phases.values()], default=0)
+        self.phases[name] = (started, self.elapsed() - started)
+        logger.info(f"startup: {name} at {self.elapsed():.3f} seconds")
+
+    def ready(self):
+        self.state = 'ready'
+        logger.info(f"startup: ready after {self.elapsed():.3f} seconds")
+
+    def failed(self, ex: Exception):
+        self.state = 'failed'
+        self.error = f"{ex}"
+        logger.exception(f"startup: failed after {self.elapsed():.3f} seconds", exc_info=ex)
+
+    def gate(self, prefix: str, is_ready: Callable[[], bool]):
+        """
+        Routes under prefix are answered only once is_ready() (the longest matching prefix decides)
+        """
+        self._gates.append((prefix, is_ready))
+        self._gates.sort(key=lambda g: len(g[0]), reverse=True)
+
+    def is_ready(self, path: str) -> bool:
+        for prefix, is_ready in self._gates:
+            if path.startswith(prefix):
+                return is_ready()
+        return True
+
+    def to_dict(self) -> dict:
+        return {
+            'State': self.state,
+            'Error': self.error,
+            'Elapsed': self.elapsed(),
+            'Phases': {name: {'Started': s, 'Duration': d} for name, (s, d) in self.phases.items()},
+        }
+
+
+startup = Startup()
+startup.gate(LAST_API_ROOT, lambda: startup.state == 'ready')
+for always_ready in ['admin/', 'unit/startup', 'unit/telemetry', 'unit/capture', 'unit/images']:
+    startup.gate(LAST_API_ROOT + always_ready, lambda: True)
+
+
+class StartupMiddleware:
+    """
+    An ASGI middleware that answers the requests for parts of the API that are not ready yet
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or startup.is_ready(scope['path']):
+            return await self.app(scope, receive, send)
+
+        if startup.state == 'failed':
+            response = JSONResponse({"Error": f"startup failed: {startup.error}"}, status_code=503)
+        else:
+            response = JSONResponse({"Error": "initializing"}, status_code=503, headers={'Retry-After': '1'})
+        await response(scope, receive, send)
+
+
+# Method 'startup'
+@startup_router.get(LAST_API_ROOT + 'unit/startup', tags=["unit"])
+async def unit_startup():
+    return jsonResponse({"Value": startup.to_dict()})
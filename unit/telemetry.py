@@ -0,0 +1,220 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from fastapi import APIRouter
+
+from utils import LAST_API_ROOT, init_log, jsonResponse, path_maker, RepeatTimer
+
+logger = logging.getLogger('unit-telemetry')
+init_log(logger)
+
+telemetry_router = APIRouter()
+
+#
+# Each channel is stored, per day, as two packed float64 columns, appended to:
+#   <top>/<YYYY-MM-DD>/telemetry/<channel>.time   - seconds since the epoch
+#   <top>/<YYYY-MM-DD>/telemetry/<channel>.value
+#
+time_suffix = '.time'
+value_suffix = '.value'
+item_size = np.dtype(np.float64).itemsize
+
+
+class TelemetryStore:
+    """
+    An append-only, column-oriented store of numeric channels (temperatures, positions, activity bits ...).
+
+    Recording only appends to in-memory buffers, a timer thread appends them to the daily files.
+    Reads memory-map the daily files and binary-search the (ordered) time column.
+    """
+    top_folder: str
+    _buffers: Dict[str, Tuple[array, array]]
+    recorded: int = 0
+    flushed: int = 0
+
+    def __init__(self, top_folder: str = None, flush_interval: float = 5):
+        self.top_folder = top_folder if top_folder is not None else path_maker.top_folder
+        self._buffers = dict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.timer = RepeatTimer(name="telemetry-flusher-thread", interval=flush_interval, function=self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def record(self, channel: str, value, timestamp: float = None):
+        """
+        Cheap enough to be called from the probe and status paths, non-numeric values are ignored
+        """
+        if isinstance(value, bool):
+            value = float(value)
+        elif not isinstance(value, (int, float)):
+            return
+        with self._lock:
+            buffer = self._buffers.get(channel)
+            if buffer is None:
+                buffer = (array('d'), array('d'))
+                self._buffers[channel] = buffer
+            buffer[0].append(time.time() if timestamp is None else timestamp)
+            buffer[1].append(value)
+            self.recorded += 1
+
+    def folder(self, day: datetime.date) -> str:
+        return os.path.join(self.top_folder, day.strftime('%Y-%m-%d'), 'telemetry')
+
+    @staticmethod
+    def file_name(channel: str) -> str:
+        return channel.replace(os.sep, '_').replace(' ', '_')
+
+    def flush(self):
+        with self._lock:
+            buffers, self._buffers = self._buffers, dict()
+        if not buffers:
+            return
+
+        with self._flush_lock:
+            for channel, (times, values) in buffers.items():
+                try:
+                    self.append(channel, times, values)
+                except Exception as ex:
+                    logger.exception(f"could not write channel '{channel}'", exc_info=ex)
+
+    def append(self, channel: str, times: array, values: array):
+        start = 0
+        while start < len(times):
+            day = datetime.date.fromtimestamp(times[start])
+            midnight = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()).timestamp()
+            end = start
+            while end < len(times) and times[end] < midnight:
+                end += 1
+
+            folder = self.folder(day)
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, self.file_name(channel))
+            with open(path + value_suffix, 'ab') as f:
+                values[start:end].tofile(f)
+            with open(path + time_suffix, 'ab') as f:     # last, readers trust the time column's length
+                times[start:end].tofile(f)
+            self.flushed += end - start
+            start = end
+
+    def channels(self, day: datetime.date = None) -> List[str]:
+        if day is None:
+            day = datetime.date.today()
+        names = set()
+        folder = self.folder(day)
+        if os.path.isdir(folder):
+            names.update([f[:-len(time_suffix)] for f in os.listdir(folder) if f.endswith(time_suffix)])
+        with self._lock:
+            names.update([self.file_name(c) for c in self._buffers])
+        return sorted(names)
+
+    def read(self, channel: str, start: float, end: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The samples of a channel with start <= time < end, from the files and the unflushed buffer
+        """
+        times, values = list(), list()
+        day = datetime.date.fromtimestamp(start)
+        while day <= datetime.date.fromtimestamp(end):
+            path = os.path.join(self.folder(day), self.file_name(channel))
+            day += datetime.timedelta(days=1)
+            if not os.path.exists(path + time_suffix):
+                continue
+            n = os.path.getsize(path + time_suffix) // item_size
+            n = min(n, os.path.getsize(path + value_suffix) // item_size)
+            if n == 0:
+                continue
+            t = np.memmap(path + time_suffix, dtype=np.float64, mode='r', shape=(n,))
+            v = np.memmap(path + value_suffix, dtype=np.float64, mode='r', shape=(n,))
+            first, last = np.searchsorted(t, [start, end])
+            times.append(np.array(t[first:last]))
+            values.append(np.array(v[first:last]))
+
+        with self._lock:
+            buffer = self._buffers.get(channel)
+            if buffer is not None:
+                t = np.frombuffer(buffer[0], dtype=np.float64).copy()
+                v = np.frombuffer(buffer[1], dtype=np.float64).copy()
+        if buffer is not None:
+            first, last = np.searchsorted(t, [start, end])
+            times.append(t[first:last])
+            values.append(v[first:last])
+
+        if not times:
+            return np.empty(0), np.empty(0)
+        return np.concatenate(times), np.concatenate(values)
+
+    @staticmethod
+    def downsample(times: np.ndarray, values: np.ndarray, start: float, end: float, buckets: int) -> dict:
+        """
+        Per-bucket (equal time spans) count, mean, min and max, of the (ordered) samples.  Empty buckets are left out.
+        """
+        width = (end - start) / buckets
+        index = np.clip(((times - start) / width).astype(np.int64), 0, buckets - 1)
+        counts = np.bincount(index, minlength=buckets)
+        sums = np.bincount(index, weights=values, minlength=buckets)
+        occupied = np.nonzero(counts)[0]
+        firsts = np.searchsorted(index, occupied)
+        return {
+            'Time': (start + occupied * width).tolist(),
+            'Count': counts[occupied].tolist(),
+            'Mean': (sums[occupied] / counts[occupied]).tolist(),
+            'Min': np.minimum.reduceat(values, firsts).tolist() if len(firsts) else [],
+            'Max': np.maximum.reduceat(values, firsts).tolist() if len(firsts) else [],
+        }
+
+    def query(self, channel: str, start: float, end: float, buckets: int) -> dict:
+        times, values = self.read(channel, start, end)
+        result = {
+            'Channel': channel,
+            'Start': start,
+            'End': end,
+            'Samples': len(times),
+        }
+        if len(times) <= buckets:
+            result.update({'Time': times.tolist(), 'Value': values.tolist()})
+        else:
+            result.update(self.downsample(times, values, start, end, buckets))
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            buffered = sum([len(b[0]) for b in self._buffers.values()])
+        return {
+            'Recorded': self.recorded,
+            'Flushed': self.flushed,
+            'Buffered': buffered,
+        }
+
+
+telemetry = TelemetryStore()
+
+
+def on_activities_changed(owner, activities):
+    telemetry.record(f"{owner.activities_name()}.activities", int(activities))
+
+
+# Method 'telemetry' (channels)
+@telemetry_router.get(LAST_API_ROOT + 'unit/telemetry', tags=["unit"])
+async def unit_telemetry_channels(day: datetime.date = None):
+    return jsonResponse({"Value": {'Channels': telemetry.channels(day), 'Stats': telemetry.stats()}})
+
+
+# Method 'telemetry' (query)
+@telemetry_router.get(LAST_API_ROOT + 'unit/telemetry/{channel}', tags=["unit"])
+async def unit_telemetry_query(channel: str, start: datetime.datetime = None, end: datetime.datetime = None,
+                               buckets: int = 500):
+    """
+    The channel's samples between start and end (default: the last hour), downsampled to at most
+     'buckets' (count, mean, min, max) points
+    """
+    end_time = end.timestamp() if end is not None else time.time()
+    start_time = start.timestamp() if start is not None else end_time - 3600
+    if start_time >= end_time or buckets < 1:
+        return jsonResponse({"Error": f"Bad range ({start=}, {end=}, {buckets=})"})
+    return jsonResponse({"Value": telemetry.query(channel, start_time, end_time, buckets)})
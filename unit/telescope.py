@@ -1,6 +1,12 @@
+import json
 import sys
 from pathlib import Path
-from utils import TriState
+import time
+from typing import Dict, List, Optional
+
+from fastapi.responses import Response
+
+from utils import call_to_completion, response_error
 
 parent_dir = str(Path(__file__).resolve().parent.parent)
 sys.path.append(parent_dir)
@@ -10,39 +16,159 @@ from activities import Activities
 class Telescope(Activities):
     focuser = None
     camera = None
-    focuser_status: None
-    camera_status: None
-    focuser_future: None
-    camera_future: None
 
     def __init__(self, id, focuser, camera):
         super().__init__()
         self.id = id
         self.focuser = focuser
         self.camera = camera
-        self.focuser_status = None
-        self.camera_status = None
 
-    @property
-    def operational(self) -> TriState:
-        fstat = self.focuser_status
-        cstat = self.camera_status
-        ret: TriState = False
+    def activities_name(self) -> str:
+        return f"telescope-{self.id}"
+
+    #
+    # The unit-level operations (autofocus, slew preparation) drive the focusers through these, so that the
+    #  device-method names are known in a single place
+    #
+    def focuser_value(self, name: str) -> object:
+        """
+        One of the focuser's getters (e.g. 'Pos', 'Activities'), fed by its probes (see lipp.py), None on errors
+        """
+        reply = status_dict(call_to_completion(self.focuser.get, name))
+        if reply is None or response_error(reply) is not None:
+            return None
+        return reply.get('Value')
+
+    def focuser_position(self) -> Optional[float]:
+        return self.focuser_value('Pos')
+
+    def move_focuser(self, position: float) -> Optional[str]:
+        """
+        Starts moving the focuser, returns the device's error (if any)
+        """
+        return response_error(call_to_completion(self.focuser.move, position=position))
+
+    def wait_for_focuser(self, timeout: float, interval: float = 0.2) -> bool:
+        give_up = time.monotonic() + timeout
+        while time.monotonic() < give_up:
+            activities = self.focuser_value('Activities')
+            if activities is not None and not activities:
+                return True
+            time.sleep(interval)
+        return False
 
-        ret = (fstat.operational if hasattr(fstat, 'operational') else False) and (cstat.operational if hasattr(cstat, 'operational') else False)
-        return ret
-    
-    def status(self) -> dict:
-        self.detected = self.focuser.detected and self.camera.detected
-        return {
-            "detected": self.detected,
-            "operational": self.operational,
-        }
-    
     def info(self):
         return {
             'Equipment': f"telescope-{self.id}",
             'Maker': "Celestron",
             'Model': 'RASA 11-inch',
         }
-    
\ No newline at end of file
+    
+
+def status_dict(status: object) -> Optional[dict]:
+    """
+    A device status as a dict, whether it came as a dict, a JSONResponse or an object
+    """
+    if status is None or isinstance(status, dict):
+        return status
+    if isinstance(status, Response):
+        try:
+            return json.loads(status.body)
+        except ValueError:
+            return None
+    if hasattr(status, 'dict'):
+        return status.dict()
+    return vars(status) if hasattr(status, '__dict__') else None
+
+
+def columns(rows: List[Optional[dict]]) -> dict:
+    """
+    Per-device dicts as per-field columns, one entry per device (None where the device has no such field).
+     Nested dicts become nested columns.
+    """
+    keys = dict.fromkeys([key for row in rows if row for key in row])
+    result = dict()
+    for key in keys:
+        values = [row.get(key) if row else None for row in rows]
+        if any([isinstance(value, dict) for value in values]):
+            result[key] = columns([value if isinstance(value, dict) else None for value in values])
+        else:
+            result[key] = values
+    return result
+
+
+class TelescopeArray:
+    """
+    The unit's telescopes, in topology order (see config['topology']).  Position i holds telescope ids[i]
+     and per-telescope values are kept in lists indexed the same way, not in per-telescope dicts.
+     Lists rather than numpy arrays: a unit has a handful of telescopes (four) and the values come from
+     per-device objects, so arrays would only add conversions.
+    """
+    ids: List[int]
+    telescopes: List[Telescope]
+    infos: Dict[str, list]          # static, per device kind
+    _positions: Dict[int, int]      # telescope id -> position
+
+    def __init__(self):
+        self.ids = list()
+        self.telescopes = list()
+        self.infos = dict()
+        self._positions = dict()
+
+    def make(self, ids: List[int], focusers: list, cameras: list):
+        self.ids = list(ids)
+        self.telescopes = [Telescope(id, focuser=focusers[id], camera=cameras[id]) for id in ids]
+        self._positions = {id: position for position, id in enumerate(ids)}
+        self.infos = {
+            'Telescopes': [t.info() for t in self.telescopes],
+            'Focusers': [t.focuser.info() for t in self.telescopes],
+            'Cameras': [t.camera.info() for t in self.telescopes],
+        }
+
+    def __len__(self) -> int:
+        return len(self.telescopes)
+
+    def __iter__(self):
+        return iter(self.telescopes)
+
+    def __getitem__(self, position: int) -> Telescope:
+        return self.telescopes[position]
+
+    def by_id(self, id: int) -> Telescope:
+        return self.telescopes[self._positions[id]]
+
+    @property
+    def focusers(self) -> list:
+        return [t.focuser for t in self.telescopes]
+
+    @property
+    def cameras(self) -> list:
+        return [t.camera for t in self.telescopes]
+
+    def status(self, focuser_statuses: List[Optional[dict]], camera_statuses: List[Optional[dict]]) -> dict:
+        """
+        The telescopes' status, as columns: one entry per telescope, in the order of 'Ids'
+        """
+        focusers_detected = [bool(t.focuser.detected) for t in self.telescopes]
+        cameras_detected = [bool(t.camera.detected) for t in self.telescopes]
+        operational = [bool(f and f.get('operational')) and bool(c and c.get('operational'))
+                       for f, c in zip(focuser_statuses, camera_statuses)]
+        detected = [f and c for f, c in zip(focusers_detected, cameras_detected)]
+        return {
+            'Ids': list(self.ids),
+            'Detected': detected,
+            'Operational': operational,
+            'AllDetected': all(detected),
+            'AllOperational': all(operational),
+            'Info': self.infos['Telescopes'],
+            'Focusers': {
+                'Info': self.infos['Focusers'],
+                'Detected': focusers_detected,
+                'Status': columns(focuser_statuses),
+            },
+            'Cameras': {
+                'Info': self.infos['Cameras'],
+                'Detected': cameras_detected,
+                'Status': columns(camera_statuses),
+            },
+        }
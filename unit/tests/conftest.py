@@ -0,0 +1,11 @@
+import sys
+from pathlib import Path
+
+#
+# The unit server's modules import each other by their bare names (they run from the unit folder), and
+#  some of them import the top-level ones (e.g. activities)
+#
+unit_dir = Path(__file__).resolve().parent.parent
+for folder in (unit_dir, unit_dir.parent):
+    if str(folder) not in sys.path:
+        sys.path.insert(0, str(folder))
@@ -0,0 +1,118 @@
+import gzip
+
+import numpy as np
+import pytest
+
+from fits import block_size, fits_types, write_fits
+
+
+def read_header(f) -> dict:
+    cards = dict()
+    while True:
+        block = f.read(block_size)
+        assert len(block) == block_size
+        for i in range(0, block_size, 80):
+            line = block[i:i + 80].decode('ascii')
+            if line.startswith('END'):
+                return cards
+            if line[8:10] == '= ':
+                value = line[10:].split(' / ')[0].strip()
+                if value.startswith("'"):
+                    value = value[1:].rsplit("'", 1)[0].replace("''", "'").rstrip()
+                elif value in ('T', 'F'):
+                    value = value == 'T'
+                else:
+                    value = float(value) if any(c in value for c in '.E') else int(value)
+                cards[line[:8].strip()] = value
+
+
+def stored_dtype(cards: dict, bitpix_key: str) -> np.dtype:
+    return np.dtype({8: 'u1', 16: '>i2', 32: '>i4', -32: '>f4', -64: '>f8'}[cards[bitpix_key]])
+
+
+def unscaled(pixels: np.ndarray, cards: dict) -> np.ndarray:
+    if cards.get('BZERO'):
+        return pixels.astype(np.float64) + cards['BZERO']
+    return pixels
+
+
+def read_fits(path: str):
+    """
+    A minimal reader of what write_fits() writes: the image (as float64 when scaled) and its header
+    """
+    with open(path, 'rb') as f:
+        cards = read_header(f)
+        if cards['NAXIS'] == 2:
+            dtype = stored_dtype(cards, 'BITPIX')
+            count = cards['NAXIS1'] * cards['NAXIS2']
+            pixels = np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype)
+            return unscaled(pixels.reshape(cards['NAXIS2'], cards['NAXIS1']), cards), cards
+
+        cards = read_header(f)
+        assert cards['ZIMAGE'] is True
+        descriptors = np.frombuffer(f.read(cards['NAXIS1'] * cards['NAXIS2']), dtype='>i4').reshape(-1, 2)
+        heap = f.read(cards['PCOUNT'])
+        dtype = stored_dtype(cards, 'ZBITPIX')
+        rows = list()
+        for size, offset in descriptors:
+            raw = gzip.decompress(heap[offset:offset + size])
+            if cards['ZCMPTYPE'] == 'GZIP_2' and dtype.itemsize > 1:
+                raw = np.frombuffer(raw, dtype=np.uint8).reshape(dtype.itemsize, -1).T.tobytes()
+            rows.append(np.frombuffer(raw, dtype=dtype).reshape(-1, cards['ZNAXIS1']))
+        return unscaled(np.concatenate(rows), cards), cards
+
+
+def image(dtype: str, shape=(150, 97)) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        info = np.iinfo(dtype)
+        data = rng.integers(info.min, info.max, size=shape, endpoint=True, dtype=dtype)
+        data[0, :2] = [info.min, info.max]
+        return data
+    return rng.normal(1000, 50, size=shape).astype(dtype)
+
+
+@pytest.mark.parametrize('compression', [None, 'GZIP_1', 'GZIP_2'])
+@pytest.mark.parametrize('dtype', list(fits_types.keys()))
+def test_round_trip(tmp_path, dtype, compression):
+    path = str(tmp_path / 'frame.fits')
+    data = image(dtype)
+    size = write_fits(path, data, meta=[('Camera', 'camera-1'), ('ExpTime', 2.5), ('Gain', 3)],
+                      compression=compression, tile_rows=64)
+
+    assert size % block_size == 0
+    assert size == (tmp_path / 'frame.fits').stat().st_size
+    assert not (tmp_path / 'frame.fits.tmp').exists()
+
+    pixels, cards = read_fits(path)
+    assert pixels.shape == data.shape
+    np.testing.assert_array_equal(pixels, data)
+    assert cards['CAMERA'] == 'camera-1'
+    assert cards['EXPTIME'] == 2.5
+    assert cards['GAIN'] == 3
+
+
+def test_meta_does_not_override_structural_keys(tmp_path):
+    path = str(tmp_path / 'frame.fits')
+    write_fits(path, image('uint16'), meta=[('BITPIX', 8), ('naxis1', 1), ('a long name', 'x'), ('Long-Name', 'y')])
+    _, cards = read_fits(path)
+    assert cards['BITPIX'] == 16
+    assert cards['NAXIS1'] == 97
+    assert cards['A_LONG_N'] == 'x'
+    assert cards['LONG-NAM'] == 'y'
+
+
+def test_unsupported_dtype(tmp_path):
+    with pytest.raises(Exception):
+        write_fits(str(tmp_path / 'frame.fits'), np.zeros((4, 4), dtype=np.int64), meta=[])
+
+
+def test_astropy_reads_it(tmp_path):
+    fits = pytest.importorskip('astropy.io.fits')
+    data = image('uint16')
+    for compression, hdu in [(None, 0), ('GZIP_2', 1)]:
+        path = str(tmp_path / f'{compression}.fits')
+        write_fits(path, data, meta=[('Camera', 'camera-1')], compression=compression)
+        with fits.open(path) as hdus:
+            np.testing.assert_array_equal(hdus[hdu].data, data)
+            assert hdus[hdu].header['CAMERA'] == 'camera-1'
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from driver_interface import BackendRetired
+from registry import DeviceHandle
+
+
+class FakeDriver:
+    """
+    Answers every request with its name, after a delay.  Once retired, the requests it did not answer
+     raise BackendRetired (as the LIPP driver does for those it never sent).
+    """
+
+    def __init__(self, name: str, delay: float = 0.0):
+        self.name = name
+        self.delay = delay
+        self.retired = False
+        self.requests = list()
+
+    def retire(self, reason: str):
+        self.retired = True
+
+    def wait_ready(self, timeout: float) -> bool:
+        return True
+
+    async def request(self, verb: str, method: str, **kwargs) -> object:
+        self.requests.append((verb, method, kwargs))
+        give_up = time.monotonic() + self.delay
+        while time.monotonic() < give_up:
+            if self.retired:
+                raise BackendRetired(f"{self.name} retired")
+            await asyncio.sleep(0.01)
+        if self.retired:
+            raise BackendRetired(f"{self.name} retired")
+        return {'Value': self.name}
+
+    async def get(self, method: str, **kwargs) -> object:
+        return await self.request('get', method, **kwargs)
+
+    async def put(self, method: str, **kwargs) -> object:
+        return await self.request('put', method, **kwargs)
+
+
+policy = {'drain': 0.2, 'ready': 1, 'wait': 2, 'attempts': 3, 'retry': 0.2}
+
+
+def make_handle(backend: FakeDriver, make=None) -> DeviceHandle:
+    return DeviceHandle('camera-1', backend=backend, make=make or (lambda: FakeDriver('new')), policy=policy,
+                        commands=['abort', 'takeExposure'])
+
+
+def value(reply: object) -> object:
+    if not isinstance(reply, dict):
+        reply = json.loads(reply.body)
+    return reply.get('Value', reply.get('Error'))
+
+
+def swap_soon(handle: DeviceHandle, make, delay: float = 0.05) -> threading.Thread:
+    def swap():
+        time.sleep(delay)
+        handle.swap(make, 'test')
+
+    thread = threading.Thread(target=swap, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_unfinished_requests_are_retried_on_the_new_driver():
+    old, new = FakeDriver('old', delay=5), FakeDriver('new')
+    handle = make_handle(old)
+
+    async def main():
+        thread = swap_soon(handle, lambda: new)
+        reply = await handle.get('Status')
+        thread.join()
+        return reply
+
+    assert value(asyncio.run(main())) == 'new'
+    assert handle.retries == 1
+    assert handle.generation == 2
+    assert handle.history[-1].drained is False and handle.history[-1].unfinished == 1
+    assert len(old.requests) == 1 and len(new.requests) == 1
+
+
+def test_requests_wait_for_the_swap():
+    new = FakeDriver('new')
+
+    def slow_make():
+        time.sleep(0.3)
+        return new
+
+    handle = make_handle(FakeDriver('old'))
+
+    async def main():
+        thread = swap_soon(handle, slow_make, delay=0)
+        await asyncio.sleep(0.05)
+        assert handle.swapping
+        threads = threading.active_count()
+        replies = await asyncio.gather(*[handle.get('Status') for _ in range(50)])
+        assert threading.active_count() <= threads     # the waiters park no threads
+        thread.join()
+        return replies
+
+    assert {value(reply) for reply in asyncio.run(main())} == {'new'}
+    assert len(new.requests) == 50
+    assert handle.retries == 0
+
+
+def test_a_failed_swap_marks_the_handle_and_is_retried():
+    attempts = list()
+
+    def make():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise Exception("cannot start")
+        return FakeDriver('new')
+
+    handle = make_handle(FakeDriver('old'), make=make)
+    handle.restart('test')
+    assert handle.failed == 'cannot start'
+    assert handle.stats()['Failed'] == 'cannot start'
+    assert 'no working driver' in value(asyncio.run(handle.get('Status')))
+
+    give_up = time.monotonic() + 5
+    while handle.failed is not None and time.monotonic() < give_up:
+        time.sleep(0.05)
+    assert handle.failed is None
+    assert len(attempts) == 2
+    assert value(asyncio.run(handle.get('Status'))) == 'new'
+
+
+def test_a_busy_handle_does_not_swap_twice():
+    handle = make_handle(FakeDriver('old'))
+
+    def slow_make():
+        time.sleep(0.3)
+        return FakeDriver('new')
+
+    thread = swap_soon(handle, slow_make, delay=0)
+    time.sleep(0.05)
+    assert handle.swap(slow_make, 'another') is None
+    thread.join()
+    assert handle.generation == 2
+
+
+def test_only_the_commands_are_proxied():
+    driver = FakeDriver('old')
+    handle = make_handle(driver)
+    assert value(asyncio.run(handle.abort())) == 'old'
+    assert value(asyncio.run(handle.takeExposure(ExpTime=1))) == 'old'
+    assert driver.requests == [('put', 'abort', {}), ('put', 'takeExposure', {'ExpTime': 1})]
+    with pytest.raises(AttributeError):
+        handle.anything_else
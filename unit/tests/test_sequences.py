@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from sequences import SequenceAllocator
+
+
+def take(allocator: SequenceAllocator, path: str, count: int) -> list:
+    return [allocator.next(path) for _ in range(count)]
+
+
+def test_numbers_are_unique_and_increasing(tmp_path):
+    allocator = SequenceAllocator(block=4)
+    numbers = take(allocator, str(tmp_path), 10)
+    assert numbers == list(range(1, 11))
+    assert allocator.reservations == 3
+
+
+def test_allocators_share_the_folder(tmp_path):
+    first, second = SequenceAllocator(block=4), SequenceAllocator(block=4)
+    numbers = take(first, str(tmp_path), 3) + take(second, str(tmp_path), 3) + take(first, str(tmp_path), 3)
+    assert len(set(numbers)) == len(numbers)
+
+
+def test_release_gives_back_the_unused_numbers(tmp_path):
+    allocator = SequenceAllocator(block=64)
+    take(allocator, str(tmp_path), 3)
+    allocator.release()
+    assert take(SequenceAllocator(), str(tmp_path), 1) == [4]
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork()")
+def test_forked_children_do_not_reuse_the_parents_numbers(tmp_path):
+    path = str(tmp_path)
+    allocator = SequenceAllocator(block=64)
+    numbers = take(allocator, path, 2)     # the parent holds a block, most of it not handed out yet
+
+    children = list()
+    for _ in range(3):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_end)
+                os.write(write_end, ','.join(str(n) for n in take(allocator, path, 5)).encode())
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        children.append((pid, read_end))
+
+    for pid, read_end in children:
+        with os.fdopen(read_end) as f:
+            numbers += [int(n) for n in f.read().split(',')]
+        os.waitpid(pid, 0)
+    numbers += take(allocator, path, 5)
+
+    assert len(numbers) == 2 + 3 * 5 + 5
+    assert len(set(numbers)) == len(numbers)
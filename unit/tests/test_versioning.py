@@ -0,0 +1,102 @@
+import json
+
+from versioning import Replica, VersionedDocument, apply_delta, etag_matches, flatten
+
+
+def delta(document: VersionedDocument, since: int) -> dict:
+    return json.loads(document.since(since))
+
+
+def test_flatten_and_apply_delta():
+    document = {'a': 1, 'b': {'c': [1, 2], 'd/e': None, 'f': {}}}
+    assert flatten(document) == {'/a': 1, '/b/c': [1, 2], '/b/d~1e': None, '/b/f': {}}
+
+    changed = apply_delta(document, changed={'/b/c': [3], '/g/h': 'new', '/b/d~1e': 0}, removed=['/a', '/x/y'])
+    assert changed == {'b': {'c': [3], 'd/e': 0, 'f': {}}, 'g': {'h': 'new'}}
+    assert document['a'] == 1 and document['b']['c'] == [1, 2]     # not modified in place
+
+
+def test_versions_and_deltas():
+    document = VersionedDocument()
+    assert document.update({'a': 1, 'b': {'c': 2}})
+    first = document.version
+    assert not document.update({'a': 1, 'b': {'c': 2}})
+    assert document.version == first
+
+    assert document.update({'a': 1, 'b': {'c': 3, 'd': 4}})
+    assert document.update({'b': {'c': 3, 'd': 4}})
+    assert document.version == first + 2
+
+    assert delta(document, first) == {'Version': first + 2, 'Since': first,
+                                      'Changed': {'/b/c': 3, '/b/d': 4}, 'Removed': ['/a']}
+    assert delta(document, first + 1) == {'Version': first + 2, 'Since': first + 1, 'Changed': {}, 'Removed': ['/a']}
+    assert document.since(first + 3) is None        # from the future
+    assert json.loads(document.full()) == {'Value': {'b': {'c': 3, 'd': 4}}, 'Version': first + 2}
+
+
+def test_forgotten_removals_move_the_horizon():
+    document = VersionedDocument(max_removed=1)
+    document.update({'a': 1, 'b': 2, 'c': 3})
+    first = document.version
+    document.update({'c': 3})
+    assert document.since(first) is None
+    assert document.since(document.version) is not None
+
+
+def test_volatile_fields_do_not_make_versions():
+    document = VersionedDocument(volatile=['Timing'])
+    document.update({'a': 1, 'timing': {'ms': 1}})
+    version = document.version
+    assert not document.update({'a': 1, 'timing': {'ms': 2}})
+    assert document.version == version
+    assert json.loads(document.full())['Value']['timing'] == {'ms': 2}    # the latest values are served
+    assert document.etag == f'W/"{version}"'
+
+    document.update({'a': 2, 'timing': {'ms': 3}})
+    assert delta(document, version)['Changed'] == {'/a': 2, '/timing/ms': 3}
+
+
+def test_etag_matches():
+    assert etag_matches('"5"', '"5"')
+    assert etag_matches('W/"5"', '"5"')
+    assert etag_matches('"4", W/"5"', 'W/"5"')
+    assert etag_matches('*', '"5"')
+    assert not etag_matches('"4"', '"5"')
+    assert not etag_matches(None, '"5"')
+
+
+def test_replica_follows_the_document():
+    document, replica = VersionedDocument(), Replica()
+    document.update({'a': 1, 'b': {'c': 2}})
+    assert replica.params() == {} and replica.headers() == {}
+    assert replica.update(200, document.etag, document.full())['Value'] == {'a': 1, 'b': {'c': 2}}
+    assert replica.params() == {'since': document.version}
+    assert replica.headers() == {'If-None-Match': document.etag}
+
+    assert replica.update(304, document.etag, b'')['Value'] == {'a': 1, 'b': {'c': 2}}
+
+    document.update({'b': {'c': 3}})
+    reply = replica.update(200, document.etag, document.since(replica.version))
+    assert reply == {'Value': {'b': {'c': 3}}, 'Version': document.version}
+    assert replica.version == document.version
+
+
+def test_replica_refetches_on_a_delta_since_another_version():
+    document, replica = VersionedDocument(), Replica()
+    document.update({'a': 1})
+    replica.update(200, document.etag, document.full())
+    document.update({'a': 2})
+    stale = document.since(document.version - 1)
+    document.update({'a': 3})
+    replica.update(200, document.etag, document.since(replica.version))
+
+    # a crossed poll: the changes since a version the replica no longer has
+    assert replica.update(200, document.etag, stale) is None
+    assert replica.params() == {} and replica.headers() == {}
+    assert replica.update(200, document.etag, document.full())['Value'] == {'a': 3}
+
+
+def test_replica_resets_on_a_304_without_a_reply():
+    replica = Replica()
+    assert replica.update(304, '"1"', b'') is None
+    assert replica.params() == {} and replica.headers() == {}
@@ -0,0 +1,41 @@
+import time
+from contextvars import ContextVar
+
+#
+# Where a request's time went, accumulated while it is handled (see profiling.RouteTimingMiddleware).
+#  When route timing is disabled there is no current RequestTiming and add() returns right away.
+#
+
+
+class RequestTiming:
+    driver: float = 0           # seconds waiting for drivers (LIPP or forwarded)
+    serialization: float = 0    # seconds encoding responses
+
+    def add(self, kind: str, seconds: float):
+        setattr(self, kind, getattr(self, kind) + seconds)
+
+
+current_timing = ContextVar('current_timing', default=None)    # Optional[RequestTiming]
+
+
+def add(kind: str, seconds: float):
+    timing = current_timing.get()
+    if timing is not None:
+        timing.add(kind, seconds)
+
+
+class timed:
+    """
+    with timed('serialization'): ...
+    """
+    def __init__(self, kind: str):
+        self.kind = kind
+
+    def __enter__(self):
+        self.timing = current_timing.get()
+        if self.timing is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.timing is not None:
+            self.timing.add(self.kind, time.perf_counter() - self.start)
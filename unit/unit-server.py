@@ -1,43 +1,130 @@
-import datetime
+import asyncio
+import hashlib
+import importlib.machinery
+import importlib.util
 import os
 import signal
 
 import uvicorn
 from fastapi import FastAPI
 from utils import init_log  # , PrettyJSONResponse, HelpResponse, quote, Subsystem
+from startup import startup, StartupMiddleware, startup_router
 from contextlib import asynccontextmanager
 from socket import gethostname
 import logging
 from subprocess import Popen
+from starlette.concurrency import run_in_threadpool
 
 
 logger = logging.getLogger('last-unit-server')
 init_log(logger)
 
+if __name__ == '__main__':
+    # This script starts things when run, processes spawned by multiprocessing (the image writer's, see
+    #  image_writer.py) would run it again, as their __main__, unless it is named '__main__'
+    __spec__ = importlib.machinery.ModuleSpec('__main__', None)
+
 #
-# First we call the routers maker (MATLAB) which produces a python module file per
-#  each of the classes served by this FastApi server (focuser, camera, mount)
+# The routers maker (MATLAB) produces a python module file per each of the classes served by
+#  this FastApi server (focuser, camera, mount).
 #
-# We need to wait for it to finish before we can import the respective server.unit_router.<class>
-#  modules
+# When they do not exist yet we need to wait for it to finish before we can import the respective
+#  server.unit_router.<class> modules.  Otherwise the existing ones are used and they are remade in
+#  the background (see lifespan()), MATLAB takes too long to wait for on every start.
 #
 
 
 cmd = ['/usr/local/bin/matlab', '-batch', 'obs.api.ApiBase.makeAuxiliaryFiles']
 env = os.environ.copy()
 env['LANG'] = 'en_US'
-logger.info(f'calling MATLAB FastApi routers maker with "{cmd=}"')
-routers_maker = Popen(args=cmd, env=env)
-logger.info(f'Waiting for MATLAB FastApi routers maker')
-routers_maker.wait()
-if routers_maker.returncode == 0:
-    logger.info('FastApi routers maker succeeded!')
-else:
-    logger.error(f'FastApi routers maker died with rc={routers_maker.returncode}')
-    exit(routers_maker.returncode)
-
-from unit import unit_quit, unit_router
+routers_made = all([importlib.util.find_spec(f'server.routers.{name}') is not None
+                    for name in ['focuser', 'camera', 'mount']])
+if not routers_made:
+    with startup.phase('routers-maker'):
+        logger.info(f'calling MATLAB FastApi routers maker with "{cmd=}"')
+        routers_maker = Popen(args=cmd, env=env)
+        logger.info(f'Waiting for MATLAB FastApi routers maker')
+        routers_maker.wait()
+    if routers_maker.returncode == 0:
+        logger.info('FastApi routers maker succeeded!')
+    else:
+        logger.error(f'FastApi routers maker died with rc={routers_maker.returncode}')
+        exit(routers_maker.returncode)
+
+from unit import unit, unit_quit, unit_router, make_telescopes
+from frames import frames_router
+from image_writer import image_writer, images_router
+from quicklook import quicklook_router
+from telemetry import telemetry_router
+from capture import capture_router
 from server.routers import focuser, camera, mount, pswitch
+from deadlines import DeadlineMiddleware
+from versioning import VersionedStatusMiddleware
+from profiling import RouteTimingMiddleware, profiling_router
+from watchdog import loop_watchdog, watchdog_router
+from registry import registry_router
+from config import config as unit_config
+
+startup.mark('imports')
+
+
+def routers_digests() -> dict:
+    """
+    The digests of the MATLAB-made routers' files, by module name
+    """
+    digests = dict()
+    for module in [focuser, camera, mount]:
+        try:
+            with open(module.__file__, 'rb') as f:
+                digests[module.__name__] = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            digests[module.__name__] = None
+    return digests
+
+
+loaded_routers = routers_digests()     # as imported
+
+
+def make_devices():
+    """
+    Starts the device drivers (one LIPP process each).  Runs in the background, the routes that
+     need the devices answer "initializing" until it is done
+    """
+    focuser.make_focusers()
+    camera.make_cameras()
+    mount.make_mounts()
+    make_telescopes()
+    unit.start()
+
+
+async def initialize():
+    try:
+        with startup.phase('devices'):
+            await run_in_threadpool(make_devices)
+        startup.ready()
+    except Exception as ex:
+        startup.failed(ex)
+        return
+
+    if routers_made:
+        try:
+            with startup.phase('routers-maker'):
+                logger.info(f'calling MATLAB FastApi routers maker with "{cmd=}", in the background')
+                routers_maker = await asyncio.create_subprocess_exec(*cmd, env=env)
+                returncode = await routers_maker.wait()
+        except Exception as ex:
+            logger.exception('FastApi routers maker failed', exc_info=ex)
+            return
+        if returncode == 0:
+            current = routers_digests()
+            changed = [name for name in current if current[name] != loaded_routers[name]]
+            if changed:
+                logger.warning(f'FastApi routers maker changed {changed}, the server is still using the old ' +
+                               'ones, restart it to use the new ones')
+            else:
+                logger.info('FastApi routers maker succeeded, the routers did not change')
+        else:
+            logger.error(f'FastApi routers maker died with rc={returncode}')
 
 
 async def end_lifespan():
@@ -47,8 +134,16 @@ async def end_lifespan():
 
 @asynccontextmanager
 async def lifespan(fast_app: FastAPI):
-    pass
+    loop_watchdog.start()
+    image_writer.start()
+    pswitch.start_poller()
+    initializer = asyncio.get_running_loop().create_task(initialize())
+    startup.mark('serving')
     yield
+    initializer.cancel()
+    pswitch.stop_poller()
+    await image_writer.stop()
+    loop_watchdog.stop()
     await end_lifespan()
 
 app = FastAPI(
@@ -58,19 +153,31 @@ app = FastAPI(
     lifespan=lifespan,
     openapi_url='/openapi.json')
 
-app.include_router(pswitch.router)
+if unit_config['versioned_status']['enabled']:
+    app.add_middleware(VersionedStatusMiddleware, suffixes=unit_config['versioned_status']['suffixes'],
+                       max_removed=unit_config['versioned_status']['max_removed'],
+                       volatile=unit_config['versioned_status']['volatile'])
+app.add_middleware(StartupMiddleware)
+app.add_middleware(DeadlineMiddleware)
+RouteTimingMiddleware.enabled = unit_config['route_timing']
+app.add_middleware(RouteTimingMiddleware, routes=app.routes)
 
-focuser.make_focusers()
+app.include_router(pswitch.router)
 app.include_router(focuser.router)
-
-camera.make_cameras()
 app.include_router(camera.router)
-
-mount.make_mounts()
 app.include_router(mount.router)
 
 # TBD: unit_make_units() ...
 app.include_router(unit_router)
+app.include_router(frames_router)
+app.include_router(images_router)
+app.include_router(quicklook_router)
+app.include_router(telemetry_router)
+app.include_router(capture_router)
+app.include_router(profiling_router)
+app.include_router(watchdog_router)
+app.include_router(registry_router)
+app.include_router(startup_router)
 
 
 @app.get("/shutdown", tags=['last-unit-service'])
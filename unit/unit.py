@@ -1,21 +1,34 @@
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, Query, HTTPException
+from starlette.responses import StreamingResponse
 from utils import LAST_API_ROOT, PrettyJSONResponse, init_log
 import socket
 import logging
-from utils import RepeatTimer, jsonResponse
+from utils import RepeatTimer, jsonResponse, call_to_completion, response_error
 import lipp
 import os
-from typing import List
+from typing import List, Callable, Optional
+import asyncio
+import math
 from validations import ValidCoordSystems
-from telescope import Telescope
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from telescope import Telescope, TelescopeArray, status_dict
+from concurrent.futures import ThreadPoolExecutor, wait
+from starlette.concurrency import run_in_threadpool
+import time
 
 from server.routers.camera import cameras
 from server.routers.focuser import focusers
 from server.routers.mount import mounts, mount_abort, mount_goTo
 import sys
 from pathlib import Path
-from activities import Activities, UnitActivities, Idle
+from activities import Activities, UnitActivities, Idle, observers as activities_observers
+from telemetry import telemetry, on_activities_changed
+from exposure import UnitExposure
+from autofocus import Autofocus
+from operations import Operation, operations
+from slew import SlewTracker, mount_position
+import itertools
+import threading
+from config import config
 
 subprocesses = list()
 
@@ -37,14 +50,17 @@ peer_hostname = hostname[:-1] + peer_side
 parent_dir = str(Path(__file__).resolve().parent.parent)
 sys.path.append(parent_dir)
 
-mount = mounts[0]
-telescopes: List[Telescope] = [
-    None,  # skip zero, go MATLAB :-)
-    Telescope(1, focuser=focusers[1], camera=cameras[1]),
-    Telescope(2, focuser=focusers[2], camera=cameras[2]),
-    Telescope(3, focuser=focusers[3], camera=cameras[3]),
-    Telescope(4, focuser=focusers[4], camera=cameras[4]),
-    ]
+#
+# Made by make_telescopes(), once the devices exist (see unit-server.py's lifespan)
+#
+mount = None
+telescopes = TelescopeArray()
+
+
+def make_telescopes():
+    global mount
+    mount = mounts[0]
+    telescopes.make(ids=config['topology']['telescopes'], focusers=focusers, cameras=cameras)
 
 
 class Unit(Activities):
@@ -52,10 +68,26 @@ class Unit(Activities):
     timer: RepeatTimer
     _terminating = False
     _status_timeout: int  # how many seconds to wait for status requests
+    _abort_deadline: float  # how many seconds to wait for all the devices to acknowledge an abort
+    _slew_poll_interval = 0.5   # seconds
+    exposure: UnitExposure = None   # the latest exposure
+    autofocuser: Autofocus = None   # the latest autofocus
 
-    def __init__(self, status_timeout=5) -> None:
+    def __init__(self, status_timeout=5, abort_deadline=3) -> None:
         super().__init__()
         self._status_timeout = status_timeout
+        self._abort_deadline = abort_deadline
+        self._exposure_ids = itertools.count(1)
+        self._activities_lock = threading.Lock()    # checking for conflicting activities and starting one
+        self.timer = None
+        self._status_executor = None
+
+    def start(self):
+        """
+        Called once the devices exist
+        """
+        self._status_executor = ThreadPoolExecutor(max_workers=4 * (2 * len(telescopes) + 1),
+                                                   thread_name_prefix="unit-status-fetcher-")
         self.timer = RepeatTimer(name="unit-timer-thread", interval=2, function=self.on_timer)
         self.timer.start()
 
@@ -66,130 +98,321 @@ class Unit(Activities):
         - Gets the current status from the various components and decides whether activities can
            be ended.
         """
-        mount_status = None
         #
-        # If we (the unit) initiated a slew (UnitActivities.Slewing) and the mount
-        #  became idle, the activity has completed
+        # Slews end within their own operation (see slew()), nothing to poll for them here
         #
-        if self.is_active(UnitActivities.Slewing):
-            if mount_status is None:
-                mount_status = mount.status()
-
-            if mount_status.Activities == Idle:
-                logger.info(f"The mount arrived to destination, ending {UnitActivities.Slewing}")
-                self.end_activity(UnitActivities.Slewing)
+        pass
 
     def slew_to_coordinates(self, primary_coord: float, secondary_coord: float,
-                            coord_system: ValidCoordSystems = ValidCoordSystems.eq):
-        mount_status = mount.status()
+                            coord_system: ValidCoordSystems = ValidCoordSystems.eq,
+                            focus_positions: List[float] = None) -> Operation:
+        """
+        Starts a slew as an operation (see operations.py), returns its handle immediately.
+        The telescopes are prepared (focusers prepositioned, cameras checked) while the mount moves.
+        """
+        with self._activities_lock:
+            if self.is_active(UnitActivities.Slewing):
+                raise Exception("The unit is already slewing")
+            logger.info(f"Starting activity {UnitActivities.Slewing}")
+            self.start_activity(UnitActivities.Slewing)
+
+        try:
+            operation = operations.start(kind='slew', coroutine_function=lambda operation: self.slew(
+                operation, primary_coord=primary_coord, secondary_coord=secondary_coord,
+                coord_system=coord_system, focus_positions=focus_positions))
+        except Exception:
+            self.end_activity(UnitActivities.Slewing)
+            raise
+        # ends with the task, even one that got cancelled before it started running
+        operation.task.add_done_callback(lambda task: self.end_activity(UnitActivities.Slewing))
+        return operation
+
+    @staticmethod
+    def prepare_telescope(t: Telescope, focus_position: Optional[float]) -> dict:
+        """
+        Gets a telescope ready for the coming exposure, while the mount is still slewing
+        """
+        prepared = {'Focuser': None, 'Camera': None}
+        if focus_position is not None:
+            error = t.move_focuser(focus_position)
+            if error is None and not t.wait_for_focuser(timeout=60):
+                error = "did not arrive within 60 sec"
+            prepared['Focuser'] = {'Position': focus_position, 'Error': error}
+
+        camera_status = call_to_completion(t.camera.status)
+        prepared['Camera'] = {
+            'Detected': t.camera.detected,
+            'Error': response_error(camera_status),
+            'Temperature': camera_status.get('Temperature') if isinstance(camera_status, dict) else
+                getattr(camera_status, 'Temperature', None),
+        }
+        return prepared
+
+    async def slew(self, operation: Operation, primary_coord: float, secondary_coord: float,
+                   coord_system: ValidCoordSystems, focus_positions: List[float] = None) -> dict:
+        mount_status = await run_in_threadpool(mount.status)
         if mount_status.Activities != Idle:
             raise Exception(f"The mount is not Idle (activities={str(mount_status.Activities)})")
-        
-        logger.info(f"Starting activity {UnitActivities.Slewing}")
-        self.start_activity(UnitActivities.Slewing)
-        mount_goTo(a1=primary_coord, a2=secondary_coord, coordtype=coord_system)
+
+        if focus_positions is None and self.autofocuser is not None and self.autofocuser.best is not None:
+            focus_positions = [None if math.isnan(p) else float(p) for p in self.autofocuser.best]
+
+        start = time.monotonic()
+        preparations = dict()
+        try:
+            await run_in_threadpool(mount_goTo, a1=primary_coord, a2=secondary_coord, coordtype=coord_system)
+
+            for i, t in enumerate(telescopes):
+                position = focus_positions[i] if focus_positions is not None and i < len(focus_positions) else None
+                preparations[f'telescope-{t.id}'] = asyncio.ensure_future(
+                    run_in_threadpool(self.prepare_telescope, t, position))
+
+            tracker = SlewTracker(target=(primary_coord, secondary_coord))
+            while True:
+                mount_status = await run_in_threadpool(mount.status)
+                progress = tracker.update(mount_position(mount_status, coord_system))
+                progress['Elapsed'] = time.monotonic() - start
+                progress['Prepared'] = [name for name, task in preparations.items() if task.done()]
+                operation.update(progress)
+                if mount_status.Activities == Idle:
+                    break
+                await asyncio.sleep(self._slew_poll_interval)
+
+            slew_duration = time.monotonic() - start
+            logger.info(f"The mount arrived to destination, ending {UnitActivities.Slewing}")
+            await asyncio.gather(*preparations.values(), return_exceptions=True)
+            prepared = dict()
+            for name, task in preparations.items():
+                prepared[name] = task.result() if task.exception() is None else {'Error': f"{task.exception()}"}
+            return {
+                'SlewDuration': slew_duration,
+                'Duration': time.monotonic() - start,
+                'Prepared': prepared,
+            }
+
+        except asyncio.CancelledError:
+            logger.info("slew cancelled, aborting the mount")
+            for task in preparations.values():
+                task.cancel()
+            await run_in_threadpool(mount_abort)
+            raise
+
+    def expose(self, exptime: float) -> str:
+        """
+        Starts an exposure on all the unit's cameras, as simultaneously as possible.  Returns once the
+         cameras acknowledged the trigger, the UnitActivities.Exposing activity ends when they are all done.
+        """
+        if len(telescopes) == 0:
+            return jsonResponse({"Error": "The unit has no telescopes"})
+        with self._activities_lock:
+            if self.is_active(UnitActivities.Exposing):
+                return jsonResponse({"Error": f"Exposure {self.exposure.id} is still in progress"})
+            if self.is_active(UnitActivities.Autofocusing):
+                return jsonResponse({"Error": "Cannot expose while autofocusing"})
+            self.start_activity(UnitActivities.Exposing)
+
+        try:
+            self.exposure = UnitExposure(id=next(self._exposure_ids), exptime=exptime, telescopes=telescopes)
+            report = self.exposure.start()
+            logger.info(f"exposure {self.exposure.id} triggered, skew={report['TriggerSkew']}")
+
+            threading.Thread(name=f"unit-exposure-{self.exposure.id}-completion-thread",
+                             target=self.exposure.wait_for_completion,
+                             kwargs={'on_done': lambda e: self.end_activity(UnitActivities.Exposing)}).start()
+            return jsonResponse({"Value": report})
+
+        except Exception as ex:
+            self.end_activity(UnitActivities.Exposing)
+            return jsonResponse({"Exception": ex})
+
+    def autofocus(self, exptime: float, step: float, max_steps: int = 15) -> str:
+        """
+        Starts autofocusing all the telescopes in parallel, in the background
+        """
+        if len(telescopes) == 0:
+            return jsonResponse({"Error": "The unit has no telescopes"})
+        with self._activities_lock:
+            if self.is_active(UnitActivities.Autofocusing):
+                return jsonResponse({"Error": "Autofocus is already in progress"})
+            if self.is_active(UnitActivities.Exposing):
+                return jsonResponse({"Error": "Cannot autofocus while exposing"})
+            self.start_activity(UnitActivities.Autofocusing)
+
+        try:
+            self.autofocuser = Autofocus(telescopes=telescopes, exptime=exptime, step=step, max_steps=max_steps,
+                                         activities=self)
+        except Exception as ex:
+            self.end_activity(UnitActivities.Autofocusing)
+            return jsonResponse({"Exception": ex})
+
+        def run():
+            try:
+                report = self.autofocuser.run()
+                logger.info(f"autofocus ended: {report}")
+            finally:
+                self.end_activity(UnitActivities.Autofocusing)
+
+        threading.Thread(name="unit-autofocus-thread", target=run).start()
+        return jsonResponse({"Value": self.autofocuser.report()})
 
     def status(self) -> str:
         logger.info(f'unit_status:')
         
         try:
-            stat = {'activities': self.activities, 'devices': dict()}
-            stat['devices']['telescopes'] = list()
-
-            with ThreadPoolExecutor(thread_name_prefix=f"unit-status-fetcher-") as executor:
-                for t in telescopes[1:5]:
-                    t.focuser_status = None
-                    t.camera_status = None
-
-                    t.focuser_future = executor.submit(t.focuser.status)
-                    t.camera_future = executor.submit(t.camera.status)
-
-                # mount_status = None
-                mount_future = executor.submit(mount.status)
-
-                for t in telescopes[1:5]:
-                    try:
-                        t.focuser_status = t.focuser_future.result(timeout=self._status_timeout)
-                    except TimeoutError:
-                        t.focuser_status = None
-                    
-                    try:
-                        t.camera_status = t.camera_future.result(timeout=self._status_timeout)
-                    except TimeoutError:
-                        t.camera_status = None
-
-                try:
-                    mount_status = mount_future.result(timeout=self._status_timeout)
-                except TimeoutError:
-                    mount_status = None
-
-            for t in telescopes[1:5]:
-                stat['devices']['telescopes'].append({
-                    'info': t.info(),
-                    'status': t.status(),
-                    'focuser': {
-                        'info': t.focuser.info(),
-                        'status': t.focuser_status,
+            #
+            # All the devices are asked at once, those that do not answer within the timeout are reported as None
+            #
+            devices = telescopes.focusers + telescopes.cameras + [mount]
+            futures = [self._status_executor.submit(call_to_completion, device.status) for device in devices]
+            wait(futures, timeout=self._status_timeout)
+            statuses = [status_dict(f.result()) if f.done() and f.exception() is None else None for f in futures]
+
+            n = len(telescopes)
+            stat = {
+                'activities': self.activities,
+                'devices': {
+                    'telescopes': telescopes.status(focuser_statuses=statuses[:n], camera_statuses=statuses[n:2 * n]),
+                    'mount': {
+                        'info': mount.info(),
+                        'status': statuses[-1],
                     },
-                    'camera': {
-                        'info': t.camera.info(),
-                        'status': t.camera_status,
-                    }
-                })
-
-            stat['devices']['mount'] = {
-                'info': mount.info(),
-                'status': mount_status
+                },
             }
-
             return jsonResponse({"Value": stat})
         
         except Exception as ex:
             return jsonResponse({"Exception": ex})
     
-    def abort(self):
+    @staticmethod
+    def abort_device(abort: Callable) -> dict:
+        start = time.monotonic()
+        try:
+            error = response_error(call_to_completion(abort))
+        except Exception as ex:
+            error = f"{ex}"
+        return {
+            'Acknowledged': error is None,
+            'Latency': time.monotonic() - start,
+            'Error': error,
+        }
+
+    def abort(self, deadline: float = None) -> str:
+        """
+        Aborts all the unit's devices at once, each on a thread of its own.  Nothing orders them: an abort
+         is an emergency method (see config['drivers']['emergency']), its driver sends it ahead of whatever
+         the device has queued.  Devices that do not acknowledge within the deadline are reported as such,
+         they do not delay the others.
+        """
+        if deadline is None:
+            deadline = self._abort_deadline
 
         try:
             self.start_activity(UnitActivities.Aborting)
+            start = time.monotonic()
+
+            aborts = dict()
+            if mount is not None:
+                aborts['mount'] = mount_abort
+            for i, c in enumerate(cameras):
+                if c is not None:
+                    aborts[f'camera-{i}'] = c.abort
+            for i, f in enumerate(focusers):
+                if f is not None:
+                    aborts[f'focuser-{i}'] = f.abort
+            if not aborts:
+                self.end_activity(UnitActivities.Aborting)
+                return jsonResponse({"Error": "The unit has no devices to abort"})
+
+            futures = dict()
+            executor = ThreadPoolExecutor(max_workers=len(aborts), thread_name_prefix="unit-abort-")
+            for name, abort in aborts.items():
+                futures[name] = executor.submit(self.abort_device, abort)
+            wait(futures.values(), timeout=deadline)
+            executor.shutdown(wait=False)          # don't wait for hung devices
+
+            devices = dict()
+            for name, future in futures.items():
+                if future.done():
+                    devices[name] = future.result()
+                else:
+                    devices[name] = {
+                        'Acknowledged': False,
+                        'Latency': time.monotonic() - start,
+                        'Error': f"No acknowledgement within {deadline} seconds",
+                    }
+                    logger.error(f"abort: {name} did not acknowledge within {deadline} seconds")
 
-            mount_abort()
-            for c in cameras:
-                c.abort()
-            for f in focusers:
-                f.abort()
-            
             self.end_activity(UnitActivities.Aborting)
-            return jsonResponse({"Value": "ok"})
+            return jsonResponse({"Value": {
+                'Acknowledged': all([d['Acknowledged'] for d in devices.values()]),
+                'Duration': time.monotonic() - start,
+                'Devices': devices,
+            }})
         
         except Exception as ex:
+            self.end_activity(UnitActivities.Aborting)
             return jsonResponse({"Exception": ex})
 
     async def quit(self):
         logger.info("Quiting")
         if self.timer is not None:
             self.timer.stop()
-        for driver in [*focusers, *cameras, *mounts]:
-            if isinstance(driver, lipp.Driver):
-                await driver.quit()
+        for handle in [*focusers, *cameras, *mounts]:
+            if isinstance(getattr(handle, 'backend', None), lipp.Driver):
+                await handle.quit()
 
         cmd = "pkill -f 'obs.api.Lipp.*\.loop()'"
         logger.info("Killing LIPP processes with command: \"%s\"", cmd)
         os.system(cmd)
+        telemetry.flush()
 
 
+activities_observers.append(on_activities_changed)
 unit = Unit()
 
 
 # Method 'status'
 @unit_router.get(LAST_API_ROOT + 'unit/status', tags=["unit"], response_class=PrettyJSONResponse)
 async def unit_status(request: Request) -> str:
-    return unit.status()
+    """
+    The unit's status, versioned (see versioning.py): send If-None-Match with the ETag of a previous reply
+     to get a 304 when nothing changed, or since=<Version> to get only what changed
+    """
+    return await run_in_threadpool(unit.status)
 
 
 # Method 'abort'
 @unit_router.get(LAST_API_ROOT + 'unit/abort', tags=["unit"], response_class=PrettyJSONResponse)
-async def unit_abort(request: Request):
-    unit.abort()
+async def unit_abort(request: Request, deadline: float = None):
+    return await run_in_threadpool(unit.abort, deadline=deadline)
+
+
+# Method 'expose'
+@unit_router.get(LAST_API_ROOT + 'unit/expose', tags=["unit"], response_class=PrettyJSONResponse)
+async def unit_expose(exptime: float):
+    return await run_in_threadpool(unit.expose, exptime=exptime)
+
+
+# Method 'exposure'
+@unit_router.get(LAST_API_ROOT + 'unit/exposure', tags=["unit"], response_class=PrettyJSONResponse)
+async def unit_exposure():
+    if unit.exposure is None:
+        return jsonResponse({"Error": "No exposure yet"})
+    return jsonResponse({"Value": unit.exposure.report()})
+
+
+# Method 'autofocus'
+@unit_router.get(LAST_API_ROOT + 'unit/autofocus', tags=["unit"], response_class=PrettyJSONResponse)
+async def unit_autofocus(exptime: float, step: float, max_steps: int = 15):
+    return unit.autofocus(exptime=exptime, step=step, max_steps=max_steps)
+
+
+# Method 'autofocus_status'
+@unit_router.get(LAST_API_ROOT + 'unit/autofocus_status', tags=["unit"], response_class=PrettyJSONResponse)
+async def unit_autofocus_status():
+    if unit.autofocuser is None:
+        return jsonResponse({"Error": "No autofocus yet"})
+    return jsonResponse({"Value": unit.autofocuser.report()})
 
 
 # Method 'quit'
@@ -200,9 +423,49 @@ async def unit_quit():
 
 # Method 'slew_to_coordinates
 @unit_router.get(LAST_API_ROOT + 'unit/slew_to_coordinates', tags=["unit"], response_class=PrettyJSONResponse)
-async def unit_slew_to_coordinates(primary_coord: float, secondary_coord: float, coord_system: ValidCoordSystems):
-    await unit.slew_to_coordinates(primary_coord=primary_coord, secondary_coord=secondary_coord,
-                                   coord_system=coord_system)
+async def unit_slew_to_coordinates(primary_coord: float, secondary_coord: float, coord_system: ValidCoordSystems,
+                                   focus_positions: List[float] = Query(None), wait: bool = False):
+    try:
+        operation = unit.slew_to_coordinates(primary_coord=primary_coord, secondary_coord=secondary_coord,
+                                             coord_system=coord_system, focus_positions=focus_positions)
+    except Exception as ex:
+        return jsonResponse({"Error": f"{ex}"})
+    if wait:
+        return jsonResponse({"Value": await operation.wait()})
+    return jsonResponse({"Value": operation.report()})
+
+
+def get_operation(operation_id: int) -> Operation:
+    operation = operations.get(operation_id)
+    if operation is None:
+        raise HTTPException(status_code=404, detail=f"No operation with id={operation_id}")
+    return operation
+
+
+# Method 'operation'
+@unit_router.get(LAST_API_ROOT + 'unit/operations/{operation_id}', tags=["unit"], response_class=PrettyJSONResponse)
+async def unit_operation(operation_id: int):
+    return jsonResponse({"Value": get_operation(operation_id).report()})
+
+
+# Method 'operation wait'
+@unit_router.get(LAST_API_ROOT + 'unit/operations/{operation_id}/wait', tags=["unit"], response_class=PrettyJSONResponse)
+async def unit_operation_wait(operation_id: int, timeout: float = None):
+    return jsonResponse({"Value": await get_operation(operation_id).wait(timeout=timeout)})
+
+
+# Method 'operation progress'
+@unit_router.get(LAST_API_ROOT + 'unit/operations/{operation_id}/progress', tags=["unit"])
+async def unit_operation_progress(operation_id: int):
+    return StreamingResponse(get_operation(operation_id).progress_stream(), media_type='text/event-stream')
+
+
+# Method 'operation cancel'
+@unit_router.get(LAST_API_ROOT + 'unit/operations/{operation_id}/cancel', tags=["unit"], response_class=PrettyJSONResponse)
+async def unit_operation_cancel(operation_id: int):
+    operation = get_operation(operation_id)
+    operation.cancel()
+    return jsonResponse({"Value": await operation.wait()})
 
 
 # def start_lifespan():
@@ -1,15 +1,20 @@
 from enum import Enum
+import atexit
 import logging
 import platform
 import os
 import datetime
 import json
-from typing import Any, Optional
+from typing import Any, Callable, Optional, Tuple
+import asyncio
+import inspect
 from threading import Timer, Event
 from datetime import timedelta
 
 from json import JSONEncoder
 from starlette.responses import Response
+from timing import timed
+from sequences import SequenceAllocator, DirectoryCache
 import fastapi.responses
 
 TriState = Optional[bool]  # either True, False or None
@@ -29,39 +34,41 @@ class Equipment(Enum):
     Undefined = 6
 
 
-equipment_ids = {
-    "e": [1, 2],
-    "w": [3, 4],
-}
-
-
 class PathMaker:
     top_folder: str
+    sequences: SequenceAllocator
+    directories: DirectoryCache
+    _daily: Optional[Tuple[datetime.date, str]] = None     # (date, its folder)
 
     def __init__(self):
         self.top_folder = os.path.join('/var', 'log', 'last')
-        pass
-
-    @staticmethod
-    def make_seq(path: str):
-        seq_file = os.path.join(path, '.seq')
-
-        os.makedirs(os.path.dirname(seq_file), exist_ok=True)
-        if os.path.exists(seq_file):
-            with open(seq_file) as f:
-                seq = int(f.readline())
-        else:
-            seq = 0
-        seq += 1
-        with open(seq_file, 'w') as file:
-            file.write(f'{seq}\n')
+        self.sequences = SequenceAllocator()
+        self.directories = DirectoryCache()
+        atexit.register(self.sequences.release)
 
-        return seq
+    def make_seq(self, path: str) -> int:
+        """
+        The next sequence number in a folder, from memory (see sequences.py)
+        """
+        return self.sequences.next(path)
 
     def make_daily_log_folder_name(self):
-        directory = os.path.join(self.top_folder, datetime.datetime.now().strftime('%Y-%m-%d'))
-        os.makedirs(directory, exist_ok=True)
-        return directory
+        today = datetime.date.today()
+        daily = self._daily
+        if daily is None or daily[0] != today:
+            daily = (today, self.directories.ensure(os.path.join(self.top_folder, today.strftime('%Y-%m-%d'))))
+            self._daily = daily
+        return daily[1]
+
+    def make_file_name(self, folder: str, prefix: str, suffix: str = '', digits: int = 4) -> str:
+        """
+        A new, uniquely numbered, file name in a folder of the daily folder, without touching the file system
+         (but for the first one in a folder and once per block of sequence numbers), e.g.
+          make_file_name('Exposures', 'exposure', '.fits') -> /var/log/last/<date>/Exposures/exposure-0001.fits
+        """
+        directory = self.directories.ensure(os.path.join(self.make_daily_log_folder_name(), folder))
+        return os.path.join(directory, f"{prefix}-{self.make_seq(directory):0{digits}d}{suffix}")
+
     #
     # def make_exposure_file_name(self):
     #     exposures_folder = os.path.join(self.make_daily_folder_name(), 'Exposures')
@@ -186,13 +193,14 @@ class PrettyJSONResponse(Response):
     media_type = "application/json"
 
     def render(self, content: Any) -> bytes:
-        return json.dumps(
-            content,
-            ensure_ascii=False,
-            allow_nan=False,
-            indent=4,
-            separators=(", ", ": "),
-        ).encode(default_encoding)
+        with timed('serialization'):
+            return json.dumps(
+                content,
+                ensure_ascii=False,
+                allow_nan=False,
+                indent=4,
+                separators=(", ", ": "),
+            ).encode(default_encoding)
 
 
 class ResponseDict(dict):
@@ -232,9 +240,40 @@ class RepeatTimer(Timer):
         self.stopped.set()
 
 
+def call_to_completion(function: Callable, *args, **kwargs) -> object:
+    """
+    Calls a device method which may be either sync or async, from a (non event-loop) thread,
+     and returns its eventual result
+    """
+    result = function(*args, **kwargs)
+    if inspect.isawaitable(result):
+        async def wait_for(awaitable):
+            return await awaitable
+        result = asyncio.run(wait_for(result))
+    return result
+
+
+def response_error(response: object) -> Optional[str]:
+    """
+    Extracts the 'Error' or 'Exception' (if any) from a device response, either a dict or a JSONResponse
+    """
+    if isinstance(response, Response):
+        try:
+            response = json.loads(response.body)
+        except ValueError:
+            return None
+    if isinstance(response, dict):
+        if response.get('Error') is not None:
+            return str(response['Error'])
+        if response.get('Exception') is not None:
+            return str(response['Exception'])
+    return None
+
+
 def jsonResponse(obj: object) -> str:
-    pretty_json = json.dumps(obj, indent=2, default=str)
-    return fastapi.responses.JSONResponse(content=json.loads(pretty_json), media_type="aplication/json")
+    with timed('serialization'):
+        pretty_json = json.dumps(obj, indent=2, default=str)
+        return fastapi.responses.JSONResponse(content=json.loads(pretty_json), media_type="aplication/json")
 
 # class Cached():
 #     _value = None
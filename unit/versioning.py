@@ -0,0 +1,289 @@
+import copy
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.responses import Response
+
+from utils import LAST_API_ROOT, init_log
+from timing import timed
+
+logger = logging.getLogger('unit-versioning')
+init_log(logger)
+
+#
+# Versioned status documents.
+#
+# Every successful ({"Value": ...}) reply of a status route (see config['versioned_status']) is a snapshot
+#  of a document that is kept per route.  Each change of the document bumps its version, which the reply
+#  carries both in the body ("Version") and as its ETag.  A poller that already has a version may either:
+#  - send "If-None-Match: <etag>" and get an empty 304 reply when nothing changed, or
+#  - add "since=<version>" to the query and get only what changed since:
+#      {"Version": ..., "Since": ..., "Changed": {"/path/to/leaf": value, ...}, "Removed": ["/path", ...]}
+#    where the paths are JSON pointers (RFC 6901) to the changed leaves (lists are leaves).  When the
+#    changes since that version are no longer known (e.g. the server restarted) the full reply is sent.
+#
+# The versions start at the server's start time, in milliseconds, so that a version never repeats across
+#  restarts of the unit server.
+#
+# Volatile fields (counters, timestamps, request ids, see config['versioned_status']['volatile']) change on
+#  (almost) every reply, they do not make a new version by themselves: the replies carry their latest values,
+#  the ETag is weak and a delta includes them only along with a real change.
+#
+
+Missing = object()
+
+
+def pointer(path: List[str]) -> str:
+    return ''.join('/' + key.replace('~', '~0').replace('/', '~1') for key in path)
+
+
+def unpointer(ptr: str) -> List[str]:
+    return [key.replace('~1', '/').replace('~0', '~') for key in ptr.split('/')[1:]]
+
+
+def flatten(document: object, path: List[str] = None, leaves: Dict[str, object] = None) -> Dict[str, object]:
+    """
+    The document's leaves, by their JSON pointers (dictionaries are walked, everything else is a leaf)
+    """
+    if path is None:
+        path, leaves = [], dict()
+    if isinstance(document, dict) and (document or not path):
+        for key, value in document.items():
+            flatten(value, path + [str(key)], leaves)
+    else:
+        leaves[pointer(path)] = document
+    return leaves
+
+
+def apply_delta(document: dict, changed: Dict[str, object], removed: List[str]) -> dict:
+    """
+    A copy of the document, with the changes of a 'since' reply applied
+    """
+    document = copy.deepcopy(document)
+    for ptr in removed:
+        *parents, key = unpointer(ptr)
+        node = document
+        for parent in parents:
+            node = node.get(parent) if isinstance(node, dict) else None
+        if isinstance(node, dict):
+            node.pop(key, None)
+    for ptr, value in changed.items():
+        *parents, key = unpointer(ptr)
+        node = document
+        for parent in parents:
+            if not isinstance(node.get(parent), dict):
+                node[parent] = dict()
+            node = node[parent]
+        node[key] = copy.deepcopy(value)
+    return document
+
+
+class VersionedDocument:
+    """
+    The latest snapshot of a document, with the version at which each of its leaves last changed
+    """
+    version: int
+    document: Optional[dict] = None
+    leaves: Dict[str, object]   # the latest
+    versioned: Dict[str, object]    # the leaves as of the latest version
+    changed: Dict[str, int]     # leaf -> version
+    removed: Dict[str, int]     # leaf -> version
+    horizon: int                # the changes after this version are known
+
+    def __init__(self, max_removed: int = 1000, volatile: List[str] = None):
+        self.version = self.horizon = int(time.time() * 1000)
+        self.max_removed = max_removed
+        self.volatile = set([name.lower() for name in volatile or []])
+        self.leaves = dict()
+        self.versioned = dict()
+        self.changed = dict()
+        self.removed = dict()
+        self._body = None
+        self._volatile = dict()     # leaf -> whether it is volatile
+
+    @property
+    def etag(self) -> str:
+        return f'W/"{self.version}"' if self.volatile else f'"{self.version}"'
+
+    def is_volatile(self, ptr: str) -> bool:
+        volatile = self._volatile.get(ptr)
+        if volatile is None:
+            volatile = not self.volatile.isdisjoint([key.lower() for key in unpointer(ptr)])
+            self._volatile[ptr] = volatile
+        return volatile
+
+    def update(self, document: dict) -> bool:
+        """
+        Takes a new snapshot, returns whether it makes a new version (i.e. other than volatile fields changed)
+        """
+        leaves = flatten(document)
+        if self.document is not None and leaves == self.leaves:
+            return False
+        self.document = document
+        self.leaves = leaves
+        self._body = None
+        if self.versioned and leaves.keys() == self.versioned.keys() and \
+                all(self.versioned[ptr] == value for ptr, value in leaves.items() if not self.is_volatile(ptr)):
+            return False
+
+        self.version += 1
+        for ptr, value in leaves.items():
+            if self.versioned.get(ptr, Missing) != value:
+                self.changed[ptr] = self.version
+                self.removed.pop(ptr, None)
+        for ptr in self.versioned.keys() - leaves.keys():
+            self.changed.pop(ptr, None)
+            self.removed[ptr] = self.version
+        while len(self.removed) > self.max_removed:
+            ptr = next(iter(self.removed))
+            self.horizon = max(self.horizon, self.removed.pop(ptr))
+        self.versioned = leaves
+        return True
+
+    def full(self) -> bytes:
+        if self._body is None:
+            self._body = json.dumps({'Value': self.document, 'Version': self.version},
+                                    separators=(',', ':'), default=str).encode()
+        return self._body
+
+    def since(self, version: int) -> Optional[bytes]:
+        """
+        The changes after version, None if they are not known
+        """
+        if version < self.horizon or version > self.version or not isinstance(self.document, dict):
+            return None
+        return json.dumps({
+            'Version': self.version,
+            'Since': version,
+            'Changed': {ptr: self.leaves[ptr] for ptr, v in self.changed.items() if v > version},
+            'Removed': [ptr for ptr, v in self.removed.items() if v > version],
+        }, separators=(',', ':'), default=str).encode()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    def strong(tag: str) -> str:   # weak comparison (RFC 7232)
+        return tag[2:] if tag.startswith('W/') else tag
+
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or strong(etag) in [strong(tag) for tag in tags]
+
+
+class VersionedStatusMiddleware:
+    """
+    An ASGI middleware that versions the replies of the status routes (GET, path ending with one of
+     the configured suffixes) and answers conditional (If-None-Match) and delta (since=) requests
+    """
+    documents: Dict[str, VersionedDocument]     # by path
+
+    def __init__(self, app, suffixes: List[str] = None, max_removed: int = 1000, volatile: List[str] = None):
+        self.app = app
+        self.documents = dict()
+        self.suffixes = tuple(suffixes or ['/status'])
+        self.max_removed = max_removed
+        self.volatile = volatile
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get('path', '')
+        if scope['type'] != 'http' or scope['method'] != 'GET' or not path.startswith(LAST_API_ROOT) or \
+                not path.endswith(self.suffixes):
+            return await self.app(scope, receive, send)
+
+        #
+        # 'since' is ours, the route does not get it
+        #
+        query = parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        since = [value for name, value in query if name == 'since']
+        if since:
+            scope = dict(scope, query_string=urlencode([(n, v) for n, v in query if n != 'since']).encode())
+        try:
+            since = int(since[-1]) if since else None
+        except ValueError:
+            since = None
+        if_none_match = None
+        for name, value in scope.get('headers', []):
+            if name.decode('latin-1').lower() == 'if-none-match':
+                if_none_match = value.decode('latin-1')
+
+        start, chunks = None, []
+
+        async def capture(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+
+        await self.app(scope, receive, capture)
+
+        body = b''.join(chunks)
+        reply = None
+        if start is not None and start['status'] == 200:
+            try:
+                reply = json.loads(body)
+            except ValueError:
+                pass
+        if not isinstance(reply, dict) or 'Value' not in reply:
+            if start is None:
+                return
+            await send(start)
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        document = self.documents.get(path)
+        if document is None:
+            document = VersionedDocument(max_removed=self.max_removed, volatile=self.volatile)
+            self.documents[path] = document
+        with timed('serialization'):
+            document.update(reply['Value'])
+            headers = {'ETag': document.etag}
+            if etag_matches(if_none_match, document.etag):
+                response = Response(status_code=304, headers=headers)
+            else:
+                content = document.since(since) if since is not None else None
+                response = Response(content=content or document.full(), media_type='application/json',
+                                    headers=headers)
+        await response(scope, receive, send)
+
+
+class Replica:
+    """
+    A poller's copy of a versioned status document: the conditional headers and 'since' parameter to
+     send, and the full reply rebuilt from whatever the server answered
+    """
+    reply: Optional[dict] = None
+    version: Optional[int] = None
+    etag: Optional[str] = None
+
+    def headers(self) -> dict:
+        return {'If-None-Match': self.etag} if self.etag else {}
+
+    def params(self) -> dict:
+        return {'since': self.version} if self.version is not None else {}
+
+    def update(self, status_code: int, etag: Optional[str], content: bytes) -> Optional[dict]:
+        """
+        The full reply, None if the server's answer cannot be used (e.g. a 304 when nothing is stored, or changes
+         since a version other than ours).  The replica is then reset, so that asking again gets the full reply.
+        """
+        if status_code == 304 and self.reply is not None:
+            return self.reply
+
+        reply = json.loads(content) if content else None
+        if isinstance(reply, dict) and 'Changed' in reply:
+            if self.reply is None or reply.get('Since') != self.version:
+                # the changes since another version (e.g. concurrent polls crossed), ours cannot be rebuilt
+                self.reply = self.version = self.etag = None
+                return None
+            value = apply_delta(self.reply['Value'], reply['Changed'], reply.get('Removed', []))
+            reply = {'Value': value, 'Version': reply['Version']}
+        if isinstance(reply, dict) and 'Value' in reply and 'Version' in reply:
+            if self.version is None or reply['Version'] >= self.version:   # concurrent polls may cross
+                self.reply, self.version, self.etag = reply, reply['Version'], etag
+        else:
+            self.reply = self.version = self.etag = None
+        return reply
@@ -0,0 +1,152 @@
+import asyncio
+import datetime
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Deque, List, Optional
+
+from fastapi import APIRouter
+
+from utils import LAST_API_ROOT, init_log, jsonResponse
+from telemetry import telemetry
+from config import config
+
+logger = logging.getLogger('unit-loop-watchdog')
+init_log(logger)
+
+watchdog_router = APIRouter()
+
+
+class Stall:
+    started: datetime.datetime
+    duration: Optional[float] = None    # seconds, None while still stalled
+    stack: List[str]
+
+    def __init__(self, stack: List[str], started: datetime.datetime):
+        self.stack = stack
+        self.started = started
+
+    def to_dict(self) -> dict:
+        return {
+            'Started': self.started.isoformat(),
+            'Duration': self.duration,
+            'Stack': self.stack,
+        }
+
+
+class LoopWatchdog:
+    """
+    Detects event-loop stalls (some code blocking the loop):
+    - a heartbeat task on the loop wakes up every 'interval' seconds and measures how late it woke up (the lag)
+    - a watchdog thread checks the heartbeat and, once it is more than 'threshold' seconds late, captures the
+       loop thread's stack, i.e. the code that blocks it
+    """
+    threshold: float
+    interval: float
+    stalls: Deque[Stall]
+    count: int = 0              # stalls so far
+    total: float = 0            # seconds stalled
+    max_lag: float = 0
+    buckets = [0.25, 0.5, 1, 5]     # stall durations histogram, upper bounds (seconds)
+    histogram: List[int]
+    _beat: float = None
+    _stall: Optional[Stall] = None
+    _loop_thread: int = None
+    _task: asyncio.Task = None
+    _thread: threading.Thread = None
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.05, history: int = 50):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = deque(maxlen=history)
+        self.lags = deque(maxlen=1000)
+        self.histogram = [0] * (len(self.buckets) + 1)
+        self._stopped = threading.Event()
+
+    def start(self):
+        """
+        Called on the event loop
+        """
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self.heartbeat())
+        self._thread = threading.Thread(name='loop-watchdog-thread', target=self.watch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def heartbeat(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = now - before - self.interval
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            stall = self._stall
+            if stall is not None:
+                self._stall = None
+                self.end_stall(stall, lag)
+
+    def watch(self):
+        while not self._stopped.wait(self.interval / 2):
+            late = time.monotonic() - self._beat - self.interval
+            if late > self.threshold and self._stall is None:
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = traceback.format_stack(frame) if frame is not None else []
+                self._stall = Stall(stack=[line.rstrip() for line in stack],
+                                    started=datetime.datetime.now() - datetime.timedelta(seconds=late))
+                logger.warning(f"event loop stalled for more than {self.threshold} seconds, at:\n" + ''.join(stack))
+
+    def end_stall(self, stall: Stall, duration: float):
+        stall.duration = duration
+        self.stalls.append(stall)
+        self.count += 1
+        self.total += duration
+        for i, bound in enumerate(self.buckets):
+            if duration <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+        telemetry.record('unit-server.loop-stall', duration)
+        logger.warning(f"event loop stall ended after {duration:.3f} seconds")
+
+    def stats(self) -> dict:
+        lags = sorted(self.lags)
+        labels = [f"<={b}" for b in self.buckets] + [f">{self.buckets[-1]}"]
+        return {
+            'Threshold': self.threshold,
+            'Stalls': self.count,
+            'StalledSeconds': self.total,
+            'Histogram': dict(zip(labels, self.histogram)),
+            'MaxLag': self.max_lag,
+            'P50Lag': lags[len(lags) // 2] if lags else None,
+            'P99Lag': lags[int(len(lags) * 0.99)] if lags else None,
+            'Stalled': self._stall is not None,
+        }
+
+
+loop_watchdog = LoopWatchdog(threshold=config['loop_watchdog']['threshold'],
+                             interval=config['loop_watchdog']['interval'])
+
+
+# Method 'stalls'
+@watchdog_router.get(LAST_API_ROOT + 'admin/stalls', tags=["admin"])
+async def admin_stalls(stacks: bool = False):
+    """
+    The event loop's lag and stall statistics, with the recent stalls' stacks if asked
+    """
+    value = loop_watchdog.stats()
+    if stacks:
+        value['Recent'] = [stall.to_dict() for stall in loop_watchdog.stalls]
+    return jsonResponse({"Value": value})